@@ -0,0 +1,135 @@
+"""
+Functions to help choosing the OpenGL backend and device the standalone context is created on
+
+By default ModernGL creates the context on the platform default (GLX on Linux, WGL on Windows, CGL on MacOS). On Linux
+the context can also be created through EGL, which works without a display and can pick one of several GPUs by device
+index. Software rendering uses Mesa's llvmpipe driver, selected through Mesa's environment variables before the
+context is created. This needs Mesa, which is the usual driver on Linux; on other platforms it only works when a Mesa
+build of the OpenGL library is installed next to Krita.
+
+The benchmark creates a separate context on each device it can find and measures fragment throughput and the speed
+of uploading and reading back a texture, which is what most runs of the tools are bound by.
+"""
+import os
+import time
+from . import RgbaCorrectionHelper
+
+# Backends that can be chosen, as (value, name), an empty value is the platform default
+backends = [("", "Platform default (GLX on Linux)"), ("egl", "EGL (Linux)")]
+
+# Environment variables read by Mesa to use llvmpipe, only the ones set here are removed again
+softwareVariables = ["LIBGL_ALWAYS_SOFTWARE", "GALLIUM_DRIVER", "LP_NUM_THREADS"]
+setVariables = []
+
+# Highest number of EGL devices tried by the benchmark
+maxDevices = 8
+
+# Fragment shader with enough arithmetic per pixel to measure throughput rather than bandwidth
+benchmarkShader = """#version 330 core
+
+out vec4 out_color;
+
+void main() {
+    vec2 p = gl_FragCoord.xy * 0.001;
+    vec4 color = vec4(0.0);
+    for (int i = 0; i < 64; i++) {
+        p = vec2(sin(p.x * 1.7 + p.y), cos(p.y * 1.3 - p.x));
+        color += vec4(p, p.x * p.y, 1.0);
+    }
+    out_color = color / 64.0;
+}"""
+
+# Set or clear the Mesa environment variables for software rendering, threads of 0 uses Mesa's default
+def applySoftwareRendering(enabled, threads):
+    global setVariables
+    for name in setVariables:
+        os.environ.pop(name, None)
+    setVariables = []
+    if not enabled:
+        return
+    values = {"LIBGL_ALWAYS_SOFTWARE": "1", "GALLIUM_DRIVER": "llvmpipe"}
+    if threads > 0:
+        values["LP_NUM_THREADS"] = str(threads)
+    for name, value in values.items():
+        # Do not override variables the user set before starting Krita
+        if name not in os.environ:
+            os.environ[name] = value
+            setVariables.append(name)
+
+# Get the keyword arguments for create_context from the settings
+def getContextArguments(backend, deviceIndex):
+    arguments = {"standalone": True}
+    if backend:
+        arguments["backend"] = backend
+        if backend == "egl" and deviceIndex >= 0:
+            arguments["device_index"] = deviceIndex
+    return arguments
+
+# Create the standalone context with the chosen backend, device, and software rendering
+def createContext(moderngl, backend, deviceIndex, software, threads):
+    applySoftwareRendering(software, threads)
+    return moderngl.create_context(**getContextArguments(backend, deviceIndex))
+
+# Describe the settings a context was created with for the log
+def describeSettings(backend, deviceIndex, software, threads):
+    description = dict(backends).get(backend, backend)
+    if backend == "egl" and deviceIndex >= 0:
+        description += f", device {deviceIndex}"
+    if software:
+        description += f", software rendering ({threads if threads > 0 else 'default'} threads)"
+    return description
+
+# Measure a context, returns its renderer, fragment throughput in megapixels per second, and transfer speed in MiB/s
+def benchmarkContext(ctx, size=1024, passes=8):
+    with ctx:
+        program = ctx.program(vertex_shader=RgbaCorrectionHelper.vertexShader, fragment_shader=benchmarkShader)
+        texture = ctx.texture((size, size), 4, dtype="f1")
+        frameBuffer = ctx.framebuffer([texture])
+        vao = ctx.vertex_array(program, [])
+        vao.vertices = 6
+        vao.mode = ctx.TRIANGLES
+        try:
+            frameBuffer.use()
+            # The first draw includes compiling and allocating, leave it out
+            vao.render()
+            ctx.finish()
+            startTime = time.perf_counter()
+            for i in range(passes):
+                vao.render()
+            ctx.finish()
+            fillRate = size * size * passes / (time.perf_counter() - startTime) / 1000000
+            data = bytes(size * size * 4)
+            startTime = time.perf_counter()
+            texture.write(data)
+            texture.read()
+            transferRate = 2 * len(data) / (time.perf_counter() - startTime) / (1024 * 1024)
+        finally:
+            vao.release()
+            frameBuffer.release()
+            texture.release()
+            program.release()
+        return ctx.info["GL_RENDERER"], fillRate, transferRate
+
+# Benchmark the platform default context and every EGL device that can be created, returns lines describing each
+def benchmarkDevices(moderngl):
+    candidates = [("Platform default", getContextArguments("", -1))]
+    candidates += [(f"EGL device {index}", getContextArguments("egl", index)) for index in range(maxDevices)]
+    results = []
+    for name, arguments in candidates:
+        try:
+            ctx = moderngl.create_context(**arguments)
+        except Exception:
+            # Devices are numbered in order, the first missing one ends the list
+            if "device_index" in arguments:
+                break
+            continue
+        try:
+            results.append((name,) + benchmarkContext(ctx))
+        except Exception as e:
+            results.append((name, str(e), 0.0, 0.0))
+        finally:
+            ctx.release()
+    if not results:
+        return ["No OpenGL device could be created."]
+    fastest = max(result[2] for result in results) or 1.0
+    return [f"{name}: {renderer}\n    {fillRate:.0f} Mpx/s ({fillRate / fastest * 100:.0f}%), transfer {transferRate:.0f} MiB/s" for name, renderer, fillRate, transferRate in results]
@@ -0,0 +1,107 @@
+from krita import *
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QIntValidator, QFont
+from PyQt5.QtWidgets import QDialog, QDialogButtonBox, QComboBox, QLabel, QHBoxLayout, QVBoxLayout, QLineEdit, QTextEdit, QPushButton, QCheckBox
+from . import BackendHelper
+
+# Dialog box to choose the OpenGL backend and device, and compare devices with a quick benchmark
+class BackendSettingsDialog(QDialog):
+    def __init__(self, extension, parent=None):
+        super(BackendSettingsDialog, self).__init__(parent)
+        self.ext = extension
+
+        self.buttonBox = QDialogButtonBox(
+            QDialogButtonBox.Ok |
+            QDialogButtonBox.Cancel,
+            self)
+        self.buttonBox.accepted.connect(self.saveAndAccept)
+        self.buttonBox.rejected.connect(self.reject)
+        self.setWindowModality(Qt.WindowModal)
+        monoFont = QFont("Monospace")
+        monoFont.setStyleHint(QFont.TypeWriter)
+
+        self.backendLayout = QHBoxLayout()
+        self.backendLabel = QLabel("Backend:", self)
+        self.backendCombo = QComboBox(self)
+        for value, name in BackendHelper.backends:
+            self.backendCombo.addItem(name, value)
+        self.deviceLabel = QLabel("EGL device index:", self)
+        self.deviceEdit = QLineEdit("-1", self)
+        self.deviceEdit.setValidator(QIntValidator(-1, 64, self))
+        self.deviceEdit.setToolTip("Index of the EGL device to use, -1 uses the default device.\nRun the benchmark to see the devices that are available.")
+        self.backendLayout.addWidget(self.backendLabel)
+        self.backendLayout.addWidget(self.backendCombo)
+        self.backendLayout.addWidget(self.deviceLabel)
+        self.backendLayout.addWidget(self.deviceEdit)
+
+        self.softwareLayout = QHBoxLayout()
+        self.softwareCheck = QCheckBox("Software rendering (llvmpipe)", self)
+        self.softwareCheck.setToolTip("""Render on the CPU with Mesa's llvmpipe driver, for machines without a usable GPU driver.
+This needs Mesa, which is the usual driver on Linux. If a context was already created, Krita may need to be restarted.""")
+        self.threadsLabel = QLabel("Threads:", self)
+        self.threadsEdit = QLineEdit("0", self)
+        self.threadsEdit.setValidator(QIntValidator(0, 1024, self))
+        self.threadsEdit.setToolTip("Number of threads llvmpipe renders with, 0 uses Mesa's default.")
+        self.softwareLayout.addWidget(self.softwareCheck)
+        self.softwareLayout.addWidget(self.threadsLabel)
+        self.softwareLayout.addWidget(self.threadsEdit)
+
+        self.rendererLabel = QLabel(self)
+        self.benchmarkButton = QPushButton("Run Benchmark", self)
+        self.benchmarkButton.clicked.connect(self.runBenchmark)
+        self.resultBox = QTextEdit()
+        self.resultBox.setReadOnly(True)
+        self.resultBox.setFont(monoFont)
+        self.resultBox.setPlaceholderText("Run the benchmark to compare the relative throughput of the available devices.")
+
+        vbox = QVBoxLayout(self)
+        vbox.addLayout(self.backendLayout)
+        vbox.addLayout(self.softwareLayout)
+        vbox.addWidget(self.rendererLabel)
+        vbox.addWidget(self.benchmarkButton)
+        vbox.addWidget(self.resultBox)
+        vbox.addWidget(self.buttonBox)
+
+        self.readSettings()
+        self.updateRendererLabel()
+
+        self.setWindowTitle("OpenGL Backend Settings")
+        self.setSizeGripEnabled(True)
+        self.resize(600, 400)
+        self.show()
+        self.activateWindow()
+
+    def updateRendererLabel(self):
+        if self.ext.ctx:
+            self.rendererLabel.setText(f"Current renderer: {self.ext.ctx.info['GL_RENDERER']}")
+        else:
+            self.rendererLabel.setText("Current renderer: no context created yet")
+
+    def runBenchmark(self):
+        # Needs ModernGL to be loaded, which also creates the main context
+        if not self.ext.initModernGL():
+            self.resultBox.setPlainText("ModernGL could not be loaded on this system.")
+            return
+        import moderngl
+        self.resultBox.setPlainText("Running benchmark...")
+        QApplication.processEvents()
+        self.resultBox.setPlainText("\n".join(BackendHelper.benchmarkDevices(moderngl)))
+
+    def saveAndAccept(self):
+        self.saveSettings()
+        # Create the context again with the new settings
+        self.ext.resetContext()
+        self.accept()
+
+    def saveSettings(self):
+        self.ext.settings.setValue("mgl_backend", self.backendCombo.currentData())
+        self.ext.settings.setValue("mgl_egl_device", self.deviceEdit.text())
+        self.ext.settings.setValue("mgl_software", self.softwareCheck.isChecked())
+        self.ext.settings.setValue("mgl_software_threads", self.threadsEdit.text())
+        self.ext.settings.sync()
+
+    def readSettings(self):
+        self.backendCombo.setCurrentIndex(max(0, self.backendCombo.findData(self.ext.settings.value("mgl_backend", ""))))
+        self.deviceEdit.setText(self.ext.settings.value("mgl_egl_device", "-1"))
+        self.softwareCheck.setChecked(self.ext.settings.value("mgl_software", "false") == "true")
+        self.threadsEdit.setText(self.ext.settings.value("mgl_software_threads", "0"))
@@ -0,0 +1,50 @@
+"""
+Functions to help running one shader over many layers in a single session
+
+A batch run puts each of its layers where the mapping uses the active layer, one after another, so the same mapping
+filters every layer without going through the mapping dialog again. The shader is compiled once for the whole batch,
+and while the GPU works on one layer the next layer's pixels are fetched from Krita. Textures are not shared, each
+layer's run creates and releases its own like a single run does, so a batch costs the uploads of every layer.
+
+Layers can be the ones selected in the Layers docker, the ones whose name matches a pattern with * and ? wildcards,
+or the ones of a type such as paintlayer, grouplayer, or filllayer. They are run in the order of the Layers docker.
+"""
+from krita import *
+from . import LayerIndex
+
+# Ways to pick the layers of a batch, as (key, name shown in the dialogs)
+batchModes = [
+    ("", "Off"),
+    ("selected", "Selected Layers"),
+    ("name", "Name Pattern"),
+    ("type", "Layer Type")
+]
+
+# Find the layers of a batch in the order of the Layers docker, raises an exception with description if there are none
+def findNodes(doc, mode, pattern):
+    layerIndex = LayerIndex.forDocument(doc)
+    layerIndex.refreshIfNeeded(doc)
+    match mode:
+        case "selected":
+            view = Krita.instance().activeWindow().activeView()
+            selected = {node.uniqueId().toString() for node in view.selectedNodes()} if view else set()
+            nodes = [layerIndex.nodes[uuid] for uuid in layerIndex.uuids if uuid in selected]
+        case "name":
+            nodes = layerIndex.nodesNamed(pattern)
+        case "type":
+            nodes = [layerIndex.nodes[uuid] for uuid in layerIndex.uuids if layerIndex.nodes[uuid].type() == pattern.strip()]
+        case _:
+            raise Exception(f"Unknown batch mode: {mode}")
+    if not nodes:
+        raise Exception("No layers match the batch settings.")
+    return nodes
+
+# Check a plan can be run over the layers of a batch, outputs are the plan items the shader writes
+# Raises an exception with description if nothing in the mapping uses the active layer or a layer cannot be written
+def validate(plan, nodes, outputs):
+    if not any(planItem.isActiveLayer for planItem in plan.items):
+        raise Exception("Nothing in the mapping uses the Active Layer, a batch would run the same shader on the same layers each time.")
+    if any(planItem.isActiveLayer for planItem in outputs):
+        for node in nodes:
+            if node.type() != "paintlayer" and node.type()[-4:] != "mask":
+                raise Exception(f"Layer {node.name()} is not paintable (type={node.type()}), batch outputs on the Active Layer must target paintable layers.")
@@ -1,16 +1,61 @@
 from krita import *
-from PyQt5.QtCore import Qt, QRect, QUuid
-from PyQt5.QtGui import QFont
-from PyQt5.QtWidgets import QDialog, QFileDialog, QDialogButtonBox, QComboBox, QLabel, QHBoxLayout, QVBoxLayout, QMessageBox, QTableWidget, QTableWidgetItem, QCheckBox, QPushButton
+from PyQt5.QtCore import Qt, QRect
+from PyQt5.QtWidgets import QDialog, QFileDialog, QDialogButtonBox, QLabel, QHBoxLayout, QVBoxLayout, QMessageBox, QTableView, QAbstractItemView, QPushButton
 import json
-from . import TextureMapItem
+from . import TextureMapItem, TextureMapModel, StorageBufferItem, StorageBufferHelper, ExecutionPlan, DocumentWatcher, LayerIndex
 
 # Dialog box to configure input and output buffers for the compute shader dialog
 class ComputeBufferMapperDialog(QDialog):
     def __init__(self, parent=None):
         super(ComputeBufferMapperDialog, self).__init__(parent)
-        self.imageMapItems = []
-        self.textureMapItems = []
+        # The item lists are held by the table models, the tables only display them
+        self.imageModel = TextureMapModel.TextureMapModel(
+            [("index", "Image Unit Index"), ("layerId", "Target Layer"), ("read", "Read"), ("write", "Write"), ("repeat", "Repeat"), ("workingFormat", "Working Format"), ("dither", "Dither"), ("overwrite", "Overwrites"), ("arrayLayers", "Layer Array")],
+            ["", "<>", "<2>"],
+            ["", "<ACTIVE LAYER>", "<NEW LAYER>"],
+            {"index": "Image Unit Index.\nThis must be in order, change by reordering rows.",
+             "layerId": "Choose layer in current document to sample from.\n<ACTIVE LAYER> will sample the currently selected layer.\n<NEW LAYER> will add a layer above the current layer.",
+             "read": "Set whether the image is readable (input).",
+             "write": "Set whether the image is writable (output).",
+             "repeat": "Set whether the texture repeats when sampling beyond the bounds.",
+             "workingFormat": "Format the shader works with, Layer Format uses the format of the layer.\nF16 or F32 give float precision on integer layers, values are converted on the GPU to and from the layer's format.",
+             "dither": "Add ordered dithering when a float working format is converted back to an 8 or 16 bit integer layer.",
+             "overwrite": "Set when the image is write only and the shader writes every pixel of this output.\nThe layer's pixels are then not uploaded and the output starts transparent, else pixels the shader does not write keep the layer's content.",
+             "arrayLayers": "Optional name pattern with * and ? wildcards, eg. Frame *.\nEvery layer whose name matches is packed into one image2DArray, a slice per layer from the top of the Layers docker, instead of the Target Layer.\nLayer arrays are read only and all their layers need the same format."},
+            self,
+            {"workingFormat": ExecutionPlan.workingFormats})
+        self.textureModel = TextureMapModel.TextureMapModel(
+            [("index", "Texture Unit Index"), ("layerId", "Target Layer"), ("repeat", "Repeat"), ("variableName", "Sampler Name"), ("workingFormat", "Working Format"), ("arrayLayers", "Layer Array")],
+            ["", "<>"],
+            ["", "<ACTIVE LAYER>"],
+            {"index": "Texture Unit Index.\nThis must be in order, change by reordering rows.",
+             "layerId": "Choose layer in current document to sample from.\n<ACTIVE LAYER> will sample the currently selected layer.",
+             "repeat": "Set whether the texture repeats when sampling beyond the bounds.",
+             "variableName": "Set the name of the sampler to map to in the fragment shader.",
+             "workingFormat": "Format the shader works with, Layer Format uses the format of the layer.\nF16 or F32 give float precision on integer layers, values are converted on the GPU to and from the layer's format.",
+             "arrayLayers": "Optional name pattern with * and ? wildcards, eg. Frame *.\nEvery layer whose name matches is packed into one sampler2DArray, a slice per layer from the top of the Layers docker, instead of the Target Layer.\nLayer arrays are read only and all their layers need the same format."},
+            self,
+            {"workingFormat": ExecutionPlan.workingFormats})
+        self.storageModel = TextureMapModel.TextureMapModel(
+            [("index", "Binding Index"), ("sourceFile", "Source File"), ("size", "Size (bytes)"), ("dataType", "Data Type"), ("readBack", "Read Back"), ("outputFile", "Output File")],
+            [],
+            [],
+            {"index": "Storage Buffer Binding Index.\nThis must be in order, change by reordering rows.",
+             "sourceFile": "Optional .npy or raw binary file used to fill the buffer.",
+             "size": "Optional buffer size in bytes, can use width and height of the document (or of the selection when limited to it), eg. width * height * 4.\nIf a source file is also set, the larger of the two is used.",
+             "dataType": "Type of the buffer elements when read back: i1, u1, i2, u2, i4, u4, f4, or f8.",
+             "readBack": "Set whether the buffer is read back after the shader runs (output).",
+             "outputFile": "Optional .npy or raw binary file to write the read back buffer to."},
+            self)
+        # Compiled mapping, cleared whenever the mapping is edited
+        self.plan = None
+        self.imageModel.mappingEdited.connect(self.invalidatePlan)
+        self.textureModel.mappingEdited.connect(self.invalidatePlan)
+        self.storageModel.mappingEdited.connect(self.invalidatePlan)
+        # Result of the last validation, reused on focus changes until the mapping or document changes
+        self.documentWatcher = DocumentWatcher.getSharedWatcher()
+        self.validationState = None
+        self.validationError = None
         
         self.helpWindow = QMessageBox(parent=self)
         self.buttonBox = QDialogButtonBox(
@@ -31,10 +76,7 @@ class ComputeBufferMapperDialog(QDialog):
         
         self.mapLabel = QLabel("Image Unit Mapping:", self)
         self.createLayerLists()
-        self.imageMap = QTableWidget(len(self.imageMapItems), 5, self)
-        self.imageMap.setHorizontalHeaderLabels(["Image Unit Index", "Target Layer", "Read", "Write", "Repeat"])
-        self.imageMap.setCornerButtonEnabled(False)
-        self.imageMap.verticalHeader().setVisible(False)
+        self.imageMap = self.createTableView(self.imageModel)
         orderUp = QPushButton(Krita.instance().icon("arrow-up"), "Move Up")
         orderUp.clicked.connect(self.moveRowUp)
         orderDown = QPushButton(Krita.instance().icon("arrow-down"), "Move Down")
@@ -50,10 +92,7 @@ class ComputeBufferMapperDialog(QDialog):
         self.mapEditBox.addWidget(listRemove)
         
         self.texMapLabel = QLabel("Texture Unit Mapping:", self)
-        self.textureMap = QTableWidget(len(self.textureMapItems), 4, self)
-        self.textureMap.setHorizontalHeaderLabels(["Texture Unit Index", "Target Layer", "Repeat", "Sampler Name"])
-        self.textureMap.setCornerButtonEnabled(False)
-        self.textureMap.verticalHeader().setVisible(False)
+        self.textureMap = self.createTableView(self.textureModel)
         texOrderUp = QPushButton(Krita.instance().icon("arrow-up"), "Move Up")
         texOrderUp.clicked.connect(self.moveTexRowUp)
         texOrderDown = QPushButton(Krita.instance().icon("arrow-down"), "Move Down")
@@ -67,6 +106,22 @@ class ComputeBufferMapperDialog(QDialog):
         self.texMapEditBox.addWidget(texOrderDown)
         self.texMapEditBox.addWidget(texListAdd)
         self.texMapEditBox.addWidget(texListRemove)
+
+        self.storageMapLabel = QLabel("Storage Buffer Mapping:", self)
+        self.storageMap = self.createTableView(self.storageModel)
+        storageOrderUp = QPushButton(Krita.instance().icon("arrow-up"), "Move Up")
+        storageOrderUp.clicked.connect(self.moveStorageRowUp)
+        storageOrderDown = QPushButton(Krita.instance().icon("arrow-down"), "Move Down")
+        storageOrderDown.clicked.connect(self.moveStorageRowDown)
+        storageListAdd = QPushButton(Krita.instance().icon("list-add"), "Add")
+        storageListAdd.clicked.connect(self.addStorageRow)
+        storageListRemove = QPushButton(Krita.instance().icon("list-remove"), "Remove")
+        storageListRemove.clicked.connect(self.removeStorageRow)
+        self.storageMapEditBox = QHBoxLayout()
+        self.storageMapEditBox.addWidget(storageOrderUp)
+        self.storageMapEditBox.addWidget(storageOrderDown)
+        self.storageMapEditBox.addWidget(storageListAdd)
+        self.storageMapEditBox.addWidget(storageListRemove)
         self.readSettings()
         
         vbox = QVBoxLayout(self)
@@ -76,6 +131,9 @@ class ComputeBufferMapperDialog(QDialog):
         vbox.addWidget(self.texMapLabel)
         vbox.addWidget(self.textureMap)
         vbox.addLayout(self.texMapEditBox)
+        vbox.addWidget(self.storageMapLabel)
+        vbox.addWidget(self.storageMap)
+        vbox.addLayout(self.storageMapEditBox)
         vbox.addWidget(self.buttonBox)
         
         self.setWindowTitle("Configure Input and Output Buffers")
@@ -86,130 +144,95 @@ class ComputeBufferMapperDialog(QDialog):
         self.createLayerLists()
         self.readSettings()
 
-    def updateView(self):
-        # Updates the UI to reflect changes made to the data model
-        self.imageMap.setRowCount(len(self.imageMapItems))
-        for idx in range(len(self.imageMapItems)):
-            # Create the widgets and items that will populate the cells
-            indexWidget = QTableWidgetItem(str(idx))
-            indexWidget.setFlags(indexWidget.flags() ^ Qt.ItemIsEditable)
-            indexWidget.setToolTip("Image Unit Index.\nThis must be in order, change by reordering rows.")
-            layerWidget = QComboBox()
-            layerWidget.addItems(["", "<ACTIVE LAYER>", "<NEW LAYER>"] + self.nameList)
-            layerWidget.setInsertPolicy(QComboBox.NoInsert)
-            layerWidget.setToolTip("Choose layer in current document to sample from.\n<ACTIVE LAYER> will sample the currently selected layer.\n<NEW LAYER> will add a layer above the current layer.")
-            try:
-                layerWidget.setCurrentIndex(self.uuidList.index(self.imageMapItems[idx].layerId))
-            except ValueError:
-                layerWidget.setCurrentIndex(0)
-            readWidget = QCheckBox()
-            readWidget.setChecked(self.imageMapItems[idx].read)
-            readWidget.setToolTip("Set whether the image is readable (input).")
-            writeWidget = QCheckBox()
-            writeWidget.setChecked(self.imageMapItems[idx].write)
-            writeWidget.setToolTip("Set whether the image is writable (output).")
-            repeatWidget = QCheckBox()
-            repeatWidget.setChecked(self.imageMapItems[idx].repeat)
-            repeatWidget.setToolTip("Set whether the texture repeats when sampling beyond the bounds.")
-            # Assign the widgets to cells
-            self.imageMap.setItem(idx, 0, indexWidget)
-            self.imageMap.setCellWidget(idx, 1, layerWidget)
-            self.imageMap.setCellWidget(idx, 2, readWidget)
-            self.imageMap.setCellWidget(idx, 3, writeWidget)
-            self.imageMap.setCellWidget(idx, 4, repeatWidget)
-
-    def updateTexView(self):
-        # Updates the texture mapping UI to reflect changes made to the data models
-        monoFont = QFont("Monospace")
-        monoFont.setStyleHint(QFont.TypeWriter)
-        self.textureMap.setRowCount(len(self.textureMapItems))
-        for idx in range(len(self.textureMapItems)):
-            # Create the widgets and items that will populate the cells
-            indexWidget = QTableWidgetItem(str(idx))
-            indexWidget.setFlags(indexWidget.flags() ^ Qt.ItemIsEditable)
-            indexWidget.setToolTip("Texture Unit Index.\nThis must be in order, change by reordering rows.")
-            layerWidget = QComboBox()
-            layerWidget.addItems(["", "<ACTIVE LAYER>"] + self.nameList)
-            layerWidget.setInsertPolicy(QComboBox.NoInsert)
-            layerWidget.setToolTip("Choose layer in current document to sample from.\n<ACTIVE LAYER> will sample the currently selected layer.")
-            try:
-                uuidIdx = self.uuidList.index(self.textureMapItems[idx].layerId)
-                # This will skip over "new layer" in the index list
-                if uuidIdx >= 2:
-                    uuidIdx -= 1
-                layerWidget.setCurrentIndex(uuidIdx)
-            except ValueError:
-                layerWidget.setCurrentIndex(0)
-            repeatWidget = QCheckBox()
-            repeatWidget.setChecked(self.textureMapItems[idx].repeat)
-            repeatWidget.setToolTip("Set whether the texture repeats when sampling beyond the bounds.")
-            samplerWidget = QTableWidgetItem()
-            samplerWidget.setFont(monoFont)
-            samplerWidget.setToolTip("Set the name of the sampler to map to in the fragment shader.")
-            if self.textureMapItems[idx].variableName: samplerWidget.setText(self.textureMapItems[idx].variableName)
-            # Assign the widgets to cells
-            self.textureMap.setItem(idx, 0, indexWidget)
-            self.textureMap.setCellWidget(idx, 1, layerWidget)
-            self.textureMap.setCellWidget(idx, 2, repeatWidget)
-            self.textureMap.setItem(idx, 3, samplerWidget)
-
-    def updateModel(self):
-        # Updates the image list data to reflect changes made in the UI view
-        self.imageMapItems = []
-        for idx in range(self.imageMap.rowCount()):
-            mapItem = TextureMapItem.TextureMapItem(self.uuidList[self.imageMap.cellWidget(idx, 1).currentIndex()],
-                                                    self.imageMap.cellWidget(idx, 2).isChecked(),
-                                                    self.imageMap.cellWidget(idx, 3).isChecked(),
-                                                    idx,
-                                                    self.imageMap.cellWidget(idx, 4).isChecked(),
-                                                    "")
-            self.imageMapItems.append(mapItem)
-
-    def updateTexModel(self):
-        # Updates the texture list data to reflect changes made in the UI view
-        self.textureMapItems = []
-        for idx in range(self.textureMap.rowCount()):
-            uuidIdx = self.textureMap.cellWidget(idx, 1).currentIndex()
-            if uuidIdx > 1:
-                uuidIdx += 1
-            mapItem = TextureMapItem.TextureMapItem(self.uuidList[uuidIdx],
-                                                    True,
-                                                    False,
-                                                    idx,
-                                                    self.textureMap.cellWidget(idx, 2).isChecked(),
-                                                    self.textureMap.item(idx, 3).text())
-            self.textureMapItems.append(mapItem)
+    def createTableView(self, model):
+        # Table for one of the mapping models, layer drop downs are only created while a cell is edited
+        table = QTableView(self)
+        table.setModel(model)
+        if model.getColumn("layerId") is not None:
+            table.setItemDelegateForColumn(model.getColumn("layerId"), TextureMapModel.LayerDelegate(table))
+        for key in model.choices:
+            table.setItemDelegateForColumn(model.getColumn(key), TextureMapModel.ChoiceDelegate(model.choices[key], table))
+        table.setEditTriggers(QAbstractItemView.CurrentChanged | QAbstractItemView.SelectedClicked | QAbstractItemView.DoubleClicked | QAbstractItemView.EditKeyPressed)
+        table.setCornerButtonEnabled(False)
+        table.verticalHeader().setVisible(False)
+        return table
+
+    def invalidatePlan(self):
+        # Forget the compiled plan and cached validation result after the mapping changes
+        self.plan = None
+        self.validationState = None
 
     def validateMapping(self):
         # Checks if the mapping is valid, throws an exception with description if invalid, nothing otherwise
-        self.updateModel()
-        for item in self.imageMapItems:
+        self.getExecutionPlan()
+        return True
+
+    def getValidationError(self):
+        # Returns the validation error message or None if the mapping is valid
+        # While the document watcher can see layer changes, the result is reused until the mapping or document changes
+        # Changing the active layer is not always a change to the layer model, so it is checked as well
+        doc = Krita.instance().activeDocument()
+        activeNode = doc.activeNode() if doc else None
+        state = (
+            self.documentWatcher.revision,
+            doc.rootNode().uniqueId().toString() if doc else None,
+            activeNode.uniqueId().toString() if activeNode else None)
+        if self.documentWatcher.isTracking() and self.validationState == state:
+            return self.validationError
+        try:
+            self.getExecutionPlan()
+            self.validationError = None
+        except Exception as e:
+            self.validationError = e.args[0]
+        self.validationState = state
+        return self.validationError
+
+    def getExecutionPlan(self):
+        # Returns the mapping resolved against the active document, throws an exception with description if invalid
+        # The plan is reused until the mapping is edited or the document no longer matches it
+        doc = Krita.instance().activeDocument()
+        if self.plan and self.plan.isCurrent(doc):
+            return self.plan
+        self.plan = None
+        for item in self.imageModel.items:
+            if item.arrayLayers:
+                # Layer arrays replace the target layer and are only read
+                if item.write:
+                    raise Exception(f"Invalid Configuration\nImage unit at index {item.index}\nLayer arrays cannot be written.")
+                continue
             # All inputs and outputs need a valid target layer
             if item.layerId == "":
                 raise Exception(f"Invalid Configuration\nImage unit at index {item.index}\nTarget Layer cannot be null.")
-            # All Outputs must map to a paintlayer node
-            if item.write and item.layerId != "<>" and item.layerId != "<2>":
-                layerType = Krita.instance().activeDocument().nodeByUniqueID(QUuid(item.layerId)).type()
-                if layerType != "paintlayer" and layerType[-4:] != "mask":
-                    raise Exception(f"Invalid Configuration\nImage unit at index {item.index}\nOutputs must target paintable layers (type={layerType}).")
             # No inputs can be mapped to new layer
             if item.read and item.layerId == "<2>":
                 raise Exception(f"Invalid Configuration\nImage unit at index {item.index}\nInputs cannot target new layers.")
-        self.updateTexModel()
-        for item in self.textureMapItems:
-            # All textures need a valid target layer
-            if item.layerId == "":
+        for item in self.textureModel.items:
+            # All textures need a valid target layer, or a layer array instead
+            if item.layerId == "" and not item.arrayLayers:
                 raise Exception(f"Invalid Configuration\nTexture unit at index {item.index}\nTarget Layer cannot be null.")
             # Should not happen, but just being safe
             if item.layerId == "<2>":
                 raise Exception(f"Invalid Configuration\nTexture unit at index {item.index}\nInputs cannot target new layers.")
-        return True
+        for item in self.storageModel.items:
+            StorageBufferHelper.StorageBufferHelper().validateItem(item, doc.width(), doc.height())
+        plan = ExecutionPlan.ExecutionPlan(doc)
+        plan.images = plan.resolve(doc, self.imageModel.items, "Image unit", newId="<2>")
+        plan.textures = plan.resolve(doc, self.textureModel.items, "Texture unit")
+        # Storage buffers have no layers to resolve
+        plan.storageBuffers = list(self.storageModel.items)
+        for planItem in plan.images:
+            # All Outputs must map to a paintlayer node
+            if planItem.item.write and not planItem.isNewLayer:
+                if planItem.nodeType != "paintlayer" and planItem.nodeType[-4:] != "mask":
+                    raise Exception(f"Invalid Configuration\nImage unit at index {planItem.index}\nOutputs must target paintable layers (type={planItem.nodeType}).")
+        self.plan = plan
+        return plan
 
     def getSelectedRows(self, table, reverse=False):
         # Helper function to get the currently selected rows on the input buffer table
         # Find which cells are selected and get their rows
         selectedRows = []
-        for idx in table.selectedIndexes():
+        for idx in table.selectionModel().selectedIndexes():
             if idx.row() not in selectedRows:
                 selectedRows.append(idx.row())
         selectedRows.sort(reverse=reverse)
@@ -217,151 +240,66 @@ class ComputeBufferMapperDialog(QDialog):
 
     def moveRowUp(self):
         # Move the current selected rows up if able
-        # Ensure the model is currently up-to-date
-        self.updateModel()
-        selectedRows = self.getSelectedRows(self.imageMap)
-        # Row 0 cannot be moved up, so it and any rows in sequence after are invalid and skipped
-        invalidRow = 0
-        while selectedRows and selectedRows[0] == invalidRow:
-            selectedRows = selectedRows[1:]
-            invalidRow += 1
-        # Quick check to see if there is any work to do
-        if not selectedRows: return
-        # Shuffle all selected rows up one position from front to back
-        for row in selectedRows:
-            self.imageMapItems = self.imageMapItems[:row-1] \
-                                   + [self.imageMapItems[row]] \
-                                   + [self.imageMapItems[row-1]] \
-                                   + self.imageMapItems[row+1:]
-        # Remap the indexes of all items in the list
-        for idx in range(len(self.imageMapItems)):
-            self.imageMapItems[idx].index = idx
-        # Update view for texture unit map
-        self.updateView()
+        self.imageModel.moveRowsUp(self.getSelectedRows(self.imageMap))
 
     def moveTexRowUp(self):
         # Move the current selected rows up if able
-        # Ensure the model is currently up-to-date
-        self.updateTexModel()
-        selectedRows = self.getSelectedRows(self.textureMap)
-        # Row 0 cannot be moved up, so it and any rows in sequence after are invalid and skipped
-        invalidRow = 0
-        while selectedRows and selectedRows[0] == invalidRow:
-            selectedRows = selectedRows[1:]
-            invalidRow += 1
-        # Quick check to see if there is any work to do
-        if not selectedRows: return
-        # Shuffle all selected rows up one position from front to back
-        for row in selectedRows:
-            self.textureMapItems = self.textureMapItems[:row-1] \
-                                    + [self.textureMapItems[row]] \
-                                    + [self.textureMapItems[row-1]] \
-                                    + self.textureMapItems[row+1:]
-        # Remap the indexes of all items in the list
-        for idx in range(len(self.textureMapItems)):
-            self.textureMapItems[idx].index = idx
-        # Update view for input map
-        self.updateTexView()
+        self.textureModel.moveRowsUp(self.getSelectedRows(self.textureMap))
 
     def moveRowDown(self):
         # Move the current selected rows down if able
-        # Ensure the model is currently up-to-date
-        self.updateModel()
-        selectedRows = self.getSelectedRows(self.imageMap, reverse=True)
-        # Last row cannot be moved down, so it and any rows in sequence before are invalid and skipped
-        invalidRow = len(self.imageMapItems) - 1
-        while selectedRows and selectedRows[0] == invalidRow:
-            selectedRows = selectedRows[1:]
-            invalidRow -= 1
-        # Quick check to see if there is any work to do
-        if not selectedRows: return
-        # Shuffle all selected rows down one position from back to front
-        for row in selectedRows:
-            self.imageMapItems = self.imageMapItems[:row] \
-                                        + [self.imageMapItems[row+1]] \
-                                        + [self.imageMapItems[row]] \
-                                        + self.imageMapItems[row+2:]
-        # Remap the indexes of all items in the list
-        for idx in range(len(self.imageMapItems)):
-            self.imageMapItems[idx].index = idx
-        # Update view for texture unit map
-        self.updateView()
+        self.imageModel.moveRowsDown(self.getSelectedRows(self.imageMap, reverse=True))
 
     def moveTexRowDown(self):
         # Move the current selected rows down if able
-        # Ensure the model is currently up-to-date
-        self.updateTexModel()
-        selectedRows = self.getSelectedRows(self.textureMap, reverse=True)
-        # Last row cannot be moved down, so it and any rows in sequence before are invalid and skipped
-        invalidRow = len(self.textureMapItems) - 1
-        while selectedRows and selectedRows[0] == invalidRow:
-            selectedRows = selectedRows[1:]
-            invalidRow -= 1
-        # Quick check to see if there is any work to do
-        if not selectedRows: return
-        # Shuffle all selected rows down one position from back to front
-        for row in selectedRows:
-            self.textureMapItems = self.textureMapItems[:row] \
-                                        + [self.textureMapItems[row+1]] \
-                                        + [self.textureMapItems[row]] \
-                                        + self.textureMapItems[row+2:]
-        # Remap the indexes of all items in the list
-        for idx in range(len(self.textureMapItems)):
-            self.textureMapItems[idx].index = idx
-        # Update view for input map
-        self.updateTexView()
+        self.textureModel.moveRowsDown(self.getSelectedRows(self.textureMap, reverse=True))
 
     def addRow(self):
         # Add a new row with default values below the current row, or at the bottom if none are selected
-        # Ensure the model is currently up-to-date
-        self.updateModel()
         # If multiple rows are selected, place a new entry below the lowest selected row
         selectedRows = self.getSelectedRows(self.imageMap, reverse=True)
         newEntry = TextureMapItem.TextureMapItem("<>")
-        if selectedRows:
-            self.imageMapItems.insert(selectedRows[0]+1, newEntry)
-        else:
-            self.imageMapItems.append(newEntry)
-        self.updateView()
+        self.imageModel.insertItem(selectedRows[0]+1 if selectedRows else len(self.imageModel.items), newEntry)
 
     def addTexRow(self):
         # Add a new row with default values below the current row, or at the bottom if none are selected
-        # Ensure the model is currently up-to-date
-        self.updateTexModel()
         # If multiple rows are selected, place a new entry below the lowest selected row
         selectedRows = self.getSelectedRows(self.textureMap, reverse=True)
         newEntry = TextureMapItem.TextureMapItem("<>")
-        if selectedRows:
-            self.textureMapItems.insert(selectedRows[0]+1, newEntry)
-        else:
-            self.textureMapItems.append(newEntry)
-        self.updateTexView()
+        self.textureModel.insertItem(selectedRows[0]+1 if selectedRows else len(self.textureModel.items), newEntry)
 
     def removeRow(self):
         # Remove the current selected rows from the table
-        # Ensure the model is currently up-to-date
-        self.updateModel()
         # Removing is easy working back to front
-        selectedRows = self.getSelectedRows(self.imageMap, reverse=True)
-        for row in selectedRows:
-            del self.imageMapItems[row]
-        self.updateView()
+        self.imageModel.removeItems(self.getSelectedRows(self.imageMap, reverse=True))
 
     def removeTexRow(self):
         # Remove the current selected rows from the table
-        # Ensure the model is currently up-to-date
-        self.updateTexModel()
         # Removing is easy working back to front
-        selectedRows = self.getSelectedRows(self.textureMap, reverse=True)
-        for row in selectedRows:
-            del self.textureMapItems[row]
-        self.updateTexView()
+        self.textureModel.removeItems(self.getSelectedRows(self.textureMap, reverse=True))
+
+    def moveStorageRowUp(self):
+        # Move the current selected rows up if able
+        self.storageModel.moveRowsUp(self.getSelectedRows(self.storageMap))
+
+    def moveStorageRowDown(self):
+        # Move the current selected rows down if able
+        self.storageModel.moveRowsDown(self.getSelectedRows(self.storageMap, reverse=True))
+
+    def addStorageRow(self):
+        # Add a new row with default values below the current row, or at the bottom if none are selected
+        selectedRows = self.getSelectedRows(self.storageMap, reverse=True)
+        newEntry = StorageBufferItem.StorageBufferItem(size="width * height * 4")
+        self.storageModel.insertItem(selectedRows[0]+1 if selectedRows else len(self.storageModel.items), newEntry)
+
+    def removeStorageRow(self):
+        # Remove the current selected rows from the table
+        self.storageModel.removeItems(self.getSelectedRows(self.storageMap, reverse=True))
 
     def resetMap(self):
-        self.imageMapItems = [TextureMapItem.TextureMapItem("<2>", False, True), TextureMapItem.TextureMapItem("<>")]
-        self.textureMapItems = []
-        self.updateView()
-        self.updateTexView()
+        self.imageModel.setItems([TextureMapItem.TextureMapItem("<2>", False, True), TextureMapItem.TextureMapItem("<>")])
+        self.textureModel.setItems([])
+        self.storageModel.setItems([])
 
     def applyChanges(self):
         try:
@@ -380,7 +318,10 @@ class ComputeBufferMapperDialog(QDialog):
    > Texture units can be bound to texture image2D uniforms using `layout (binding = <INDEX>, <FORMAT>)`.
    > All inputs and outputs must be set to a valid layer in the document, outputs must be assigned to a paintlayer or mask layer.
    > The Repeat option sets whether the layer used as the texture will repeat when sampling beyond the texture bounds.
+   > Images are only uploaded when they are read or may keep some of the layer's pixels, and only read back when they are written. Set Overwrites on write only images the shader writes completely to skip the upload.
    > Textures can be mapped to be used in samplers, these can only be used as inputs.
+   > Storage buffers can be bound to buffer blocks using `layout (std430, binding = <INDEX>) buffer`. They can be filled from a .npy or raw binary file and/or sized in bytes with an expression using width and height.
+   > Storage buffers with Read Back set are read after the shader runs, saved to the Output File if one is set, and kept in storageBufferResults on the compute shader dialog for scripts.
    > Press Reset at any time to reset the inputs and outputs to default values.
    > If you like to poke around, the configuration is saved as JSON. If you break something, delete the mgl_map_comp_texture_map entry in krita-scripterrc and restart Krita.""")
         self.helpWindow.open()
@@ -395,25 +336,29 @@ class ComputeBufferMapperDialog(QDialog):
         if file[0]:
             with open(file[0], 'r') as f:
                 jsonMap = json.loads(f.read())
-                self.imageMapItems = []
-                self.textureMapItems = []
+                imageMapItems = []
+                textureMapItems = []
+                storageItems = []
                 try:
                     # This is for back compatability, if exception is raised then fallback to old method
                     thing = jsonMap[0][0]
                     for item in jsonMap[0]:
-                        self.imageMapItems.append(TextureMapItem.TextureMapItem(json=item))
+                        imageMapItems.append(TextureMapItem.TextureMapItem(json=item))
                     for item in jsonMap[1]:
-                        self.textureMapItems.append(TextureMapItem.TextureMapItem(json=item))
+                        textureMapItems.append(TextureMapItem.TextureMapItem(json=item))
+                    # Storage buffers were added later
+                    if len(jsonMap) > 2:
+                        for item in jsonMap[2]:
+                            storageItems.append(StorageBufferItem.StorageBufferItem(json=item))
                 except Exception:
                     for item in jsonMap:
-                        self.imageMapItems.append(TextureMapItem.TextureMapItem(json=item))
-                self.updateView()
-                self.updateTexView()
+                        imageMapItems.append(TextureMapItem.TextureMapItem(json=item))
+                self.imageModel.setItems(imageMapItems)
+                self.textureModel.setItems(textureMapItems)
+                self.storageModel.setItems(storageItems)
 
     def saveFile(self):
         # Open a file save dialog
-        self.updateModel()
-        self.updateTexModel()
         file = QFileDialog.getSaveFileName(
             self,
             "Save File",
@@ -421,8 +366,7 @@ class ComputeBufferMapperDialog(QDialog):
             "JSON File (*.json)")
         if file[0]:
             with open(file[0], 'w') as f:
-                self.updateModel()
-                f.write(str([self.imageMapItems, self.textureMapItems]))
+                f.write(str([self.imageModel.items, self.textureModel.items, self.storageModel.items]))
 
     def saveAndReject(self):
         self.saveSettings(False)
@@ -433,17 +377,15 @@ class ComputeBufferMapperDialog(QDialog):
         event.accept()
 
     def saveSettings(self, saveMaps=True):
-        if saveMaps:
-            self.updateModel()
-            self.updateTexModel()
         rect = QRect(
             self.geometry().x(),
             self.geometry().y(),
             1, 1) # width and height do not matter
         self.parentWidget().ext.settings.setValue("mgl_map_comp_geometry", rect)
         if saveMaps:
-            self.parentWidget().ext.settings.setValue("mgl_map_comp_texture_map", str(self.imageMapItems))
-            self.parentWidget().ext.settings.setValue("mgl_map_comp_texture_map2", str(self.textureMapItems))
+            self.parentWidget().ext.settings.setValue("mgl_map_comp_texture_map", str(self.imageModel.items))
+            self.parentWidget().ext.settings.setValue("mgl_map_comp_texture_map2", str(self.textureModel.items))
+            self.parentWidget().ext.settings.setValue("mgl_map_comp_storage_map", str(self.storageModel.items))
         self.parentWidget().ext.settings.sync()
 
     def readSettings(self):
@@ -453,32 +395,17 @@ class ComputeBufferMapperDialog(QDialog):
         default = '[{"layerId":"<2>","read":false,"write":true,"index":0,"repeat":true,"variableName":""},{"layerId":"<>","read":true,"write":false,"index":1,"repeat":true,"variableName":""}]'
         jsonMap = json.loads(self.parentWidget().ext.settings.value("mgl_map_comp_texture_map", default))
         jsonMap2 = json.loads(self.parentWidget().ext.settings.value("mgl_map_comp_texture_map2", "[]"))
-        self.imageMapItems = []
-        self.textureMapItems = []
-        for item in jsonMap:
-            self.imageMapItems.append(TextureMapItem.TextureMapItem(json=item))
-        for item in jsonMap2:
-            self.textureMapItems.append(TextureMapItem.TextureMapItem(json=item))
-        self.updateView()
-        self.updateTexView()
+        jsonMap3 = json.loads(self.parentWidget().ext.settings.value("mgl_map_comp_storage_map", "[]"))
+        self.imageModel.setItems([TextureMapItem.TextureMapItem(json=item) for item in jsonMap])
+        self.textureModel.setItems([TextureMapItem.TextureMapItem(json=item) for item in jsonMap2])
+        self.storageModel.setItems([StorageBufferItem.StorageBufferItem(json=item) for item in jsonMap3])
 
     def createLayerLists(self):
         # Assume this will work because you need an active document to open the shader plugin
-        nodes = Krita.instance().activeDocument().topLevelNodes()
-        nameList = []
-        uuidList = []
-        for node in nodes:
-            name, uuid = listNodesRecursive(nameList, uuidList, node)
-            nameList.insert(0, name)
-            uuidList.insert(0, uuid)
-        self.nameList = nameList
-        self.uuidList = ["", "<>", "<2>"] + uuidList
-
-# Helper function to recursively list all nodes in the document
-def listNodesRecursive(names, uuids, node, prefix="  "):
-    children = node.childNodes()
-    for child in children:
-        name, uuid = listNodesRecursive(names, uuids, child, "  " + prefix)
-        names.insert(0, prefix + name)
-        uuids.insert(0, prefix + uuid)
-    return node.name(), node.uniqueId().toString()
\ No newline at end of file
+        # The layer index is shared with the other dialogs and only rebuilt when the document changed
+        doc = Krita.instance().activeDocument()
+        self.layerIndex = LayerIndex.forDocument(doc)
+        self.layerIndex.refreshIfNeeded(doc)
+        # Refreshing replaces these lists, so the models keep consistent lists if the index is refreshed elsewhere
+        self.imageModel.setLayers(self.layerIndex.names, self.layerIndex.uuids, self.layerIndex.rows)
+        self.textureModel.setLayers(self.layerIndex.names, self.layerIndex.uuids, self.layerIndex.rows)
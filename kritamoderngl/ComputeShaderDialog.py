@@ -1,8 +1,9 @@
 from krita import *
+import time
 from PyQt5.QtCore import Qt, QRect, QSettings, QStandardPaths, QUuid
 from PyQt5.QtGui import QIntValidator, QFont
-from PyQt5.QtWidgets import QDialog, QLabel, QHBoxLayout, QVBoxLayout, QMessageBox, QLineEdit, QTextEdit, QCheckBox
-from . import ComputeBufferMapperDialog, RgbaCorrectionHelper
+from PyQt5.QtWidgets import QDialog, QLabel, QHBoxLayout, QVBoxLayout, QMessageBox, QLineEdit, QTextEdit, QCheckBox, QComboBox
+from . import ComputeBufferMapperDialog, RgbaCorrectionHelper, StorageBufferHelper, ReductionHelper, SelectionHelper, FormatConversionHelper, MemoryEstimator, ShaderReflection, ResultCache, TileDiffHelper, SparseTileHelper, ProgressiveWriteHelper, BatchHelper, LayerArrayHelper, ShaderCompileHelper
 
 # Dialog box for compute shader
 class ComputeShaderDialog(QDialog):
@@ -29,11 +30,78 @@ class ComputeShaderDialog(QDialog):
         monoFont.setStyleHint(QFont.TypeWriter)
 
         self.rgbaColorCorrector = RgbaCorrectionHelper.RgbaCorrectionHelper()
+        self.formatConverter = FormatConversionHelper.FormatConversionHelper()
         self.rgbaCorrectCheck = QCheckBox("Fix RGBA color channel order", self)
         self.rgbaCorrectCheck.setChecked(True)
         self.rgbaCorrectCheck.setToolTip("""Attempt to ensure the red and blue color channels are in the correct order when using RGBA color mode.
 When this is checked, RGBA channels should be in the correct order. Else, red and blue channels may be swapped.
 If you notice issues with the order of red and blue color channels, try toggling this option.""")
+        self.selectionHelper = SelectionHelper.SelectionHelper()
+        self.cacheCheck = QCheckBox("Reuse results of identical runs", self)
+        self.cacheCheck.setToolTip("""Keep the results of runs in memory and on disk, and write them straight to the layers when a run with the same shader, settings, mapping, and layer content is done again.
+Layers are still read to check their content, but nothing is compiled, uploaded, or dispatched. Runs with storage buffers are not cached.""")
+        self.tileDiffHelper = TileDiffHelper.TileDiffHelper()
+        self.reductionHelper = ReductionHelper.ReductionHelper()
+        self.progressiveHelper = ProgressiveWriteHelper.ProgressiveWriteHelper()
+        self.batchLabel = QLabel("Batch over layers:", self)
+        self.batchCombo = QComboBox(self)
+        for key, name in BatchHelper.batchModes:
+            self.batchCombo.addItem(name, key)
+        self.batchCombo.setToolTip("""Run the shader once for each layer of a batch, with the layer in place of the active layer in the mapping.
+The shader is compiled once for the whole batch, and the next layer is fetched while the GPU works on the current one.""")
+        self.batchEdit = QLineEdit("", self)
+        self.batchEdit.setPlaceholderText("Name pattern such as Line*, or a type such as paintlayer")
+        self.batchLayout = QHBoxLayout()
+        self.batchLayout.addWidget(self.batchLabel)
+        self.batchLayout.addWidget(self.batchCombo)
+        self.batchLayout.addWidget(self.batchEdit)
+        self.progressiveCheck = QCheckBox("Write back progressively from the view centre", self)
+        self.progressiveCheck.setToolTip(f"""Write the outputs to the layers in {ProgressiveWriteHelper.tileSize}x{ProgressiveWriteHelper.tileSize} tiles, starting at the centre of the view, and show them on the canvas as they are written.
+The write back can be cancelled from the progress dialog, tiles written until then are kept. Progressive runs are not cached.""")
+        self.cropCheck = QCheckBox("Crop new layers to their content", self)
+        self.cropCheck.setToolTip("""Find the bounding box of the pixels that are not transparent in outputs going to new layers on the GPU, and only read back and write that box.
+The rest of the new layer stays empty, which saves read back time and memory for shaders that only draw in a small area.""")
+        self.tileDiffCheck = QCheckBox("Only write back changed tiles", self)
+        self.tileDiffCheck.setToolTip(f"""Compare each output with the layer's original pixels on the GPU in {TileDiffHelper.tileSize}x{TileDiffHelper.tileSize} tiles, and only write the tiles that changed.
+This keeps undo steps and projection updates small for effects that only change part of a layer, at the cost of reading the layers of write only outputs.""")
+        self.selectionCheck = QCheckBox("Limit to selection", self)
+        self.selectionCheck.setToolTip("""Only process the bounding box of the active selection, and blend the result with the original pixels by the selection.
+Layers are only read and written inside that box, so small selections on large documents run much faster.
+Shaders can declare uniform ivec2 region_offset; to get the position of the box in the document.""")
+        self.sparseTileHelper = SparseTileHelper.SparseTileHelper()
+        self.sparseCheck = QCheckBox("Only run on tiles with content", self)
+        self.sparseCheck.setToolTip(f"""Split the region into tiles of about {SparseTileHelper.targetTileSize}x{SparseTileHelper.targetTileSize} pixels and only run the shader on tiles where an input has pixels that are not transparent, so mostly empty layers run much faster.
+The shader is dispatched indirectly over the tiles, the Workgroup X and Y boxes are not used. Use tile_pixel() instead of gl_GlobalInvocationID.xy for the pixel position, tile_origin() gives the first pixel of the tile.
+Tiles without content are left as they were, and storage binding {SparseTileHelper.sparseBinding} is used for the tile list.""")
+        self.haloLabel = QLabel("Halo (pixels):", self)
+        self.haloEdit = QLineEdit("0", self)
+        self.haloEdit.setValidator(QIntValidator(0, 4096, self))
+        self.haloEdit.setToolTip("Tiles also run when an input has content this many pixels outside of them, for shaders that spread content such as blurs and outlines.")
+        self.sparseLayout = QHBoxLayout()
+        self.sparseLayout.addWidget(self.sparseCheck)
+        self.sparseLayout.addStretch()
+        self.sparseLayout.addWidget(self.haloLabel)
+        self.sparseLayout.addWidget(self.haloEdit)
+        self.halfFloatCheck = QCheckBox("Use F16 intermediates for 32 bit float layers", self)
+        self.halfFloatCheck.setToolTip("""Store the texture units of 32 bit float layers as 16 bit floats on the GPU, halving their memory.
+Layers are still uploaded and read back as 32 bit floats, the conversion happens on the GPU.
+Image units keep their format, because the shader declares it.\nPrecision is reduced to about 3 decimal digits, and the saved memory and run time are shown after each run.""")
+        self.budgetLabel = QLabel("VRAM budget (MiB):", self)
+        self.budgetEdit = QLineEdit("0", self)
+        self.budgetEdit.setValidator(QIntValidator(0, 1048576, self))
+        self.budgetEdit.setToolTip("""GPU memory a run may use, checked against an estimate before anything is allocated.
+0 uses the free video memory reported by the driver, if the driver reports it.
+Runs that do not fit use F16 intermediates if that is enough, otherwise they are refused.""")
+        self.memoryLayout = QHBoxLayout()
+        self.memoryLayout.addWidget(self.halfFloatCheck)
+        self.memoryLayout.addStretch()
+        self.memoryLayout.addWidget(self.budgetLabel)
+        self.memoryLayout.addWidget(self.budgetEdit)
+        # Duration of the last run with and without F16 intermediates, to show the time saved
+        self.runTimes = {}
+        self.storageBufferHelper = StorageBufferHelper.StorageBufferHelper()
+        # Read back storage buffers from the last run by binding index, for use from scripts
+        self.storageBufferResults = {}
         
         self.compLabel = QLabel("Compute Shader:", self)
         self.compLayout = QHBoxLayout()
@@ -50,11 +118,7 @@ If you notice issues with the order of red and blue color channels, try toggling
         self.settingSpacer = QLabel("   |   ", self)
         self.mapButton = QPushButton("Map Buffers", self)
         self.mapButton.clicked.connect(self.showMap)
-        try:
-            self.mapWindow.validateMapping()
-        except Exception as e:
-            self.mapButton.setIcon(Krita.instance().icon("warning"))
-            self.mapButton.setToolTip(f"Errors in configuration mapping, open to resolve\nMost likely, previous configuration referred to a layer that does not exist now\n\n{e.args[0]}")
+        self.updateMapButton()
         self.compLayout.addWidget(self.compLabelX)
         self.compLayout.addWidget(self.compWGX)
         self.compLayout.addWidget(self.compLabelY)
@@ -63,6 +127,20 @@ If you notice issues with the order of red and blue color channels, try toggling
         self.compLayout.addWidget(self.compWGZ)
         self.compLayout.addWidget(self.settingSpacer)
         self.compLayout.addWidget(self.mapButton)
+        # Built in reductions of the active layer, only the small results are read back
+        self.statsLayout = QHBoxLayout()
+        self.statsLabel = QLabel("Active Layer Statistics:", self)
+        self.statsCombo = QComboBox(self)
+        for key, name in ReductionHelper.reductionTypes:
+            self.statsCombo.addItem(name, key)
+        self.statsButton = QPushButton("Compute Statistics", self)
+        self.statsButton.clicked.connect(self.computeStatistics)
+        self.statsLayout.addWidget(self.statsLabel)
+        self.statsLayout.addWidget(self.statsCombo)
+        self.statsLayout.addWidget(self.statsButton)
+        self.statsLayout.addStretch()
+        # Result of the last statistics computed, for use from scripts
+        self.statistics = {}
         self.compBox = QTextEdit()
         self.compBox.setAcceptRichText(False)
         self.compBox.setTabChangesFocus(False)
@@ -73,11 +151,23 @@ If you notice issues with the order of red and blue color channels, try toggling
         self.errBox.setAcceptRichText(False)
         self.errBox.setReadOnly(True)
         self.errBox.setPlaceholderText("Enter shader code above and click Run, warnings and errors will appear here.")
+        # Compiles the shader a moment after it is edited and keeps it for runs
+        self.compileHelper = ShaderCompileHelper.ShaderCompileHelper(self.ext, {"compute_shader": self.compBox}, self.getShaderSources, lambda ctx, source: ctx.compute_shader(source), self.errBox, self)
+        self.sparseCheck.toggled.connect(self.compileHelper.schedule)
         
         vbox = QVBoxLayout(self)
         vbox.addWidget(self.compLabel)
         vbox.addLayout(self.compLayout)
         vbox.addWidget(self.rgbaCorrectCheck)
+        vbox.addWidget(self.selectionCheck)
+        vbox.addWidget(self.cacheCheck)
+        vbox.addWidget(self.tileDiffCheck)
+        vbox.addWidget(self.cropCheck)
+        vbox.addWidget(self.progressiveCheck)
+        vbox.addLayout(self.batchLayout)
+        vbox.addLayout(self.sparseLayout)
+        vbox.addLayout(self.memoryLayout)
+        vbox.addLayout(self.statsLayout)
         vbox.addWidget(self.compBox)
         vbox.addWidget(self.errLabel)
         vbox.addWidget(self.errBox)
@@ -104,16 +194,20 @@ If you notice issues with the order of red and blue color channels, try toggling
         # this filter is needed to detect when the window (widget) receives focus
         # because the widget does not receive focus events when the window receives focus
         if event.type() == QEvent.WindowActivate:
-            try:
-                self.mapWindow.validateMapping()
-                self.mapButton.setIcon(QIcon())
-                self.mapButton.setToolTip("")
-            except Exception as e:
-                self.mapButton.setIcon(Krita.instance().icon("warning"))
-                self.mapButton.setToolTip(f"Errors in configuration mapping, open to resolve\nMost likely, previous configuration referred to a layer that does not exist now\n\n{e.args[0]}")
+            self.updateMapButton()
             return True
         return super().eventFilter(obj, event)
 
+    def updateMapButton(self):
+        # Show a warning on the map button if the mapping is invalid, the result is cached so this is cheap on focus changes
+        error = self.mapWindow.getValidationError()
+        if error is None:
+            self.mapButton.setIcon(QIcon())
+            self.mapButton.setToolTip("")
+        else:
+            self.mapButton.setIcon(Krita.instance().icon("warning"))
+            self.mapButton.setToolTip(f"Errors in configuration mapping, open to resolve\nMost likely, previous configuration referred to a layer that does not exist now\n\n{error}")
+
     def showMap(self):
         # Simple function to show the buffer mapping window
         self.mapWindow.open()
@@ -123,59 +217,161 @@ If you notice issues with the order of red and blue color channels, try toggling
         if not doc:
             self.errBox.setPlainText("You need to have a document open to use this script!")
             return
-        # Check layer validity before doing anything
+        # Check layer validity before doing anything, this also resolves every mapped layer once
         try:
-            self.mapWindow.validateMapping()
+            plan = self.mapWindow.getExecutionPlan()
         except Exception as e:
             self.errBox.setPlainText(f"Layer mapping is invalid, click Map Buffers and fix:\n{e.args[0]}")
             return
+        batchMode = self.batchCombo.currentData()
+        if not batchMode:
+            plan.clearPixelData()
+            self.runPlan(doc, plan)
+            return
+        try:
+            nodes = BatchHelper.findNodes(doc, batchMode, self.batchEdit.text())
+            BatchHelper.validate(plan, nodes, [planItem for planItem in plan.images if planItem.item.write])
+        except Exception as e:
+            self.errBox.setPlainText(e.args[0])
+            return
+        plans = [plan.forActiveNode(node) for node in nodes]
+        startTime = time.perf_counter()
+        # The shader is compiled once and taken from the program cache for every layer of the batch
+        for index in range(len(plans)):
+            nextPlan = plans[index + 1] if index + 1 < len(plans) else None
+            if not self.runPlan(doc, plans[index], nextPlan.prefetchActive if nextPlan else None):
+                self.errBox.setPlainText(f"Batch stopped at layer {nodes[index].name()} ({index + 1} of {len(nodes)}):\n{self.errBox.toPlainText()}")
+                return
+        self.errBox.setPlainText(f"Batch ran on {len(nodes)} layers in {time.perf_counter() - startTime:.2f} s.\n{self.errBox.toPlainText()}")
+
+    # Run the shaders with a resolved plan, returns False if the run failed and the error is shown
+    # prefetch is called with the region while the GPU works, batch runs use it to fetch the next layer
+    def runPlan(self, doc, plan, prefetch=None):
+        rgbaFix = self.rgbaCorrectCheck.isChecked()
+        # Limit the work to the bounding box of the selection if asked and there is one, else the whole document
+        selectionRegion = SelectionHelper.getSelectionRegion(doc) if self.selectionCheck.isChecked() else None
+        if selectionRegion and (selectionRegion[2] == 0 or selectionRegion[3] == 0):
+            self.errBox.setPlainText("The selection is outside of the document, there is nothing to process.")
+            return False
+        x, y, width, height = selectionRegion if selectionRegion else (0, 0, plan.width, plan.height)
+        halfFloat = self.halfFloatCheck.isChecked()
+        tileDiff = self.tileDiffCheck.isChecked()
+        cropNewLayers = self.cropCheck.isChecked()
+        progressive = self.progressiveCheck.isChecked()
+        sparse = self.sparseCheck.isChecked()
+        if sparse:
+            try:
+                self.sparseTileHelper.validate(plan.storageBuffers)
+            except Exception as e:
+                self.errBox.setPlainText(f"Layer mapping is invalid, click Map Buffers and fix:\n{e.args[0]}")
+                return False
+        startTime = time.perf_counter()
+        # Check the run fits in GPU memory before allocating anything, the cache key needs the F16 setting it ends up with
+        with self.ext.ctx as ctx:
+            try:
+                halfFloat, fallbackMessage = MemoryEstimator.preflightCheck(
+                    ctx,
+                    int(self.budgetEdit.text() or "0"),
+                    lambda useHalfFloat: MemoryEstimator.estimateCompute(plan, width, height, rgbaFix, selectionRegion, useHalfFloat),
+                    halfFloat)
+            except Exception as e:
+                self.errBox.setPlainText(str(e))
+                return False
+        # Reuse the result of an identical run if there is one, storage buffers have effects outside the layers so those runs are not cached
+        cacheKey = None
+        if self.cacheCheck.isChecked() and not plan.storageBuffers:
+            cacheKey = self.getCacheKey(doc, plan, rgbaFix, halfFloat, selectionRegion, (x, y, width, height))
+            cached = self.ext.getResultCache().get(cacheKey)
+            if cached is not None:
+                newNodes = ResultCache.writeResults(doc, plan.images, cached, x, y, width, height)
+                for newNode in newNodes:
+                    plan.getActiveNode(doc).parentNode().addChildNode(newNode, plan.getActiveNode(doc))
+                doc.refreshProjection()
+                plan.clearPixelData()
+                self.errBox.setPlainText(f"Reused the result of an identical run in {(time.perf_counter() - startTime) * 1000:.0f} ms.")
+                self.saveSettings()
+                return True
+        # Progressive runs never read back whole results, so there is nothing to cache
+        if progressive:
+            cacheKey = None
+        cachedResults = []
+        # Set when part of the write back failed after the shader ran, the error is shown and a batch stops
+        failed = False
+        messages = [fallbackMessage] if fallbackMessage else []
         newNodes = []
         images = []
+        imageData = []
         textures = []
         shader = None
         # Must specify this context otherwise Krita will cause issues if using OpenGL for main renderer
         with self.ext.ctx as ctx:
             # Create a shader program from the text boxes
             try:
-                shader = ctx.compute_shader(self.compBox.toPlainText())
+                shader = self.compileHelper.getProgram(ctx, self.getShaderSources())
             except Exception as e:
                 self.errBox.setPlainText(str(e))
                 # Cleanup and early exit
-                if shader:
-                    shader.release()
                 self.saveSettings()
-                return
+                return False
+            # Shaders can optionally read where the processed region is in the document
+            regionOffset = shader.get("region_offset", None)
+            if regionOffset is not None:
+                regionOffset.value = (x, y)
+            # Units the shader never uses are not fetched, uploaded, bound, or written back
+            bindings = ShaderReflection.findBindings(shader, [self.compBox.toPlainText()])
+            activeImages = []
+            for planItem in plan.images:
+                if ShaderReflection.imageUnitUsed(bindings, planItem.item):
+                    activeImages.append(planItem)
+                else:
+                    messages.append(f"Warning: image unit {planItem.index} is not used by the shader and was skipped.")
+            activeTextures = []
+            for planItem in plan.textures:
+                if ShaderReflection.textureUnitUsed(shader, bindings, planItem.item):
+                    activeTextures.append(planItem)
+                else:
+                    messages.append(f"Warning: texture unit {planItem.index} is not used by the shader and was skipped.")
+            messages += ShaderReflection.describeUnmapped(bindings, [planItem.item for planItem in plan.textures], [planItem.item for planItem in plan.images])
+            if selectionRegion:
+                self.selectionHelper.createMask(ctx, doc, selectionRegion)
             # Create textures for each mapped input and output image
-            for item in self.mapWindow.imageMapItems:
-                if item.layerId == "<2>":
-                    node = doc
+            for planItem in activeImages:
+                # Layer arrays are read only, their slices are packed and uploaded together
+                if planItem.arrayNodes:
+                    images.append(LayerArrayHelper.createTextureArray(ctx, plan, planItem, (x, y, width, height), rgbaFix))
+                    imageData.append(None)
+                    continue
+                if planItem.isNewLayer:
+                    original = None
                     data = None
                 else:
-                    if item.layerId == "<>":
-                        node = doc.activeNode()
-                    else:
-                        node = doc.nodeByUniqueID(QUuid(item.layerId))
-                    data = node.projectionPixelData(0, 0, doc.width(), doc.height())
-                components, colorType = self.getColorComponentsAndType(node)
-                texture = ctx.texture((doc.width(), doc.height()), components, data=data, dtype=colorType)
+                    # Write only images the shader fully overwrites are not uploaded, their pixels are only needed to blend with the selection
+                    keepsPixels = planItem.item.read or not planItem.item.overwrite
+                    original = plan.fetchPixelData(planItem, x, y, width, height) if keepsPixels or selectionRegion else None
+                    data = original if keepsPixels else None
+                if planItem.workingType:
+                    # Converted to the working format on the GPU, this also puts the channels in order
+                    texture = self.formatConverter.convertInput(ctx, planItem, (width, height), data, rgbaFix and planItem.needsCorrection)
+                else:
+                    texture = ctx.texture((width, height), planItem.components, data=data, dtype=planItem.colorType)
+                # Images without data start transparent, cleared on the GPU instead of uploading anything
+                if data is None:
+                    self.formatConverter.clearTexture(ctx, texture)
                 images.append(texture)
+                # The original pixels are needed again to blend with the selection
+                imageData.append(original if selectionRegion else None)
                 # If color correction is needed on an input, add it to a prepass shader to correct it
-                if self.rgbaCorrectCheck.isChecked() and item.read:
-                    self.rgbaColorCorrector.fixTextureIfNeeded(doc, texture)
+                if rgbaFix and planItem.needsCorrection and not planItem.workingType and planItem.item.read:
+                    self.rgbaColorCorrector.fixTexture(texture)
             # Run the prepass color correction shader
-            if self.rgbaCorrectCheck.isChecked():
+            if rgbaFix:
                 self.rgbaColorCorrector.renderCorrectionIfNeeded(ctx, doc)
             # Bind images to the compute shader
-            for idx in range(len(self.mapWindow.imageMapItems)):
-                item = self.mapWindow.imageMapItems[idx]
-                if item.layerId == "<2>":
-                    node = doc
-                elif item.layerId == "<>":
-                    node = doc.activeNode()
-                else:
-                    node = doc.nodeByUniqueID(QUuid(item.layerId))
+            for idx in range(len(activeImages)):
+                planItem = activeImages[idx]
+                item = planItem.item
                 try:
-                    if self.rgbaCorrectCheck.isChecked() and self.rgbaColorCorrector.nodeNeedsCorrection(node) and item.read:
+                    if rgbaFix and planItem.needsCorrection and not planItem.workingType and item.read:
                         # If an input image was corrected, bind the corrected image
                         self.rgbaColorCorrector.getNextCorrectedTexture().bind_to_image(item.index, read=True, write=item.write)
                     else:
@@ -185,23 +381,28 @@ If you notice issues with the order of red and blue color channels, try toggling
                     # Cleanup and early exit
                     for i in images:
                         i.release()
-                    shader.release()
                     self.rgbaColorCorrector.cleanUp()
-                    return
+                    self.storageBufferHelper.cleanUp()
+                    self.sparseTileHelper.cleanUp()
+                    self.selectionHelper.cleanUp()
+                    self.formatConverter.cleanUp()
+                    return False
                 # Add any outputs to a correction shader that runs after the compute shader
-                if self.rgbaCorrectCheck.isChecked() and item.write:
-                    self.rgbaColorCorrector.fixTextureIfNeeded(node, images[idx])
+                if rgbaFix and planItem.needsCorrection and not planItem.workingType and item.write:
+                    self.rgbaColorCorrector.fixTexture(images[idx])
             # Create textures for mapped texture units
-            for item in self.mapWindow.textureMapItems:
-                if item.layerId == "<>":
-                    node = doc.activeNode()
+            for planItem in activeTextures:
+                item = planItem.item
+                workingType = planItem.getWorkingType(halfFloat)
+                if planItem.arrayNodes:
+                    texture = LayerArrayHelper.createTextureArray(ctx, plan, planItem, (x, y, width, height), rgbaFix)
+                elif workingType:
+                    texture = self.formatConverter.convertInput(ctx, planItem, (width, height), plan.fetchPixelData(planItem, x, y, width, height), rgbaFix and planItem.needsCorrection, workingType)
                 else:
-                    node = doc.nodeByUniqueID(QUuid(item.layerId))
-                components, colorType = self.getColorComponentsAndType(node)
-                texture = ctx.texture((doc.width(), doc.height()), components, data=node.projectionPixelData(0, 0, doc.width(), doc.height()), dtype=colorType)
-                # Perform RGBA color channel corrections on texture if needed
-                if self.rgbaCorrectCheck.isChecked():
-                    self.rgbaColorCorrector.swizzleTextureIfNeeded(node, texture)
+                    texture = ctx.texture((width, height), planItem.components, data=plan.fetchPixelData(planItem, x, y, width, height), dtype=planItem.colorType)
+                    # Perform RGBA color channel corrections on texture if needed
+                    if rgbaFix and planItem.needsCorrection:
+                        self.rgbaColorCorrector.swizzleTexture(texture)
                 textures.append(texture)
                 # Attempt to bind the textures to the shader and texture units and assign samplers
                 try:
@@ -214,9 +415,31 @@ If you notice issues with the order of red and blue color channels, try toggling
                         i.release()
                     for t in textures:
                         t.release()
-                    shader.release()
                     self.rgbaColorCorrector.cleanUp()
-                    return
+                    self.storageBufferHelper.cleanUp()
+                    self.sparseTileHelper.cleanUp()
+                    self.selectionHelper.cleanUp()
+                    self.formatConverter.cleanUp()
+                    return False
+            # Find the tiles with content first, that pass uses the first storage bindings
+            # Then create, fill, and bind the storage buffers
+            try:
+                if sparse:
+                    inputs = [images[idx] for idx in range(len(activeImages)) if activeImages[idx].item.read and not activeImages[idx].isNewLayer]
+                    self.sparseTileHelper.findTiles(ctx, inputs + textures, (width, height), int(self.haloEdit.text() or "0"))
+                self.storageBufferHelper.createBuffers(ctx, plan.storageBuffers, width, height)
+            except Exception as e:
+                self.errBox.setPlainText(str(e))
+                for i in images:
+                    i.release()
+                for t in textures:
+                    t.release()
+                self.rgbaColorCorrector.cleanUp()
+                self.storageBufferHelper.cleanUp()
+                self.sparseTileHelper.cleanUp()
+                self.selectionHelper.cleanUp()
+                self.formatConverter.cleanUp()
+                return False
             # Try to get the workgroup dimensions
             try:
                 workgroupX = int(self.compWGX.text())
@@ -228,15 +451,28 @@ If you notice issues with the order of red and blue color channels, try toggling
                     i.release()
                 for t in textures:
                     t.release()
-                shader.release()
                 self.rgbaColorCorrector.cleanUp()
-                return
+                self.storageBufferHelper.cleanUp()
+                self.sparseTileHelper.cleanUp()
+                self.selectionHelper.cleanUp()
+                self.formatConverter.cleanUp()
+                return False
             # Run the shader
             try:
-                shader.run(workgroupX, workgroupY, workgroupZ)
+                if sparse:
+                    self.sparseTileHelper.run(shader, workgroupZ)
+                else:
+                    shader.run(workgroupX, workgroupY, workgroupZ)
+                # Fetch the next layer of a batch while the GPU works on this one
+                if prefetch:
+                    prefetch(x, y, width, height)
+                # Image writes must be visible to the passes that sample the images afterwards
+                ctx.memory_barrier()
                 ctx.finish()
+                if sparse:
+                    messages.append(self.sparseTileHelper.describe())
                 # Run the correction shader on any outputs that need it
-                if self.rgbaCorrectCheck.isChecked():
+                if rgbaFix:
                     self.rgbaColorCorrector.renderCorrectionIfNeeded(ctx, doc)
             except Exception as e:
                 self.errBox.setPlainText(str(e))
@@ -244,52 +480,159 @@ If you notice issues with the order of red and blue color channels, try toggling
                     i.release()
                 for t in textures:
                     t.release()
-                shader.release()
                 self.rgbaColorCorrector.cleanUp()
-                return
+                self.storageBufferHelper.cleanUp()
+                self.sparseTileHelper.cleanUp()
+                self.selectionHelper.cleanUp()
+                self.formatConverter.cleanUp()
+                return False
+            # The shader ran, errors from here on are from the write back and are kept over the messages
+            self.errBox.setPlainText("")
+            # Find the texture holding the result of each output in the layer's format
+            # Corrected ones are returned in the order they were added
+            results = []
+            try:
+                for idx in range(len(activeImages)):
+                    planItem = activeImages[idx]
+                    if not planItem.item.write:
+                        continue
+                    if planItem.workingType:
+                        results.append((idx, self.formatConverter.convertOutput(ctx, planItem, images[idx], rgbaFix and planItem.needsCorrection)))
+                    elif rgbaFix and planItem.needsCorrection:
+                        results.append((idx, self.rgbaColorCorrector.getNextCorrectedTexture()))
+                    else:
+                        results.append((idx, images[idx]))
+                # Blend the results with the original pixels by the selection mask
+                if selectionRegion and results:
+                    for idx, texture in results:
+                        self.selectionHelper.blendTexture(ctx, texture, imageData[idx])
+                    self.selectionHelper.renderBlendIfNeeded(ctx)
+                    results = [(idx, self.selectionHelper.getNextBlendedTexture()) for idx, texture in results]
+            except Exception as e:
+                self.errBox.setPlainText(f"Failed to prepare the outputs:\n{e}")
+                failed = True
+                results = []
+                cacheKey = None
             # Set the pixel data of the nodes assigned to outputs
-            for idx in range(len(self.mapWindow.imageMapItems)):
-                item = self.mapWindow.imageMapItems[idx]
-                if not item.write:
-                    continue
-                if item.layerId == "<2>":
+            for idx, texture in results:
+                planItem = activeImages[idx]
+                if planItem.isNewLayer:
                     node = doc.createNode(f"Render Result {idx}", "paintlayer")
                     newNodes.append(node)
-                elif item.layerId == "<>":
-                    node = doc.activeNode()
                 else:
-                    node = doc.nodeByUniqueID(QUuid(item.layerId))
+                    node = planItem.node
                 try:
-                    if self.rgbaCorrectCheck.isChecked() and self.rgbaColorCorrector.nodeNeedsCorrection(node):
-                        node.setPixelData(self.rgbaColorCorrector.getNextCorrectedTexture().read(), 0, 0, doc.width(), doc.height())
+                    cropped = cropNewLayers and planItem.isNewLayer
+                    # The whole result is only read back when all of it is written or it has to be cached
+                    # Cropped layers are cached as the part that was written, so a reused result is cropped the same way
+                    data = texture.read() if not cropped and (cacheKey or not (tileDiff or progressive)) else None
+                    if cropped:
+                        bounds = self.reductionHelper.findBounds(ctx, texture)
+                        spans = [bounds] if bounds else []
+                        if bounds:
+                            messages.append(f"Result {idx}: new layer cropped to x {bounds[0] + x}, y {bounds[1] + y}, width {bounds[2]}, height {bounds[3]}")
+                        else:
+                            messages.append(f"Result {idx}: fully transparent, the new layer was left empty")
+                    elif tileDiff:
+                        original = None if planItem.isNewLayer else plan.fetchPixelData(planItem, x, y, width, height)
+                        spans = self.tileDiffHelper.findChangedSpans(ctx, texture, original)
+                    else:
+                        spans = [(0, 0, width, height)]
+                    if progressive:
+                        # Written tile by tile after the run is cleaned up
+                        self.progressiveHelper.add(ctx, node, texture, spans)
                     else:
-                        node.setPixelData(images[idx].read(), 0, 0, doc.width(), doc.height())
+                        for spanX, spanY, spanWidth, spanHeight, spanData in self.tileDiffHelper.readSpans(ctx, texture, spans, data):
+                            node.setPixelData(spanData, x + spanX, y + spanY, spanWidth, spanHeight)
+                            if cropped and cacheKey:
+                                cachedResults.append((plan.images.index(planItem), planItem.isNewLayer, spanData, (spanX, spanY, spanWidth, spanHeight)))
+                    if cropped and cacheKey and not spans:
+                        cachedResults.append((plan.images.index(planItem), planItem.isNewLayer, b"", (0, 0, 0, 0)))
+                    if data is not None:
+                        cachedResults.append((plan.images.index(planItem), planItem.isNewLayer, data, (0, 0, width, height)))
                 except Exception as e:
                     self.errBox.setPlainText(str(e))
+                    cacheKey = None
+                    failed = True
+            if self.tileDiffHelper.totalTiles:
+                messages.append(self.tileDiffHelper.describe())
+            # Read back any storage buffers marked as outputs
+            try:
+                messages += self.storageBufferHelper.readBack()
+            except Exception as e:
+                self.errBox.setPlainText(f"Failed to read back storage buffers:\n{e}")
+                failed = True
+            self.storageBufferResults = self.storageBufferHelper.results
             # Cleanup
             for i in images:
                 i.release()
             for t in textures:
                 t.release()
-            shader.release()
             self.rgbaColorCorrector.cleanUp()
+            self.storageBufferHelper.cleanUp()
+            self.sparseTileHelper.cleanUp()
+            self.selectionHelper.cleanUp()
+            self.formatConverter.cleanUp()
+            self.tileDiffHelper.cleanUp()
+            self.reductionHelper.cleanUp()
         # Exit the context scope before adding new nodes
         for newNode in newNodes:
-            doc.activeNode().parentNode().addChildNode(newNode, doc.activeNode())
+            plan.getActiveNode(doc).parentNode().addChildNode(newNode, plan.getActiveNode(doc))
         doc.refreshProjection()
+        if self.progressiveHelper.jobs:
+            messages.append(self.progressiveHelper.write(self.ext.ctx, doc, (x, y, width, height), self))
+        plan.clearPixelData()
+        if cacheKey and cachedResults:
+            self.ext.getResultCache().put(cacheKey, cachedResults)
+        self.runTimes[halfFloat] = time.perf_counter() - startTime
+        if halfFloat:
+            messages.append(MemoryEstimator.describeHalfFloatSavings(
+                MemoryEstimator.estimateCompute(plan, width, height, rgbaFix, selectionRegion, True),
+                MemoryEstimator.estimateCompute(plan, width, height, rgbaFix, selectionRegion, False),
+                self.runTimes[True],
+                self.runTimes.get(False)))
+        # Only show messages about the run if it did not fail
+        if messages and not self.errBox.toPlainText():
+            self.errBox.setPlainText("\n".join(messages))
         self.saveSettings()
+        return not failed
 
-    def getColorComponentsAndType(self, node):
-        # Helper function to get the number of components and data type from a node
-        colorModel = node.colorModel()
-        # Number of components is the number of capitals in the color model, unless GRAYA
-        if colorModel == "GRAYA":
-            components = 2
-        else:
-            components = sum(1 for c in colorModel if c.isupper())
-        colorDepth = node.colorDepth()
-        colorDepth = colorDepth[0].lower() + str(int(colorDepth[1:]) // 8)
-        return components, colorDepth
+    def getShaderSources(self):
+        # Source to compile as it is in the text box, with the tile functions in sparse tile mode
+        source = self.compBox.toPlainText()
+        return (self.sparseTileHelper.prepareSource(source) if self.sparseCheck.isChecked() else source,)
+
+    def getCacheKey(self, doc, plan, rgbaFix, halfFloat, selectionRegion, region):
+        # Everything that decides the result of a run, with the content of the layers it reads
+        x, y, width, height = region
+        readImages = [planItem for planItem in plan.images if not planItem.isNewLayer and (planItem.item.read or not planItem.item.overwrite or selectionRegion)]
+        return ResultCache.makeKey([
+            "compute",
+            self.compBox.toPlainText(),
+            [self.compWGX.text(), self.compWGY.text(), self.compWGZ.text()],
+            [self.sparseCheck.isChecked(), self.haloEdit.text()],
+            rgbaFix,
+            halfFloat,
+            self.cropCheck.isChecked(),
+            [doc.colorModel(), doc.colorDepth()],
+            region,
+            ResultCache.fingerprint(doc.selection().pixelData(x, y, width, height)) if selectionRegion else None,
+            str([planItem.item for planItem in plan.images]),
+            str([planItem.item for planItem in plan.textures]),
+            ResultCache.fingerprintLayers(plan, readImages, x, y, width, height),
+            ResultCache.fingerprintLayers(plan, plan.textures, x, y, width, height)])
+
+    def computeStatistics(self):
+        doc = Krita.instance().activeDocument()
+        if not doc or not doc.activeNode():
+            self.errBox.setPlainText("You need to have a document open to use this script!")
+            return
+        try:
+            self.statistics = self.ext.layerStatistics(doc.activeNode(), self.statsCombo.currentData(), doc)
+        except Exception as e:
+            self.errBox.setPlainText(f"Failed to compute statistics:\n{e}")
+            return
+        self.errBox.setPlainText(f"Statistics for {doc.activeNode().name()}:\n" + ReductionHelper.formatResult(self.statistics))
 
     def showHelp(self):
         self.helpWindow.setText("Krita ModernGL Compute Shader Programming")
@@ -299,6 +642,21 @@ If you notice issues with the order of red and blue color channels, try toggling
    > Input and output images and textures can be configured using the Map Buffers button on top left.
    > By default, the active layer is the input on image unit 1, and the output uses image unit 0 and will be added to a new layer above the active layer.
    > Textures can be configured as inputs to be used with samplers.
+   > A Layer Array pattern packs every layer whose name matches it into one read only sampler2DArray or image2DArray, a slice per layer from the top of the Layers docker. Set Workgroup Z to run over the slices.
+   > Mapped images and textures the compiled shader does not use are skipped with a warning, so their layers are not fetched or uploaded. Samplers and images the shader uses without a mapping are flagged too.
+   > Active Layer Statistics computes a histogram, min and max, mean, or bounding box of non-transparent pixels on the GPU and only reads back the result.
+   > Each image and texture can use a F16 or F32 working format, integer layers are then normalized to 0.0-1.0 floats and converted back on the GPU, with optional dithering.
+   > Limit to selection only processes the bounding box of the active selection, images and textures are the size of that box and the result is blended by the selection. Declare uniform ivec2 region_offset; to get the position of the box.
+   > F16 intermediates stores texture units of 32 bit float layers as 16 bit floats on the GPU, and shows the memory and time saved.
+   > Before a run, the GPU memory needed is estimated and checked against the VRAM budget, or the free video memory if the driver reports it and the budget is 0.
+   > Reuse results of identical runs keeps results in memory and on disk (256 MiB and 1 GiB by default, set mgl_cache_memory and mgl_cache_disk in MiB in krita-scripterrc), and writes them straight to the layers when the shader, settings, mapping, and layer content match an earlier run.
+   > The shader is compiled a moment after you stop typing. Errors appear below with their lines marked in red, and the compiled program is kept, so Run only has the layers left to upload, process, and write back.
+   > Only run on tiles with content dispatches the shader indirectly over the tiles where inputs are not transparent, with an optional halo, or over every tile when the shader reads no layers. Use tile_pixel() for the pixel position and tile_origin() for the tile, both in the processed region.
+   > Batch over layers runs the shader once for each selected layer, each layer whose name matches a pattern with * and ? wildcards, or each layer of a type such as paintlayer, with that layer in place of the active layer in the mapping. The shader is compiled once for the batch.
+   > Write back progressively writes the outputs in tiles from the centre of the view outward and refreshes the canvas as it goes, the write back can be cancelled and keeps the tiles already written.
+   > Crop new layers to their content only reads back and writes the bounding box of the pixels that are not transparent in outputs going to new layers.
+   > Only write back changed tiles compares the outputs with the layers on the GPU and only writes the 64x64 tiles that changed, keeping undo steps small for local effects.
+   > Storage buffers can be configured as inputs and outputs for buffer blocks declared with layout(std430, binding = N) buffer.
    > Fix RGBA color channel order option will try to ensure colors are in the correct channels, else red and blue could be swapped.
    > There is no syntax highlighting, it is advisable you use some other editor to make the shaders.
    > Shader files can be saved and loaded using Save and Open.""")
@@ -327,12 +685,20 @@ If you notice issues with the order of red and blue color channels, try toggling
             with open(file[0], 'w') as cf:
                 cf.write(self.compBox.toPlainText())
 
+    def releasePrograms(self):
+        # Programs kept by the compile helper belong to this dialog, a new one is made each time the tool is opened
+        if self.ext.ctx:
+            with self.ext.ctx:
+                self.compileHelper.cleanUp()
+
     def saveAndReject(self):
         self.saveSettings()
+        self.releasePrograms()
         self.reject()
 
     def closeEvent(self, event):
         self.saveSettings()
+        self.releasePrograms()
         event.accept()
 
     def saveSettings(self):
@@ -346,6 +712,17 @@ If you notice issues with the order of red and blue color channels, try toggling
         self.ext.settings.setValue("mgl_comp_wgy", self.compWGY.text())
         self.ext.settings.setValue("mgl_comp_wgz", self.compWGZ.text())
         self.ext.settings.setValue("mgl_comp_rgba_fix", self.rgbaCorrectCheck.isChecked())
+        self.ext.settings.setValue("mgl_comp_selection", self.selectionCheck.isChecked())
+        self.ext.settings.setValue("mgl_comp_cache", self.cacheCheck.isChecked())
+        self.ext.settings.setValue("mgl_comp_tile_diff", self.tileDiffCheck.isChecked())
+        self.ext.settings.setValue("mgl_comp_crop_new", self.cropCheck.isChecked())
+        self.ext.settings.setValue("mgl_comp_progressive", self.progressiveCheck.isChecked())
+        self.ext.settings.setValue("mgl_comp_batch_mode", self.batchCombo.currentData())
+        self.ext.settings.setValue("mgl_comp_batch_pattern", self.batchEdit.text())
+        self.ext.settings.setValue("mgl_comp_sparse", self.sparseCheck.isChecked())
+        self.ext.settings.setValue("mgl_comp_sparse_halo", self.haloEdit.text())
+        self.ext.settings.setValue("mgl_comp_half_float", self.halfFloatCheck.isChecked())
+        self.ext.settings.setValue("mgl_vram_budget", self.budgetEdit.text())
         if self.compBox.toPlainText() != "":
             self.ext.settings.setValue("mgl_comp_shader", self.compBox.toPlainText())
         self.ext.settings.sync()
@@ -357,4 +734,15 @@ If you notice issues with the order of red and blue color channels, try toggling
         self.compWGY.setText(self.ext.settings.value("mgl_comp_wgy", "1"))
         self.compWGZ.setText(self.ext.settings.value("mgl_comp_wgz", "1"))
         self.rgbaCorrectCheck.setChecked(self.ext.settings.value("mgl_comp_rgba_fix", "true") == "true")
+        self.selectionCheck.setChecked(self.ext.settings.value("mgl_comp_selection", "false") == "true")
+        self.cacheCheck.setChecked(self.ext.settings.value("mgl_comp_cache", "false") == "true")
+        self.tileDiffCheck.setChecked(self.ext.settings.value("mgl_comp_tile_diff", "false") == "true")
+        self.cropCheck.setChecked(self.ext.settings.value("mgl_comp_crop_new", "false") == "true")
+        self.progressiveCheck.setChecked(self.ext.settings.value("mgl_comp_progressive", "false") == "true")
+        self.batchCombo.setCurrentIndex(max(0, self.batchCombo.findData(self.ext.settings.value("mgl_comp_batch_mode", ""))))
+        self.batchEdit.setText(self.ext.settings.value("mgl_comp_batch_pattern", ""))
+        self.sparseCheck.setChecked(self.ext.settings.value("mgl_comp_sparse", "false") == "true")
+        self.haloEdit.setText(self.ext.settings.value("mgl_comp_sparse_halo", "0"))
+        self.halfFloatCheck.setChecked(self.ext.settings.value("mgl_comp_half_float", "false") == "true")
+        self.budgetEdit.setText(self.ext.settings.value("mgl_vram_budget", "0"))
         self.compBox.setPlainText(self.ext.settings.value("mgl_comp_shader", ""))
\ No newline at end of file
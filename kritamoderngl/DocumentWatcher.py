@@ -0,0 +1,84 @@
+from krita import *
+from PyQt5.QtCore import Qt, QObject, pyqtSignal
+from PyQt5.QtWidgets import QDockWidget, QTreeView
+
+# Counts changes to the active document and its layer tree so results derived from it can be cached
+# Krita's scripting API has no signals for the layer tree, so this listens to the model behind the Layers docker
+class DocumentWatcher(QObject):
+    documentChanged = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super(DocumentWatcher, self).__init__(parent)
+        self.revision = 0
+        self.layerModel = None
+        # Name shown in the Layers docker for each row seen in a data change, by the model's internal id of the row
+        self.names = {}
+        notifier = Krita.instance().notifier()
+        notifier.imageCreated.connect(self.markChanged)
+        notifier.imageClosed.connect(self.markChanged)
+        notifier.viewCreated.connect(self.markChanged)
+        notifier.viewClosed.connect(self.markChanged)
+        window = Krita.instance().activeWindow()
+        if window:
+            window.activeViewChanged.connect(self.viewChanged)
+            self.attachLayerModel(window)
+
+    def attachLayerModel(self, window):
+        # Find the layer tree model used by the Layers docker, it is updated for every node change in the active document
+        docker = window.qwindow().findChild(QDockWidget, "KisLayerBox")
+        view = docker.findChild(QTreeView) if docker else None
+        model = view.model() if view else None
+        if not model:
+            return
+        self.layerModel = model
+        model.destroyed.connect(self.detachLayerModel)
+        model.rowsInserted.connect(self.markChanged)
+        model.rowsRemoved.connect(self.markChanged)
+        model.rowsMoved.connect(self.markChanged)
+        model.modelReset.connect(self.markChanged)
+        model.layoutChanged.connect(self.markChanged)
+        # Renames only show up as data changes, which also fire for every thumbnail and property update while painting
+        model.dataChanged.connect(self.dataChanged)
+
+    def detachLayerModel(self, *args):
+        self.layerModel = None
+        self.names = {}
+
+    def dataChanged(self, topLeft, bottomRight, roles=None):
+        # Only count data changes that rename a layer, layer conversions replace the node and move rows instead
+        if roles and Qt.DisplayRole not in roles and Qt.EditRole not in roles:
+            return
+        renamed = False
+        for row in range(topLeft.row(), bottomRight.row() + 1):
+            index = topLeft.sibling(row, 0)
+            name = index.data(Qt.DisplayRole)
+            if self.names.get(index.internalId()) != name:
+                self.names[index.internalId()] = name
+                renamed = True
+        if renamed:
+            self.markChanged()
+
+    def viewChanged(self, *args):
+        # The Layers docker may not have existed when this was created, try again
+        if not self.layerModel:
+            window = Krita.instance().activeWindow()
+            if window:
+                self.attachLayerModel(window)
+        self.markChanged()
+
+    def isTracking(self):
+        # Without the layer model, changes to the layer tree cannot be seen and nothing should be cached on this
+        return self.layerModel is not None
+
+    def markChanged(self, *args):
+        self.revision += 1
+        self.documentChanged.emit()
+
+# Watcher shared by all dialogs and layer indexes, created on first use
+sharedWatcher = None
+
+def getSharedWatcher():
+    global sharedWatcher
+    if sharedWatcher is None:
+        sharedWatcher = DocumentWatcher(Krita.instance())
+    return sharedWatcher
@@ -0,0 +1,190 @@
+from krita import *
+import copy
+from . import RgbaCorrectionHelper, LayerIndex, DocumentWatcher
+
+# Working formats a mapping item can choose, as (value, name), an empty value works in the layer's own format
+workingFormats = [("", "Layer Format"), ("F16", "F16"), ("F32", "F32")]
+# Texture data types for each working format
+workingTypes = {"F16": "f2", "F32": "f4"}
+
+# Helper function to get the number of components and data type from a node (or document)
+def getColorComponentsAndType(node):
+    colorModel = node.colorModel()
+    # Number of components is the number of capitals in the color model, unless GRAYA
+    if colorModel == "GRAYA":
+        components = 2
+    else:
+        components = sum(1 for c in colorModel if c.isupper())
+    colorDepth = node.colorDepth()
+    colorDepth = colorDepth[0].lower() + str(int(colorDepth[1:]) // 8)
+    return components, colorDepth
+
+# A mapping item with its layer resolved, holding everything needed to upload, bind, correct, and write it back
+class PlanItem():
+    def __init__(self, item, node, isNewLayer, formatSource):
+        self.item = item
+        self.index = item.index
+        self.node = node
+        self.isNewLayer = isNewLayer
+        # Set when the item was mapped to the active layer, batch runs put each of their layers there instead
+        self.isActiveLayer = False
+        self.nodeType = node.type() if node else ""
+        # New layers take their format from the document
+        self.colorModel = formatSource.colorModel()
+        self.colorDepth = formatSource.colorDepth()
+        self.components, self.colorType = getColorComponentsAndType(formatSource)
+        self.needsCorrection = bool(RgbaCorrectionHelper.nodeNeedsCorrection(formatSource))
+        # Data type the shader works with when it differs from the layer, converted on the GPU, else None
+        workingType = workingTypes.get(getattr(item, "workingFormat", ""))
+        self.workingType = workingType if workingType != self.colorType else None
+        self.dither = getattr(item, "dither", False)
+        # Layers packed into a texture array in place of node, in the order of the Layers docker, empty if not an array
+        self.arrayNodes = []
+        # Set when the slices of an array are swapped to RGBA while they are packed
+        self.swapChannels = False
+
+    def getWorkingType(self, halfFloat=False):
+        # Data type of the texture the shader uses, None when it is the layer's own
+        # F16 intermediates only apply to 32 bit float layers without a working format of their own
+        if halfFloat and not self.workingType and self.colorType == "f4" and not self.arrayNodes:
+            return "f2"
+        return self.workingType
+
+    def isCurrent(self, rootId):
+        # Cheap check that the resolved node is still in the document with the same format
+        if self.isNewLayer:
+            return True
+        return all(LayerIndex.nodeIsAttached(node, rootId)
+                   and node.colorModel() == self.colorModel
+                   and node.colorDepth() == self.colorDepth for node in (self.arrayNodes if self.arrayNodes else [self.node]))
+
+# The layer mapping compiled against a document, cached by the mapper dialogs until the mapping or document changes
+class ExecutionPlan():
+    def __init__(self, doc):
+        self.rootId = doc.rootNode().uniqueId()
+        self.width = doc.width()
+        self.height = doc.height()
+        self.colorModel = doc.colorModel()
+        self.colorDepth = doc.colorDepth()
+        activeNode = doc.activeNode()
+        self.activeId = activeNode.uniqueId() if activeNode else None
+        self.items = []
+        # Resolved mapping the mapper dialogs fill in, compute uses images, textures, and storageBuffers
+        # render uses inputs, outputs, vertexBuffers, and vertexLayers
+        self.images = []
+        self.textures = []
+        self.storageBuffers = []
+        self.inputs = []
+        self.outputs = []
+        self.vertexBuffers = []
+        self.vertexLayers = {}
+        # Layer arrays pick their layers by name, so plans with arrays are only current for this revision of the layers
+        watcher = DocumentWatcher.getSharedWatcher()
+        self.revision = watcher.revision if watcher.isTracking() else None
+        # Pixel data fetched during a run, so a layer mapped more than once or fingerprinted first is only fetched once
+        self.pixelData = {}
+        # Layer used as the active layer by batch runs, None uses the document's
+        self.batchNode = None
+
+    def resolve(self, doc, items, label, activeId="<>", newId=None):
+        # Resolve a list of TextureMapItems, raises an exception with description if a layer cannot be found
+        planItems = []
+        layerIndex = LayerIndex.forDocument(doc)
+        for item in items:
+            if getattr(item, "arrayLayers", ""):
+                planItem = self.resolveArray(doc, layerIndex, item, label)
+            elif newId is not None and item.layerId == newId:
+                planItem = PlanItem(item, None, True, doc)
+            else:
+                if item.layerId == activeId:
+                    node = doc.activeNode()
+                else:
+                    node = layerIndex.node(doc, item.layerId)
+                if not node:
+                    raise Exception(f"Invalid Configuration\n{label} at index {item.index}\nTarget Layer does not exist in the document.")
+                planItem = PlanItem(item, node, False, node)
+                planItem.isActiveLayer = item.layerId == activeId
+            planItems.append(planItem)
+        self.items += planItems
+        return planItems
+
+    def resolveArray(self, doc, layerIndex, item, label):
+        # Resolve the layers of a layer array by their names, they must all have the same format
+        # The index may be missing layers added or renamed since it was built
+        layerIndex.refreshIfNeeded(doc)
+        nodes = layerIndex.nodesNamed(item.arrayLayers)
+        if not nodes:
+            raise Exception(f"Invalid Configuration\n{label} at index {item.index}\nNo layers match the Layer Array pattern {item.arrayLayers}.")
+        for node in nodes:
+            if node.colorModel() != nodes[0].colorModel() or node.colorDepth() != nodes[0].colorDepth():
+                raise Exception(f"Invalid Configuration\n{label} at index {item.index}\nLayer {node.name()} has a different format than {nodes[0].name()}, all layers of an array need the same format.")
+        planItem = PlanItem(item, nodes[0], False, nodes[0])
+        planItem.arrayNodes = nodes
+        # The correction passes and format conversions work on single textures, arrays are swapped while they are packed
+        planItem.swapChannels = planItem.needsCorrection
+        planItem.needsCorrection = False
+        planItem.workingType = None
+        return planItem
+
+    def fetchPixelData(self, planItem, x, y, width, height):
+        # Get a layer's pixels for a region, fetched from Krita the first time they are needed in a run
+        # Layer arrays get the pixels of every layer as consecutive slices
+        if planItem.arrayNodes:
+            return b"".join(self.fetchNodePixelData(node, x, y, width, height) for node in planItem.arrayNodes)
+        return self.fetchNodePixelData(planItem.node, x, y, width, height)
+
+    def fetchNodePixelData(self, node, x, y, width, height):
+        key = (node.uniqueId().toString(), x, y, width, height)
+        if key not in self.pixelData:
+            self.pixelData[key] = node.projectionPixelData(x, y, width, height)
+        return self.pixelData[key]
+
+    def forActiveNode(self, node):
+        # Copy of the plan with the items mapped to the active layer resolved to another node, for batch runs
+        plan = copy.copy(self)
+        replaced = {}
+        for planItem in self.items:
+            if planItem.isActiveLayer:
+                replaced[id(planItem)] = PlanItem(planItem.item, node, False, node)
+                replaced[id(planItem)].isActiveLayer = True
+        plan.items = [replaced.get(id(planItem), planItem) for planItem in self.items]
+        plan.images = [replaced.get(id(planItem), planItem) for planItem in self.images]
+        plan.textures = [replaced.get(id(planItem), planItem) for planItem in self.textures]
+        plan.inputs = [replaced.get(id(planItem), planItem) for planItem in self.inputs]
+        plan.outputs = [replaced.get(id(planItem), planItem) for planItem in self.outputs]
+        plan.vertexLayers = {index: replaced.get(id(planItem), planItem) for index, planItem in self.vertexLayers.items()}
+        # Storage and vertex buffer mappings do not refer to layers, the lists are shared
+        plan.pixelData = {}
+        plan.batchNode = node
+        return plan
+
+    def getActiveNode(self, doc):
+        # The layer new layers are added above, the batch layer for batch runs
+        return self.batchNode if self.batchNode else doc.activeNode()
+
+    def prefetchActive(self, x, y, width, height):
+        # Fetch the pixels of the layer used as the active layer ahead of the run, while the GPU works on another
+        for planItem in self.items:
+            if planItem.isActiveLayer:
+                self.fetchPixelData(planItem, x, y, width, height)
+
+    def clearPixelData(self):
+        # Forget the fetched pixels, called before and after each run so layers edited in between are fetched again
+        self.pixelData = {}
+
+    def isCurrent(self, doc):
+        # Check if this plan can still be used for the document without resolving everything again
+        if not doc or doc.rootNode().uniqueId() != self.rootId:
+            return False
+        if doc.width() != self.width or doc.height() != self.height:
+            return False
+        if doc.colorModel() != self.colorModel or doc.colorDepth() != self.colorDepth:
+            return False
+        activeNode = doc.activeNode()
+        if (activeNode.uniqueId() if activeNode else None) != self.activeId:
+            return False
+        # Layers added, removed, or renamed may change which layers an array matches
+        if any(planItem.arrayNodes for planItem in self.items):
+            if self.revision is None or self.revision != DocumentWatcher.getSharedWatcher().revision:
+                return False
+        return all(planItem.isCurrent(self.rootId) for planItem in self.items)
@@ -0,0 +1,153 @@
+"""
+Class to help converting between a layer's format and the working format a mapping item asked for
+
+Layers are always uploaded and read back in their own format, so only the layer's bytes cross the bus. Everything
+in between happens on the GPU with a small render pass per texture: integer layers are normalized into the float
+working texture on the way in, and on the way out the working texture is clamped, optionally dithered, and rounded
+into a texture in the layer's format that is then read back.
+
+Because these passes touch every channel anyway, they also put the channels of 8 and 16 bit RGBA layers in the right
+order, so items with a working format do not go through the RGBA correction pass.
+"""
+from . import RgbaCorrectionHelper
+
+# Shader to move a layer's data into a float working texture
+inputShader = """#version 330 core
+
+uniform {prefix}sampler2D source;
+uniform float scale;
+out vec4 out_color;
+
+void main() {{
+    vec4 color = vec4(texelFetch(source, ivec2(gl_FragCoord.xy), 0)) * scale;
+    out_color = color{swizzle};
+}}"""
+
+# Shader to move a float working texture into the layer's format
+# Integer layers are clamped, the 4x4 ordered dither spreads rounding error when asked for
+outputShader = """#version 330 core
+
+uniform sampler2D source;
+uniform float maxValue;
+uniform bool dither;
+out {prefix}vec4 out_color;
+
+const float bayer[16] = float[](
+    0.0, 8.0, 2.0, 10.0,
+    12.0, 4.0, 14.0, 6.0,
+    3.0, 11.0, 1.0, 9.0,
+    15.0, 7.0, 13.0, 5.0
+);
+
+void main() {{
+    ivec2 pos = ivec2(gl_FragCoord.xy);
+    vec4 color = texelFetch(source, pos, 0){swizzle};
+{convert}
+}}"""
+
+floatConvert = "    out_color = color;"
+
+uintConvert = """    float offset = dither ? (bayer[(pos.y % 4) * 4 + pos.x % 4] + 0.5) / 16.0 - 0.5 : 0.0;
+    out_color = uvec4(clamp(floor(clamp(color, 0.0, 1.0) * maxValue + 0.5 + offset), 0.0, maxValue));"""
+
+# Shader to clear integer textures, glClear is undefined for integer color buffers
+uintClearShader = """#version 330 core
+
+out uvec4 out_color;
+
+void main() {
+    out_color = uvec4(0u);
+}"""
+
+# Largest value of each integer data type, used to normalize
+maxValues = {"u1": 255.0, "u2": 65535.0}
+
+class FormatConversionHelper:
+    textures = []
+    frameBuffers = []
+    programs = {}
+    vaos = {}
+
+    def __init__(self):
+        self.textures = []
+        self.frameBuffers = []
+        self.programs = {}
+        self.vaos = {}
+
+    # Get a program for the shader source, each distinct conversion is only compiled once per run
+    def getProgram(self, ctx, source):
+        if source not in self.programs:
+            self.programs[source] = ctx.program(vertex_shader=RgbaCorrectionHelper.vertexShader, fragment_shader=source)
+            vao = ctx.vertex_array(self.programs[source], [])
+            vao.vertices = 6
+            vao.mode = ctx.TRIANGLES
+            self.vaos[source] = vao
+        return self.programs[source]
+
+    # Render the texture into the target texture with the program compiled from the shader source
+    def render(self, ctx, shaderSource, texture, target):
+        texture.use(location=0)
+        self.programs[shaderSource]["source"] = 0
+        frameBuffer = ctx.framebuffer([target])
+        self.frameBuffers.append(frameBuffer)
+        frameBuffer.use()
+        self.vaos[shaderSource].render()
+
+    # Upload layer data in its own format and convert it to a new working texture, which belongs to the caller
+    # Data may be None for new layers, the working texture is then left empty
+    # The working type defaults to the one chosen in the mapping
+    def convertInput(self, ctx, planItem, size, data, swap, workingType=None):
+        working = ctx.texture(size, planItem.components, dtype=workingType if workingType else planItem.workingType)
+        if data is None:
+            return working
+        native = ctx.texture(size, planItem.components, data=data, dtype=planItem.colorType)
+        prefix = "u" if planItem.colorType in maxValues else ""
+        shaderSource = inputShader.format(prefix=prefix, swizzle=".bgra" if swap else "")
+        program = self.getProgram(ctx, shaderSource)
+        program["scale"] = 1.0 / maxValues.get(planItem.colorType, 1.0)
+        self.render(ctx, shaderSource, native, working)
+        # The upload is not needed after the conversion, release it now to keep peak memory down
+        native.release()
+        return working
+
+    # Clear a texture that was created without data on the GPU, so it starts transparent without uploading anything
+    def clearTexture(self, ctx, texture):
+        frameBuffer = ctx.framebuffer([texture])
+        self.frameBuffers.append(frameBuffer)
+        frameBuffer.use()
+        if texture.dtype in maxValues:
+            self.getProgram(ctx, uintClearShader)
+            self.vaos[uintClearShader].render()
+        else:
+            frameBuffer.clear()
+
+    # Convert a working texture to a new texture in the layer's format, ready to read back
+    def convertOutput(self, ctx, planItem, working, swap):
+        target = ctx.texture(working.size, planItem.components, dtype=planItem.colorType)
+        self.textures.append(target)
+        isUint = planItem.colorType in maxValues
+        shaderSource = outputShader.format(
+            prefix="u" if isUint else "",
+            swizzle=".bgra" if swap else "",
+            convert=uintConvert if isUint else floatConvert)
+        program = self.getProgram(ctx, shaderSource)
+        if isUint:
+            program["maxValue"] = maxValues[planItem.colorType]
+            program["dither"] = planItem.dither
+        self.render(ctx, shaderSource, working, target)
+        return target
+
+    # Clean up all OGL objects created, the working textures from convertInput belong to the parent
+    def cleanUp(self):
+        for texture in self.textures:
+            texture.release()
+        for frameBuffer in self.frameBuffers:
+            frameBuffer.release()
+        for vao in self.vaos.values():
+            vao.release()
+        for program in self.programs.values():
+            program.release()
+        self.textures = []
+        self.frameBuffers = []
+        self.programs = {}
+        self.vaos = {}
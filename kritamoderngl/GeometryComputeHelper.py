@@ -0,0 +1,92 @@
+"""
+Class to help generating geometry on the GPU with a compute shader before a render pass draws it
+
+The compute shader writes vertices into a storage buffer and fills in an indirect draw command, then the vertex and
+fragment shaders draw from that buffer with glDrawArraysIndirect. The vertices and the number of them never leave the
+GPU, only the frame buffer is read back to the layers, so geometry can follow image content (outlines, point clouds
+from luminance, line fields from gradients) without a round trip through Python.
+
+The vertex buffer is bound to storage binding 0 and the command to binding 1, as
+    layout(std430, binding = 1) buffer Command { uint count; uint instanceCount; uint first; uint baseInstance; };
+The command starts as 0 vertices and 1 instance, so shaders usually reserve vertices with atomicAdd(count, n). The
+vertex buffer uses std430 rules, so a vec3 in it takes the space of a vec4 and the layout needs padding to match.
+"""
+import struct
+from . import StorageBufferHelper, VertexBufferHelper
+
+# Storage bindings of the generated buffers
+vertexBinding = 0
+commandBinding = 1
+
+# Initial DrawArraysIndirectCommand: count, instanceCount, first, baseInstance
+initialCommand = struct.pack("<4I", 0, 1, 0, 0)
+
+class GeometryComputeHelper:
+    vertexBuffer = None
+    commandBuffer = None
+    notes = []
+
+    def __init__(self):
+        self.vertexBuffer = None
+        self.commandBuffer = None
+        self.notes = []
+
+    # Check the settings can be used, returns the number of work groups and vertex buffer bytes for the region
+    # Raises an exception with description if not
+    def validate(self, groupsX, groupsY, vertexSize, layout, attributes, width, height):
+        names = {"width": width, "height": height}
+        try:
+            groups = (StorageBufferHelper.evaluateSize(groupsX, names), StorageBufferHelper.evaluateSize(groupsY, names))
+            size = StorageBufferHelper.evaluateSize(vertexSize, names)
+            parsed = VertexBufferHelper.parseLayout(layout)
+        except Exception as e:
+            raise Exception(f"Invalid geometry settings\n{e.args[0]}")
+        if groups[0] <= 0 or groups[1] <= 0:
+            raise Exception("Invalid geometry settings\nThe number of work groups must be larger than 0.")
+        if size <= 0:
+            raise Exception("Invalid geometry settings\nThe vertex buffer size must be larger than 0.")
+        attributeCount = sum(1 for count, typeName, size in parsed if typeName)
+        if len(attributes.split()) != attributeCount:
+            raise Exception(f"Invalid geometry settings\nAttribute Names needs one name for each of the {attributeCount} attributes in the layout.")
+        return groups, size
+
+    # Bind the sampled inputs to the compiled compute shader and run it to fill the vertex and command buffers
+    # The shader belongs to the dialog's compile cache and is not released here
+    # inputs are (TextureMapItem, texture) pairs that are already bound to their texture units
+    def generate(self, ctx, shader, groups, size, inputs, regionOffset):
+        for item, texture in inputs:
+            if item.variableName and shader.get(item.variableName, None) is not None:
+                shader[item.variableName] = item.index
+        offset = shader.get("region_offset", None)
+        if offset is not None:
+            offset.value = regionOffset
+        self.vertexBuffer = ctx.buffer(reserve=size)
+        self.vertexBuffer.clear()
+        self.commandBuffer = ctx.buffer(initialCommand)
+        self.vertexBuffer.bind_to_storage_buffer(binding=vertexBinding)
+        self.commandBuffer.bind_to_storage_buffer(binding=commandBinding)
+        shader.run(groups[0], groups[1], 1)
+        # The writes must be visible to the vertex fetch and the indirect command read
+        ctx.memory_barrier()
+
+    # Get the content for ctx.vertex_array that draws from the generated vertices, None if the shader uses none of them
+    def getContent(self, program, layout, attributes):
+        usedLayout, usedNames, skippedNames = VertexBufferHelper.matchAttributes(program, layout, attributes)
+        for name in skippedNames:
+            self.notes.append(f"Generated geometry: attribute {name} is not used by the vertex shader and was skipped.")
+        if not usedNames:
+            return None
+        return (self.vertexBuffer, usedLayout, *usedNames)
+
+    # Draw the vertex array with the command the compute shader wrote
+    def render(self, vao):
+        vao.render_indirect(self.commandBuffer, count=1)
+
+    # Clean up all OGL objects created
+    def cleanUp(self):
+        for obj in [self.vertexBuffer, self.commandBuffer]:
+            if obj:
+                obj.release()
+        self.vertexBuffer = None
+        self.commandBuffer = None
+        self.notes = []
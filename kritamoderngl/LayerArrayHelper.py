@@ -0,0 +1,20 @@
+"""
+Functions to help binding many layers at once as a texture array
+
+A mapping row with a Layer Array pattern packs every layer whose name matches it into one texture array, a slice per
+layer in the order of the Layers docker, top first. Shaders read it as a sampler2DArray on a texture unit or an
+image2DArray on an image unit, so stacks of layers or animation frames take one binding instead of one per layer, and
+a compute shader can run a workgroup per slice along z with imageSize(image).z slices.
+
+Arrays are read only and keep the format of their layers. The RGBA correction passes work on single textures, so the
+slices of BGRA layers are swapped on the CPU while they are packed instead.
+"""
+from . import RgbaCorrectionHelper
+
+# Create a texture array holding the region of every layer of an array plan item
+def createTextureArray(ctx, plan, planItem, region, rgbaFix):
+    x, y, width, height = region
+    data = plan.fetchPixelData(planItem, x, y, width, height)
+    if rgbaFix and planItem.swapChannels:
+        data = RgbaCorrectionHelper.swapRedBlue(data, planItem.colorType)
+    return ctx.texture_array((width, height, len(planItem.arrayNodes)), planItem.components, data=data, dtype=planItem.colorType)
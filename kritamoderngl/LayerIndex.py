@@ -0,0 +1,85 @@
+from krita import *
+import fnmatch
+from PyQt5.QtCore import QUuid
+from . import DocumentWatcher
+
+# Helper function to check if a node is still in the document, removed nodes (or their removed ancestors) lose their parent
+def nodeIsAttached(node, rootId):
+    parent = node.parentNode()
+    while parent:
+        node = parent
+        parent = node.parentNode()
+    return node.uniqueId() == rootId
+
+# Every layer of a document in the order shown in the Layers docker, with constant time lookups by uuid
+class LayerIndex():
+    def __init__(self, doc):
+        self.rootId = doc.rootNode().uniqueId()
+        self.names = []
+        self.uuids = []
+        self.rows = {}
+        self.nodes = {}
+        self.revision = None
+        self.refresh(doc)
+
+    def refresh(self, doc):
+        # Rebuild from the document's node tree in a single pass, top of the stack first
+        watcher = DocumentWatcher.getSharedWatcher()
+        names = []
+        uuids = []
+        nodes = {}
+        # Children are listed bottom to top, so walk them reversed with an explicit stack
+        stack = [(node, "") for node in doc.topLevelNodes()]
+        while stack:
+            node, prefix = stack.pop()
+            uuid = node.uniqueId().toString()
+            names.append(prefix + node.name())
+            uuids.append(uuid)
+            nodes[uuid] = node
+            stack += [(child, prefix + "  ") for child in node.childNodes()]
+        self.names = names
+        self.uuids = uuids
+        self.rows = {uuid: row for row, uuid in enumerate(uuids)}
+        self.nodes = nodes
+        self.revision = watcher.revision if watcher.isTracking() else None
+
+    def isCurrent(self):
+        # Only known to be current while the document watcher is tracking the layer tree
+        return self.revision is not None and self.revision == DocumentWatcher.getSharedWatcher().revision
+
+    def refreshIfNeeded(self, doc):
+        if not self.isCurrent():
+            self.refresh(doc)
+
+    def node(self, doc, uuid):
+        # Get the node for a uuid, falling back to Krita's lookup if it is not in the index
+        # If the index may be out of date, a cheap walk up the tree checks the node was not removed since
+        # Mappings saved by older versions may have the indentation in front of the uuid
+        uuid = uuid.strip()
+        node = self.nodes.get(uuid)
+        if node and (self.isCurrent() or nodeIsAttached(node, self.rootId)):
+            return node
+        return doc.nodeByUniqueID(QUuid(uuid))
+
+    def nodesNamed(self, pattern):
+        # Nodes whose name matches a pattern with * and ? wildcards, top of the stack first
+        return [self.nodes[uuid] for uuid in self.uuids if fnmatch.fnmatchcase(self.nodes[uuid].name(), pattern)]
+
+# Indexes for each open document by root node uuid, shared by both mapper dialogs
+indexes = {}
+notifierConnected = False
+
+def clearIndexes(*args):
+    # Nodes held by the indexes would keep closed documents' layers alive
+    indexes.clear()
+
+def forDocument(doc):
+    # Get the index for a document, building it the first time it is needed
+    global notifierConnected
+    if not notifierConnected:
+        Krita.instance().notifier().imageClosed.connect(clearIndexes)
+        notifierConnected = True
+    key = doc.rootNode().uniqueId().toString()
+    if key not in indexes:
+        indexes[key] = LayerIndex(doc)
+    return indexes[key]
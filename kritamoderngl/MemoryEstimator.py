@@ -0,0 +1,166 @@
+"""
+Functions to estimate the GPU memory a run needs from its execution plan, before anything is allocated
+
+The estimate counts every texture the dialogs and helpers create: the texture for each mapped unit in the format the
+shader uses, uploads and read back textures for format conversion, RGBA correction targets, the selection mask with
+the textures used to blend with it, and storage buffers. Frame buffers only reference their textures, so they add
+nothing. Drivers pad and align allocations, so real use can be somewhat higher.
+
+Before a run the estimate is compared with a budget, either set by the user or the free video memory reported by the
+driver through GL_NVX_gpu_memory_info or GL_ATI_meminfo. ModernGL has no call for these queries, so glGetIntegerv is
+loaded from the system's OpenGL library and called while the context is current.
+"""
+import ctypes
+import os
+import platform
+from . import StorageBufferHelper
+
+# Query enums for the free video memory extensions, both report KiB
+GPU_MEMORY_INFO_CURRENT_AVAILABLE_VIDMEM_NVX = 0x9049
+TEXTURE_FREE_MEMORY_ATI = 0x87FC
+
+bytesPerComponent = {"u1": 1, "u2": 2, "f2": 2, "f4": 4}
+
+def textureBytes(width, height, components, dtype):
+    return width * height * components * bytesPerComponent[dtype]
+
+# Memory for one mapped item, storedType is the type the shader uses
+def itemBytes(planItem, width, height, storedType, isOutput, corrected, blended):
+    # Layer arrays hold a slice for each of their layers
+    total = textureBytes(width, height, planItem.components, storedType) * max(1, len(planItem.arrayNodes))
+    if storedType != planItem.colorType and isOutput:
+        # Outputs are converted back to the layer's format before reading, the input upload is released right away
+        total += textureBytes(width, height, planItem.components, planItem.colorType)
+    if corrected:
+        total += textureBytes(width, height, 4, planItem.colorType)
+    if blended:
+        # The original pixels and the blended result
+        total += 2 * textureBytes(width, height, planItem.components, planItem.colorType)
+    return total
+
+# Memory for the selection mask
+def maskBytes(width, height, selection):
+    return width * height if selection else 0
+
+# Memory for the storage buffers of a compute run, files that cannot be read are counted by their size expression
+def storageBytes(items, width, height):
+    total = 0
+    for item in items:
+        size = StorageBufferHelper.evaluateSize(item.size, {"width": width, "height": height}) if item.size else 0
+        if item.sourceFile and os.path.isfile(item.sourceFile):
+            size = max(size, os.path.getsize(item.sourceFile))
+        total += size
+    return total
+
+# Memory for the vertex and instance buffers of a render run, layers give one element per pixel of the region
+# CSV files are counted by their file size, which is usually more than the packed data
+def vertexBytes(items, layerItems, width, height):
+    total = 0
+    for item in items:
+        planItem = layerItems.get(item.index)
+        if planItem:
+            total += textureBytes(width, height, planItem.components, planItem.colorType)
+        elif item.sourceFile and os.path.isfile(item.sourceFile):
+            total += os.path.getsize(item.sourceFile)
+    return total
+
+# Estimate for a compute shader run
+def estimateCompute(plan, width, height, rgbaFix, selection, halfFloat):
+    total = maskBytes(width, height, selection)
+    for planItem in plan.images:
+        item = planItem.item
+        # Images keep their format even with F16 intermediates, the shader declares it in the layout qualifier
+        storedType = planItem.getWorkingType()
+        correctedCount = 0
+        if rgbaFix and planItem.needsCorrection and not planItem.workingType:
+            correctedCount = int(item.read) + int(item.write)
+        total += itemBytes(planItem, width, height, storedType if storedType else planItem.colorType, item.write, False, selection and item.write)
+        total += correctedCount * textureBytes(width, height, 4, planItem.colorType)
+    for planItem in plan.textures:
+        storedType = planItem.getWorkingType(halfFloat)
+        total += itemBytes(planItem, width, height, storedType if storedType else planItem.colorType, False, False, False)
+    total += storageBytes(plan.storageBuffers, width, height)
+    return total
+
+# Estimate for a render shader run
+def estimateRender(plan, width, height, rgbaFix, selection, halfFloat):
+    total = maskBytes(width, height, selection)
+    for planItem in plan.inputs:
+        storedType = planItem.getWorkingType(halfFloat)
+        total += itemBytes(planItem, width, height, storedType if storedType else planItem.colorType, False, False, False)
+    for planItem in plan.outputs:
+        storedType = planItem.getWorkingType(halfFloat)
+        corrected = rgbaFix and planItem.needsCorrection and not storedType
+        total += itemBytes(planItem, width, height, storedType if storedType else planItem.colorType, True, corrected, selection)
+    total += vertexBytes(plan.vertexBuffers, plan.vertexLayers, width, height)
+    return total
+
+# Describe a number of bytes for the dialogs
+def formatBytes(size):
+    return f"{size / (1024 * 1024):.1f} MiB"
+
+# Describe what F16 intermediates saved in a run, fullRunTime is the last run without them if there was one
+def describeHalfFloatSavings(halfBytes, fullBytes, runTime, fullRunTime=None):
+    text = f"F16 intermediates: estimated peak texture memory {formatBytes(halfBytes)} instead of {formatBytes(fullBytes)} ({formatBytes(fullBytes - halfBytes)} saved), run took {runTime * 1000:.0f} ms"
+    if fullRunTime is not None:
+        text += f", the last run without them took {fullRunTime * 1000:.0f} ms"
+    return text
+
+# Load glGetIntegerv from the system's OpenGL library, returns None if it cannot be found
+def loadGetIntegerv():
+    try:
+        system = platform.system().lower()
+        if system == "windows":
+            library = ctypes.WinDLL("opengl32")
+        elif system == "darwin":
+            library = ctypes.CDLL("/System/Library/Frameworks/OpenGL.framework/OpenGL")
+        else:
+            try:
+                library = ctypes.CDLL("libOpenGL.so.0")
+            except OSError:
+                library = ctypes.CDLL("libGL.so.1")
+        getIntegerv = library.glGetIntegerv
+        getIntegerv.argtypes = [ctypes.c_uint, ctypes.POINTER(ctypes.c_int)]
+        getIntegerv.restype = None
+        return getIntegerv
+    except (OSError, AttributeError):
+        return None
+
+# Query the free video memory in bytes with the context current, returns None if the driver does not expose it
+def queryAvailableMemory(ctx):
+    if "GL_NVX_gpu_memory_info" in ctx.extensions:
+        query = GPU_MEMORY_INFO_CURRENT_AVAILABLE_VIDMEM_NVX
+    elif "GL_ATI_meminfo" in ctx.extensions:
+        query = TEXTURE_FREE_MEMORY_ATI
+    else:
+        return None
+    getIntegerv = loadGetIntegerv()
+    if not getIntegerv:
+        return None
+    # The ATI query returns four values, the first is the total free memory in the pool
+    values = (ctypes.c_int * 4)()
+    getIntegerv(query, values)
+    return values[0] * 1024 if values[0] > 0 else None
+
+# Get the budget to check against in bytes and where it came from, or (None, None) if there is nothing to check against
+def getMemoryBudget(ctx, budgetMiB):
+    if budgetMiB > 0:
+        return budgetMiB * 1024 * 1024, "configured VRAM budget"
+    available = queryAvailableMemory(ctx)
+    if available:
+        return available, "free video memory reported by the driver"
+    return None, None
+
+# Check a run fits in the memory budget before anything is allocated
+# estimate is called with whether F16 intermediates are used and returns the bytes needed
+# Returns whether to use F16 intermediates and a message if that was changed, raises an exception if the run cannot fit
+def preflightCheck(ctx, budgetMiB, estimate, halfFloat):
+    budget, source = getMemoryBudget(ctx, budgetMiB)
+    if budget is None:
+        return halfFloat, None
+    required = estimate(halfFloat)
+    if required <= budget:
+        return halfFloat, None
+    if not halfFloat and estimate(True) <= budget:
+        return True, f"This run needs an estimated {formatBytes(required)} of GPU memory, more than the {source} of {formatBytes(budget)}.\nF16 intermediates were used for this run instead, needing {formatBytes(estimate(True))}."
+    raise Exception(f"This run needs an estimated {formatBytes(required)} of GPU memory, more than the {source} of {formatBytes(budget)}.\nTry Limit to selection with a smaller selection, F16 intermediates, fewer mapped layers, or a larger VRAM budget.")
@@ -0,0 +1,114 @@
+"""
+Class to help writing results back to layers tile by tile, starting where the user is looking
+
+Reading back and writing a large output in one go leaves the dialog frozen until all of it is done. In progressive
+mode each result is copied on the GPU when the run finishes, so the run can be cleaned up as usual, and the copies are
+read back and written in tiles ordered by their distance from the centre of the view. The projection is refreshed and
+events are processed a few times a second, so the first tiles show up on the canvas right away and the progress
+dialog can cancel the rest. Tiles written before cancelling are kept.
+
+Krita's scripting API can only refresh the whole projection, so refreshes are bounded in time instead of area.
+"""
+import time
+from krita import *
+from PyQt5.QtCore import Qt, QPointF
+from PyQt5.QtWidgets import QApplication, QMdiArea, QProgressDialog
+
+# Width and height of the tiles written at a time, in pixels
+tileSize = 256
+
+# Seconds between refreshes of the projection while writing
+refreshInterval = 0.2
+
+# Get the document position at the centre of the active view, the centre of the document if it cannot be found
+def getViewCenter(doc):
+    try:
+        window = Krita.instance().activeWindow()
+        view = window.activeView()
+        widget = window.qwindow().findChild(QMdiArea).activeSubWindow().widget()
+        flakeCenter = view.flakeToCanvasTransform().inverted()[0].map(QPointF(widget.width() / 2, widget.height() / 2))
+        imageCenter = view.flakeToImageTransform().map(flakeCenter)
+        return imageCenter.x(), imageCenter.y()
+    except Exception:
+        return doc.width() / 2, doc.height() / 2
+
+# Split spans of a result into pieces on the tile grid, as (x, y, width, height)
+def splitSpans(spans):
+    pieces = []
+    for spanX, spanY, spanWidth, spanHeight in spans:
+        for tileY in range(spanY // tileSize, (spanY + spanHeight - 1) // tileSize + 1):
+            for tileX in range(spanX // tileSize, (spanX + spanWidth - 1) // tileSize + 1):
+                left = max(spanX, tileX * tileSize)
+                top = max(spanY, tileY * tileSize)
+                right = min(spanX + spanWidth, (tileX + 1) * tileSize)
+                bottom = min(spanY + spanHeight, (tileY + 1) * tileSize)
+                pieces.append((left, top, right - left, bottom - top))
+    return pieces
+
+class ProgressiveWriteHelper:
+    jobs = []
+    textures = []
+    frameBuffers = []
+
+    def __init__(self):
+        self.jobs = []
+        self.textures = []
+        self.frameBuffers = []
+
+    # Copy a result on the GPU to write its spans to node later, spans are (x, y, width, height) in the result
+    def add(self, ctx, node, result, spans):
+        copy = ctx.texture(result.size, result.components, dtype=result.dtype)
+        source = ctx.framebuffer([result])
+        ctx.copy_framebuffer(copy, source)
+        source.release()
+        frameBuffer = ctx.framebuffer([copy])
+        self.textures.append(copy)
+        self.frameBuffers.append(frameBuffer)
+        self.jobs.append((node, frameBuffer, copy.components, copy.dtype, spans))
+
+    # Write all added results from the centre of the view outward, region is the processed part of the document
+    # Must be called outside of the context's scope, returns a description of what was written
+    def write(self, ctx, doc, region, parent):
+        x, y, width, height = region
+        centerX, centerY = getViewCenter(doc)
+        pieces = []
+        for node, frameBuffer, components, dtype, spans in self.jobs:
+            for piece in splitSpans(spans):
+                distance = (x + piece[0] + piece[2] / 2 - centerX) ** 2 + (y + piece[1] + piece[3] / 2 - centerY) ** 2
+                pieces.append((distance, piece, node, frameBuffer, components, dtype))
+        pieces.sort(key=lambda entry: entry[0])
+        progress = QProgressDialog("Writing results to layers...", "Cancel", 0, len(pieces), parent)
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(0)
+        written = 0
+        lastRefresh = time.perf_counter()
+        for distance, (pieceX, pieceY, pieceWidth, pieceHeight), node, frameBuffer, components, dtype in pieces:
+            if progress.wasCanceled():
+                break
+            with ctx:
+                data = frameBuffer.read(viewport=(pieceX, pieceY, pieceWidth, pieceHeight), components=components, dtype=dtype)
+            node.setPixelData(data, x + pieceX, y + pieceY, pieceWidth, pieceHeight)
+            written += 1
+            if time.perf_counter() - lastRefresh > refreshInterval:
+                doc.refreshProjection()
+                progress.setValue(written)
+                QApplication.processEvents()
+                lastRefresh = time.perf_counter()
+        cancelled = progress.wasCanceled()
+        progress.close()
+        doc.refreshProjection()
+        with ctx:
+            self.cleanUp()
+        if cancelled:
+            return f"Progressive write back cancelled, wrote {written} of {len(pieces)} tiles."
+        return f"Progressive write back: wrote {written} tiles."
+
+    # Clean up all OGL objects created, must be called in the context's scope
+    def cleanUp(self):
+        for frameBuffer in self.frameBuffers:
+            frameBuffer.release()
+        for texture in self.textures:
+            texture.release()
+        self.jobs = []
+        self.textures = []
+        self.frameBuffers = []
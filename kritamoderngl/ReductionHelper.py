@@ -0,0 +1,318 @@
+"""
+Class to help reducing a layer to a few numbers on the GPU instead of reading back every pixel
+
+Each reduction is a generated compute shader that reads the layer as a texture. Every 16x16 workgroup reduces its
+pixels in shared memory first, then merges that into a small result buffer with atomics, so only the result buffer is
+read back: 1 KiB per channel for a histogram, and a few bytes for min/max, mean, and the bounding box.
+
+The only exception is the mean of float layers, there are no float atomics so each workgroup writes its own partial sum
+and they are added up here. That is still 1/256th of the pixel count, and the sums are exact for integer layers.
+
+Results are returned in the display order of the channels, so RGBA layers stored as BGRA are reported as RGBA.
+
+Textures that are already on the GPU, such as the outputs of a run, can be reduced too. The dialogs use the bounding
+box of outputs going to new layers to only read back and write the part that is not transparent.
+"""
+import array
+import math
+import struct
+from . import ExecutionPlan, RgbaCorrectionHelper
+
+# Reductions that can be run, as (key, name shown in the dialog)
+reductionTypes = [
+    ("histogram", "Histogram"),
+    ("minmax", "Min / Max"),
+    ("mean", "Mean"),
+    ("bounds", "Bounding Box")
+]
+
+# Channel names for each color model in display order
+channelNames = {
+    "RGBA": ["Red", "Green", "Blue", "Alpha"],
+    "GRAYA": ["Gray", "Alpha"],
+    "XYZA": ["X", "Y", "Z", "Alpha"],
+    "LABA": ["L", "a", "b", "Alpha"],
+    "YCbCrA": ["Y", "Cb", "Cr", "Alpha"]
+}
+
+groupSize = 16
+emptyKey = 0xFFFFFFFF
+
+computeShaderHeader = """#version 430
+
+layout(local_size_x = 16, local_size_y = 16) in;
+#define COMPONENTS {components}
+uniform {sampler} in_texture;
+uniform ivec2 size;
+layout(std430, binding = 0) buffer Result {{
+    uint result[];
+}};
+"""
+
+# Map values to uints with the same ordering so atomicMin and atomicMax work on floats too
+floatKeyFunction = """
+uint toKey(float value) {
+    uint bits = floatBitsToUint(value);
+    return (bits & 0x80000000u) != 0u ? ~bits : bits | 0x80000000u;
+}
+uint toBin(float value) {
+    return uint(clamp(value, 0.0, 1.0) * 255.0 + 0.5);
+}
+"""
+
+uintKeyFunction = """
+uint toKey(uint value) {{
+    return value;
+}}
+uint toBin(uint value) {{
+    return min(value >> {shift}u, 255u);
+}}
+"""
+
+mainHeader = """
+void main() {{
+    ivec2 pos = ivec2(gl_GlobalInvocationID.xy);
+    uint local = gl_LocalInvocationIndex;
+    bool inside = pos.x < size.x && pos.y < size.y;
+    {vec} color = inside ? texelFetch(in_texture, pos, 0) : {vec}(0);
+"""
+
+histogramBody = """
+    for (int c = 0; c < COMPONENTS; c++) {
+        bins[c * 256 + local] = 0u;
+    }
+    barrier();
+    if (inside) {
+        for (int c = 0; c < COMPONENTS; c++) {
+            atomicAdd(bins[c * 256 + toBin(color[c])], 1u);
+        }
+    }
+    barrier();
+    for (int c = 0; c < COMPONENTS; c++) {
+        if (bins[c * 256 + local] != 0u) {
+            atomicAdd(result[c * 256 + local], bins[c * 256 + local]);
+        }
+    }
+}"""
+
+minMaxBody = """
+    if (local < COMPONENTS) {
+        lowest[local] = 0xFFFFFFFFu;
+        highest[local] = 0u;
+    }
+    barrier();
+    if (inside) {
+        for (int c = 0; c < COMPONENTS; c++) {
+            atomicMin(lowest[c], toKey(color[c]));
+            atomicMax(highest[c], toKey(color[c]));
+        }
+    }
+    barrier();
+    if (local < COMPONENTS) {
+        atomicMin(result[local], lowest[local]);
+        atomicMax(result[COMPONENTS + local], highest[local]);
+    }
+}"""
+
+# Partial sums of 256 pixels are exact in a float, even for 16 bit layers
+meanBody = """
+    partial[local] = vec4(color);
+    barrier();
+    for (uint stride = 128u; stride > 0u; stride >>= 1) {
+        if (local < stride) {
+            partial[local] += partial[local + stride];
+        }
+        barrier();
+    }
+    if (local == 0u) {
+        for (int c = 0; c < COMPONENTS; c++) {
+"""
+
+meanUintWrite = """            // 64 bit sums as low and high words, carrying into the high word when the low word wraps
+            uint sum = uint(partial[0][c]);
+            uint previous = atomicAdd(result[c * 2], sum);
+            if (previous > 0xFFFFFFFFu - sum) {
+                atomicAdd(result[c * 2 + 1], 1u);
+            }
+        }
+    }
+}"""
+
+meanFloatWrite = """            uint group = gl_WorkGroupID.y * gl_NumWorkGroups.x + gl_WorkGroupID.x;
+            result[group * COMPONENTS + c] = floatBitsToUint(partial[0][c]);
+        }
+    }
+}"""
+
+boundsBody = """
+    if (local == 0u) {{
+        box[0] = 0xFFFFFFFFu;
+        box[1] = 0xFFFFFFFFu;
+        box[2] = 0u;
+        box[3] = 0u;
+    }}
+    barrier();
+    if (inside && color[COMPONENTS - 1] {notEmpty}) {{
+        atomicMin(box[0], uint(pos.x));
+        atomicMin(box[1], uint(pos.y));
+        atomicMax(box[2], uint(pos.x));
+        atomicMax(box[3], uint(pos.y));
+    }}
+    barrier();
+    if (local == 0u && box[0] != 0xFFFFFFFFu) {{
+        atomicMin(result[0], box[0]);
+        atomicMin(result[1], box[1]);
+        atomicMax(result[2], box[2]);
+        atomicMax(result[3], box[3]);
+    }}
+}}"""
+
+# Create the compute shader for a reduction of a texture in the given format
+def generateComputeShader(kind, components, colorType):
+    isFloat = colorType[0] == "f"
+    source = computeShaderHeader.format(components=components, sampler="sampler2D" if isFloat else "usampler2D")
+    if isFloat:
+        source += floatKeyFunction
+    else:
+        source += uintKeyFunction.format(shift=int(colorType[1:]) * 8 - 8)
+    match kind:
+        case "histogram":
+            source += f"shared uint bins[{components * 256}];\n"
+        case "minmax":
+            source += "shared uint lowest[COMPONENTS];\nshared uint highest[COMPONENTS];\n"
+        case "mean":
+            source += "shared vec4 partial[256];\n"
+        case "bounds":
+            source += "shared uint box[4];\n"
+    source += mainHeader.format(vec="vec4" if isFloat else "uvec4")
+    match kind:
+        case "histogram":
+            source += histogramBody
+        case "minmax":
+            source += minMaxBody
+        case "mean":
+            source += meanBody + (meanFloatWrite if isFloat else meanUintWrite)
+        case "bounds":
+            source += boundsBody.format(notEmpty="> 0.0" if isFloat else "!= 0u")
+    return source
+
+# Get the value of a float stored with toKey
+def fromFloatKey(key):
+    bits = key & 0x7FFFFFFF if key & 0x80000000 else ~key & 0xFFFFFFFF
+    return struct.unpack("<f", struct.pack("<I", bits))[0]
+
+class ReductionHelper:
+    program = None
+    texture = None
+    buffer = None
+
+    def __init__(self):
+        self.program = None
+        self.texture = None
+        self.buffer = None
+
+    # Reduce a node over the document area, returns a dict of results, see formatResult for their layout
+    def reduce(self, ctx, node, width, height, kind):
+        if kind not in [key for key, name in reductionTypes]:
+            raise Exception(f"Unknown reduction: {kind}")
+        components, colorType = ExecutionPlan.getColorComponentsAndType(node)
+        if components > 4:
+            raise Exception(f"Statistics are not supported for the {node.colorModel()} color model.")
+        names = channelNames.get(node.colorModel(), [f"Channel {c}" for c in range(components)])
+        # Find where each channel in display order is in the pixel data
+        order = [2, 1, 0, 3] if RgbaCorrectionHelper.nodeNeedsCorrection(node) else list(range(components))
+        groupsX = (width + groupSize - 1) // groupSize
+        groupsY = (height + groupSize - 1) // groupSize
+        # Set up the starting values to merge into
+        match kind:
+            case "histogram":
+                initial = array.array("I", [0] * (components * 256))
+            case "minmax":
+                initial = array.array("I", [emptyKey] * components + [0] * components)
+            case "mean":
+                initial = array.array("I", [0] * (components * (groupsX * groupsY if colorType[0] == "f" else 2)))
+            case "bounds":
+                initial = array.array("I", [emptyKey, emptyKey, 0, 0])
+        self.texture = ctx.texture((width, height), components, data=node.projectionPixelData(0, 0, width, height), dtype=colorType)
+        data = self.reduceTexture(ctx, self.texture, kind, initial)
+        # Decode the result buffer
+        if colorType[0] == "f":
+            decode = fromFloatKey
+        else:
+            decode = int
+        match kind:
+            case "histogram":
+                return {"histogram": {names[c]: list(data[order[c] * 256:order[c] * 256 + 256]) for c in range(components)}}
+            case "minmax":
+                return {
+                    "min": {names[c]: decode(data[order[c]]) for c in range(components)},
+                    "max": {names[c]: decode(data[components + order[c]]) for c in range(components)}
+                }
+            case "mean":
+                if colorType[0] == "f":
+                    sums = [math.fsum(struct.unpack("<f", struct.pack("<I", bits))[0] for bits in data[c::components]) for c in range(components)]
+                else:
+                    sums = [data[c * 2] + (data[c * 2 + 1] << 32) for c in range(components)]
+                return {"mean": {names[c]: sums[order[c]] / (width * height) for c in range(components)}}
+            case "bounds":
+                if data[0] == emptyKey:
+                    return {"bounds": None}
+                return {"bounds": (data[0], data[1], data[2] - data[0] + 1, data[3] - data[1] + 1)}
+
+    # Run a reduction over a texture already on the GPU, returns the raw result buffer merged into initial
+    def reduceTexture(self, ctx, texture, kind, initial):
+        width, height = texture.size
+        self.program = ctx.compute_shader(generateComputeShader(kind, texture.components, texture.dtype))
+        self.buffer = ctx.buffer(initial.tobytes())
+        texture.use(location=0)
+        self.program["in_texture"] = 0
+        self.program["size"] = (width, height)
+        self.buffer.bind_to_storage_buffer(binding=0)
+        self.program.run((width + groupSize - 1) // groupSize, (height + groupSize - 1) // groupSize, 1)
+        ctx.finish()
+        data = array.array("I")
+        data.frombytes(self.buffer.read())
+        self.program.release()
+        self.buffer.release()
+        self.program = None
+        self.buffer = None
+        return data
+
+    # Find the bounding box of the pixels of a texture with a non zero last channel
+    # Returns (x, y, width, height) in the texture, or None if it is fully transparent
+    def findBounds(self, ctx, texture):
+        data = self.reduceTexture(ctx, texture, "bounds", array.array("I", [emptyKey, emptyKey, 0, 0]))
+        if data[0] == emptyKey:
+            return None
+        return (data[0], data[1], data[2] - data[0] + 1, data[3] - data[1] + 1)
+
+    # Clean up all OGL objects created for the reduction
+    def cleanUp(self):
+        if self.program:
+            self.program.release()
+        if self.texture:
+            self.texture.release()
+        if self.buffer:
+            self.buffer.release()
+        self.program = None
+        self.texture = None
+        self.buffer = None
+
+# Describe a reduction result as text for the dialogs
+def formatResult(result):
+    lines = []
+    if "histogram" in result:
+        for name, bins in result["histogram"].items():
+            lines.append(f"{name} histogram (256 bins): {' '.join(str(count) for count in bins)}")
+    if "min" in result:
+        for name in result["min"]:
+            lines.append(f"{name}: min {result['min'][name]:g}, max {result['max'][name]:g}")
+    if "mean" in result:
+        for name, value in result["mean"].items():
+            lines.append(f"{name}: mean {value:g}")
+    if "bounds" in result:
+        if result["bounds"] is None:
+            lines.append("Bounding box: layer is fully transparent")
+        else:
+            lines.append("Bounding box: x {}, y {}, width {}, height {}".format(*result["bounds"]))
+    return "\n".join(lines)
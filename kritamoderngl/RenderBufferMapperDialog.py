@@ -1,16 +1,58 @@
 from krita import *
-from PyQt5.QtCore import Qt, QRect, QUuid
-from PyQt5.QtGui import QFont
-from PyQt5.QtWidgets import QDialog, QFileDialog, QDialogButtonBox, QComboBox, QLabel, QHBoxLayout, QVBoxLayout, QMessageBox, QTableWidget, QTableWidgetItem, QCheckBox, QPushButton
+from PyQt5.QtCore import Qt, QRect
+from PyQt5.QtWidgets import QDialog, QFileDialog, QDialogButtonBox, QLabel, QHBoxLayout, QVBoxLayout, QMessageBox, QTableView, QAbstractItemView, QPushButton
 import json
-from . import TextureMapItem
+from . import TextureMapItem, TextureMapModel, VertexBufferItem, VertexBufferHelper, ExecutionPlan, DocumentWatcher, LayerIndex
 
 # Dialog box to configure input and output buffers for the render shader dialog
 class RenderBufferMapperDialog(QDialog):
     def __init__(self, parent=None):
         super(RenderBufferMapperDialog, self).__init__(parent)
-        self.inputTextureMapItems = []
-        self.outputTextureMapItems = []
+        # The item lists are held by the table models, the tables only display them
+        self.inputModel = TextureMapModel.TextureMapModel(
+            [("index", "Texture Unit Index"), ("layerId", "Target Layer"), ("repeat", "Repeat"), ("variableName", "Sampler Name"), ("workingFormat", "Working Format"), ("arrayLayers", "Layer Array")],
+            ["", "<>"],
+            ["", "<ACTIVE LAYER>"],
+            {"index": "Texture Unit Index.\nThis must be in order, change by reordering rows.",
+             "layerId": "Choose layer in current document to sample from.\n<ACTIVE LAYER> will sample the currently selected layer.",
+             "repeat": "Set whether the texture repeats when sampling beyond the bounds.",
+             "variableName": "Set the name of the sampler to map to in the fragment shader.",
+             "workingFormat": "Format the shader works with, Layer Format uses the format of the layer.\nF16 or F32 give float precision on integer layers, values are converted on the GPU to and from the layer's format.",
+             "arrayLayers": "Optional name pattern with * and ? wildcards, eg. Frame *.\nEvery layer whose name matches is packed into one sampler2DArray, a slice per layer from the top of the Layers docker, instead of the Target Layer.\nLayer arrays are read only and all their layers need the same format."},
+            self,
+            {"workingFormat": ExecutionPlan.workingFormats})
+        self.outputModel = TextureMapModel.TextureMapModel(
+            [("index", "Frame Buffer Index"), ("layerId", "Target Layer"), ("repeat", "Repeat"), ("workingFormat", "Working Format"), ("dither", "Dither"), ("overwrite", "Overwrites")],
+            ["", "<>"],
+            ["", "<NEW LAYER>"],
+            {"index": "Frame Buffer Index.\nThis must be in order, change by reordering rows.",
+             "layerId": "Choose layer in current document to sample from.\n<NEW LAYER> will add a new layer above the currently selected layer.",
+             "repeat": "Set whether the texture repeats when sampling beyond the bounds.",
+             "workingFormat": "Format the shader works with, Layer Format uses the format of the layer.\nF16 or F32 give float precision on integer layers, values are converted on the GPU to and from the layer's format.",
+             "dither": "Add ordered dithering when a float working format is converted back to an 8 or 16 bit integer layer.",
+             "overwrite": "Set when the shader writes every pixel of this output.\nThe layer's pixels are then not uploaded and the output starts transparent, else pixels the shader does not write keep the layer's content."},
+            self,
+            {"workingFormat": ExecutionPlan.workingFormats})
+        self.vertexModel = TextureMapModel.TextureMapModel(
+            [("index", "Buffer Index"), ("layerId", "Source"), ("sourceFile", "Source File"), ("layout", "Layout"), ("attributes", "Attribute Names"), ("perInstance", "Per Instance")],
+            ["", "<>"],
+            ["<SOURCE FILE>", "<ACTIVE LAYER>"],
+            {"index": "Vertex Buffer Index.\nBuffers are bound in this order, change by reordering rows.",
+             "layerId": "Where the buffer data comes from.\n<SOURCE FILE> reads the Source File, a layer gives one element per pixel in the layer's format.",
+             "sourceFile": ".csv file with one element per row, or .npy or raw binary file with the data already in the layout.",
+             "layout": "Layout of each element, eg. 2f 4f1 for a vec2 and a normalized RGBA byte color, 4x skips 4 bytes.\nLayers can leave this empty to read each pixel as one normalized vector.",
+             "attributes": "Names of the vertex shader inputs for the attributes in the layout, separated by spaces.",
+             "perInstance": "Set whether the buffer advances once per instance instead of once per vertex."},
+            self)
+        # Compiled mapping, cleared whenever the mapping is edited
+        self.plan = None
+        self.inputModel.mappingEdited.connect(self.invalidatePlan)
+        self.outputModel.mappingEdited.connect(self.invalidatePlan)
+        self.vertexModel.mappingEdited.connect(self.invalidatePlan)
+        # Result of the last validation, reused on focus changes until the mapping or document changes
+        self.documentWatcher = DocumentWatcher.getSharedWatcher()
+        self.validationState = None
+        self.validationError = None
         
         self.helpWindow = QMessageBox(parent=self)
         self.buttonBox = QDialogButtonBox(
@@ -31,10 +73,7 @@ class RenderBufferMapperDialog(QDialog):
         
         self.inputLabel = QLabel("Input Texture Units:", self)
         self.createLayerLists()
-        self.inputMap = QTableWidget(len(self.inputTextureMapItems), 4, self)
-        self.inputMap.setHorizontalHeaderLabels(["Texture Unit Index", "Target Layer", "Repeat", "Sampler Name"])
-        self.inputMap.setCornerButtonEnabled(False)
-        self.inputMap.verticalHeader().setVisible(False)
+        self.inputMap = self.createTableView(self.inputModel)
         inOrderUp = QPushButton(Krita.instance().icon("arrow-up"), "Move Up")
         inOrderUp.clicked.connect(self.moveInRowUp)
         inOrderDown = QPushButton(Krita.instance().icon("arrow-down"), "Move Down")
@@ -50,10 +89,7 @@ class RenderBufferMapperDialog(QDialog):
         self.inMapEditBox.addWidget(inListRemove)
         
         self.outputLabel = QLabel("Output Frame Buffer:", self)
-        self.outputMap = QTableWidget(len(self.outputTextureMapItems), 3, self)
-        self.outputMap.setHorizontalHeaderLabels(["Frame Buffer Index", "Target Layer", "Repeat"])
-        self.outputMap.setCornerButtonEnabled(False)
-        self.outputMap.verticalHeader().setVisible(False)
+        self.outputMap = self.createTableView(self.outputModel)
         outOrderUp = QPushButton(Krita.instance().icon("arrow-up"), "Move Up")
         outOrderUp.clicked.connect(self.moveOutRowUp)
         outOrderDown = QPushButton(Krita.instance().icon("arrow-down"), "Move Down")
@@ -67,6 +103,22 @@ class RenderBufferMapperDialog(QDialog):
         self.outMapEditBox.addWidget(outOrderDown)
         self.outMapEditBox.addWidget(outListAdd)
         self.outMapEditBox.addWidget(outListRemove)
+
+        self.vertexLabel = QLabel("Vertex and Instance Buffers:", self)
+        self.vertexMap = self.createTableView(self.vertexModel)
+        vertexOrderUp = QPushButton(Krita.instance().icon("arrow-up"), "Move Up")
+        vertexOrderUp.clicked.connect(self.moveVertexRowUp)
+        vertexOrderDown = QPushButton(Krita.instance().icon("arrow-down"), "Move Down")
+        vertexOrderDown.clicked.connect(self.moveVertexRowDown)
+        vertexListAdd = QPushButton(Krita.instance().icon("list-add"), "Add")
+        vertexListAdd.clicked.connect(self.addVertexRow)
+        vertexListRemove = QPushButton(Krita.instance().icon("list-remove"), "Remove")
+        vertexListRemove.clicked.connect(self.removeVertexRow)
+        self.vertexMapEditBox = QHBoxLayout()
+        self.vertexMapEditBox.addWidget(vertexOrderUp)
+        self.vertexMapEditBox.addWidget(vertexOrderDown)
+        self.vertexMapEditBox.addWidget(vertexListAdd)
+        self.vertexMapEditBox.addWidget(vertexListRemove)
         self.readSettings()
         
         vbox = QVBoxLayout(self)
@@ -76,6 +128,9 @@ class RenderBufferMapperDialog(QDialog):
         vbox.addWidget(self.outputLabel)
         vbox.addWidget(self.outputMap)
         vbox.addLayout(self.outMapEditBox)
+        vbox.addWidget(self.vertexLabel)
+        vbox.addWidget(self.vertexMap)
+        vbox.addLayout(self.vertexMapEditBox)
         vbox.addWidget(self.buttonBox)
         
         self.setWindowTitle("Configure Input and Output Buffers")
@@ -86,114 +141,81 @@ class RenderBufferMapperDialog(QDialog):
         self.createLayerLists()
         self.readSettings()
 
-    def updateAllViews(self):
-        # This will update both the input and output UI
-        self.updateInView()
-        self.updateOutView()
+    def createTableView(self, model):
+        # Table for one of the mapping models, layer drop downs are only created while a cell is edited
+        table = QTableView(self)
+        table.setModel(model)
+        table.setItemDelegateForColumn(model.getColumn("layerId"), TextureMapModel.LayerDelegate(table))
+        for key in model.choices:
+            table.setItemDelegateForColumn(model.getColumn(key), TextureMapModel.ChoiceDelegate(model.choices[key], table))
+        table.setEditTriggers(QAbstractItemView.CurrentChanged | QAbstractItemView.SelectedClicked | QAbstractItemView.DoubleClicked | QAbstractItemView.EditKeyPressed)
+        table.setCornerButtonEnabled(False)
+        table.verticalHeader().setVisible(False)
+        return table
 
-    def updateInView(self):
-        # Updates the input mapping UI to reflect changes made to the data models
-        monoFont = QFont("Monospace")
-        monoFont.setStyleHint(QFont.TypeWriter)
-        self.inputMap.setRowCount(len(self.inputTextureMapItems))
-        for idx in range(len(self.inputTextureMapItems)):
-            # Create the widgets and items that will populate the cells
-            indexWidget = QTableWidgetItem(str(idx))
-            indexWidget.setFlags(indexWidget.flags() ^ Qt.ItemIsEditable)
-            indexWidget.setToolTip("Texture Unit Index.\nThis must be in order, change by reordering rows.")
-            layerWidget = QComboBox()
-            layerWidget.addItems(["", "<ACTIVE LAYER>"] + self.nameList)
-            layerWidget.setInsertPolicy(QComboBox.NoInsert)
-            layerWidget.setToolTip("Choose layer in current document to sample from.\n<ACTIVE LAYER> will sample the currently selected layer.")
-            try:
-                layerWidget.setCurrentIndex(self.uuidList.index(self.inputTextureMapItems[idx].layerId))
-            except ValueError:
-                layerWidget.setCurrentIndex(0)
-            repeatWidget = QCheckBox()
-            repeatWidget.setChecked(self.inputTextureMapItems[idx].repeat)
-            repeatWidget.setToolTip("Set whether the texture repeats when sampling beyond the bounds.")
-            samplerWidget = QTableWidgetItem()
-            samplerWidget.setFont(monoFont)
-            samplerWidget.setToolTip("Set the name of the sampler to map to in the fragment shader.")
-            if self.inputTextureMapItems[idx].variableName: samplerWidget.setText(self.inputTextureMapItems[idx].variableName)
-            # Assign the widgets to cells
-            self.inputMap.setItem(idx, 0, indexWidget)
-            self.inputMap.setCellWidget(idx, 1, layerWidget)
-            self.inputMap.setCellWidget(idx, 2, repeatWidget)
-            self.inputMap.setItem(idx, 3, samplerWidget)
+    def invalidatePlan(self):
+        # Forget the compiled plan and cached validation result after the mapping changes
+        self.plan = None
+        self.validationState = None
     
-    def updateOutView(self):
-        # Updates the output mapping UI to reflect changes made to the data models
-        self.outputMap.setRowCount(len(self.outputTextureMapItems))
-        for idx in range(len(self.outputTextureMapItems)):
-            # Create the widgets and items that will populate the cells
-            indexWidget = QTableWidgetItem(str(idx))
-            indexWidget.setFlags(indexWidget.flags() ^ Qt.ItemIsEditable)
-            indexWidget.setToolTip("Frame Buffer Index.\nThis must be in order, change by reordering rows.")
-            layerWidget = QComboBox()
-            layerWidget.addItems(["", "<NEW LAYER>"] + self.nameList)
-            layerWidget.setInsertPolicy(QComboBox.NoInsert)
-            layerWidget.setToolTip("Choose layer in current document to sample from.\n<NEW LAYER> will add a new layer above the currently selected layer.")
-            try:
-                layerWidget.setCurrentIndex(self.uuidList.index(self.outputTextureMapItems[idx].layerId))
-            except ValueError:
-                layerWidget.setCurrentIndex(0)
-            repeatWidget = QCheckBox()
-            repeatWidget.setChecked(self.outputTextureMapItems[idx].repeat)
-            repeatWidget.setToolTip("Set whether the texture repeats when sampling beyond the bounds.")
-            # Assign the widgets to cells
-            self.outputMap.setItem(idx, 0, indexWidget)
-            self.outputMap.setCellWidget(idx, 1, layerWidget)
-            self.outputMap.setCellWidget(idx, 2, repeatWidget)
-    
-    def updateAllModels(self):
-        # Will update both the input and output list models
-        self.updateInModel()
-        self.updateOutModel()
-
-    def updateInModel(self):
-        # Updates the input list data to reflect changes made in the UI view
-        self.inputTextureMapItems = []
-        for idx in range(self.inputMap.rowCount()):
-            mapItem = TextureMapItem.TextureMapItem(self.uuidList[self.inputMap.cellWidget(idx, 1).currentIndex()],
-                                                    True,
-                                                    False,
-                                                    idx,
-                                                    self.inputMap.cellWidget(idx, 2).isChecked(),
-                                                    self.inputMap.item(idx, 3).text())
-            self.inputTextureMapItems.append(mapItem)
-
-    def updateOutModel(self):
-        # Updates the output list data to reflect changes made in the UI view
-        self.outputTextureMapItems = []
-        for idx in range(self.outputMap.rowCount()):
-            mapItem = TextureMapItem.TextureMapItem(self.uuidList[self.outputMap.cellWidget(idx, 1).currentIndex()],
-                                                    False,
-                                                    True,
-                                                    idx,
-                                                    self.outputMap.cellWidget(idx, 2).isChecked(),
-                                                    "")
-            self.outputTextureMapItems.append(mapItem)
-
     def validateMapping(self):
         # Checks if the mapping is valid, throws an exception with description if invalid, nothing otherwise
-        self.updateAllModels()
-        for item in self.inputTextureMapItems + self.outputTextureMapItems:
+        self.getExecutionPlan()
+        return True
+
+    def getValidationError(self):
+        # Returns the validation error message or None if the mapping is valid
+        # While the document watcher can see layer changes, the result is reused until the mapping or document changes
+        # Changing the active layer is not always a change to the layer model, so it is checked as well
+        doc = Krita.instance().activeDocument()
+        activeNode = doc.activeNode() if doc else None
+        state = (
+            self.documentWatcher.revision,
+            doc.rootNode().uniqueId().toString() if doc else None,
+            activeNode.uniqueId().toString() if activeNode else None)
+        if self.documentWatcher.isTracking() and self.validationState == state:
+            return self.validationError
+        try:
+            self.getExecutionPlan()
+            self.validationError = None
+        except Exception as e:
+            self.validationError = e.args[0]
+        self.validationState = state
+        return self.validationError
+
+    def getExecutionPlan(self):
+        # Returns the mapping resolved against the active document, throws an exception with description if invalid
+        # The plan is reused until the mapping is edited or the document no longer matches it
+        doc = Krita.instance().activeDocument()
+        if self.plan and self.plan.isCurrent(doc):
+            return self.plan
+        self.plan = None
+        for item in self.inputModel.items + self.outputModel.items:
             # All inputs and outputs need a valid target layer
-            if item.layerId == "":
+            if item.layerId == "" and not item.arrayLayers:
                 raise Exception(f"Invalid Configuration\n{'Input' if item.read else 'Output'} at index {item.index}\nTarget Layer cannot be null.")
+        plan = ExecutionPlan.ExecutionPlan(doc)
+        plan.inputs = plan.resolve(doc, self.inputModel.items, "Input")
+        # For outputs, <> means a new layer rather than the active layer
+        plan.outputs = plan.resolve(doc, self.outputModel.items, "Output", activeId=None, newId="<>")
+        for planItem in plan.outputs:
             # All Outputs must map to a paintlayer node
-            if item.write and item.layerId != "<>":
-                layerType = Krita.instance().activeDocument().nodeByUniqueID(QUuid(item.layerId)).type()
-                if layerType != "paintlayer" and layerType[-4:] != "mask":
-                    raise Exception(f"Invalid Configuration\nOutput at index {item.index}\nTarget Layer is not paintable (type={layerType})")
-        return True
+            if not planItem.isNewLayer and planItem.nodeType != "paintlayer" and planItem.nodeType[-4:] != "mask":
+                raise Exception(f"Invalid Configuration\nOutput at index {planItem.index}\nTarget Layer is not paintable (type={planItem.nodeType})")
+        for item in self.vertexModel.items:
+            VertexBufferHelper.VertexBufferHelper().validateItem(item)
+        # Only buffers generated from a layer have a layer to resolve
+        plan.vertexBuffers = list(self.vertexModel.items)
+        layerItems = plan.resolve(doc, [item for item in self.vertexModel.items if item.layerId], "Vertex buffer")
+        plan.vertexLayers = {planItem.index: planItem for planItem in layerItems}
+        self.plan = plan
+        return plan
 
     def getSelectedRows(self, table, reverse=False):
         # Helper function to get the currently selected rows on the input buffer table
         # Find which cells are selected and get their rows
         selectedRows = []
-        for idx in table.selectedIndexes():
+        for idx in table.selectionModel().selectedIndexes():
             if idx.row() not in selectedRows:
                 selectedRows.append(idx.row())
         selectedRows.sort(reverse=reverse)
@@ -201,150 +223,66 @@ class RenderBufferMapperDialog(QDialog):
 
     def moveInRowUp(self):
         # Move the current selected rows up if able
-        # Ensure the model is currently up-to-date
-        self.updateInModel()
-        selectedRows = self.getSelectedRows(self.inputMap)
-        # Row 0 cannot be moved up, so it and any rows in sequence after are invalid and skipped
-        invalidRow = 0
-        while selectedRows and selectedRows[0] == invalidRow:
-            selectedRows = selectedRows[1:]
-            invalidRow += 1
-        # Quick check to see if there is any work to do
-        if not selectedRows: return
-        # Shuffle all selected rows up one position from front to back
-        for row in selectedRows:
-            self.inputTextureMapItems = self.inputTextureMapItems[:row-1] \
-                                        + [self.inputTextureMapItems[row]] \
-                                        + [self.inputTextureMapItems[row-1]] \
-                                        + self.inputTextureMapItems[row+1:]
-        # Remap the indexes of all items in the list
-        for idx in range(len(self.inputTextureMapItems)):
-            self.inputTextureMapItems[idx].index = idx
-        # Update view for input map
-        self.updateInView()
+        self.inputModel.moveRowsUp(self.getSelectedRows(self.inputMap))
     
     def moveInRowDown(self):
         # Move the current selected rows down if able
-        # Ensure the model is currently up-to-date
-        self.updateInModel()
-        selectedRows = self.getSelectedRows(self.inputMap, reverse=True)
-        # Last row cannot be moved down, so it and any rows in sequence before are invalid and skipped
-        invalidRow = len(self.inputTextureMapItems) - 1
-        while selectedRows and selectedRows[0] == invalidRow:
-            selectedRows = selectedRows[1:]
-            invalidRow -= 1
-        # Quick check to see if there is any work to do
-        if not selectedRows: return
-        # Shuffle all selected rows down one position from back to front
-        for row in selectedRows:
-            self.inputTextureMapItems = self.inputTextureMapItems[:row] \
-                                        + [self.inputTextureMapItems[row+1]] \
-                                        + [self.inputTextureMapItems[row]] \
-                                        + self.inputTextureMapItems[row+2:]
-        # Remap the indexes of all items in the list
-        for idx in range(len(self.inputTextureMapItems)):
-            self.inputTextureMapItems[idx].index = idx
-        # Update view for input map
-        self.updateInView()
+        self.inputModel.moveRowsDown(self.getSelectedRows(self.inputMap, reverse=True))
     
     def addInRow(self):
         # Add a new row with default values below the current row, or at the bottom if none are selected
-        # Ensure the model is currently up-to-date
-        self.updateInModel()
         # If multiple rows are selected, place a new entry below the lowest selected row
         selectedRows = self.getSelectedRows(self.inputMap, reverse=True)
         newEntry = TextureMapItem.TextureMapItem("<>")
-        if selectedRows:
-            self.inputTextureMapItems.insert(selectedRows[0]+1, newEntry)
-        else:
-            self.inputTextureMapItems.append(newEntry)
-        self.updateInView()
+        self.inputModel.insertItem(selectedRows[0]+1 if selectedRows else len(self.inputModel.items), newEntry)
     
     def removeInRow(self):
         # Remove the current selected rows from the table
-        # Ensure the model is currently up-to-date
-        self.updateInModel()
         # Removing is easy working back to front
-        selectedRows = self.getSelectedRows(self.inputMap, reverse=True)
-        for row in selectedRows:
-            del self.inputTextureMapItems[row]
-        self.updateInView()
+        self.inputModel.removeItems(self.getSelectedRows(self.inputMap, reverse=True))
 
     def moveOutRowUp(self):
         # Move the current selected rows up if able
-        # Ensure the model is currently up-to-date
-        self.updateOutModel()
-        selectedRows = self.getSelectedRows(self.outputMap)
-        # Row 0 cannot be moved up, so it and any rows in sequence after are invalid and skipped
-        invalidRow = 0
-        while selectedRows and selectedRows[0] == invalidRow:
-            selectedRows = selectedRows[1:]
-            invalidRow += 1
-        # Quick check to see if there is any work to do
-        if not selectedRows: return
-        # Shuffle all selected rows up one position from front to back
-        for row in selectedRows:
-            self.outputTextureMapItems = self.outputTextureMapItems[:row-1] \
-                                        + [self.outputTextureMapItems[row]] \
-                                        + [self.outputTextureMapItems[row-1]] \
-                                        + self.outputTextureMapItems[row+1:]
-        # Remap the indexes of all items in the list
-        for idx in range(len(self.outputTextureMapItems)):
-            self.outputTextureMapItems[idx].index = idx
-        # Update view for output map
-        self.updateOutView()
+        self.outputModel.moveRowsUp(self.getSelectedRows(self.outputMap))
     
     def moveOutRowDown(self):
         # Move the current selected rows down if able
-        # Ensure the model is currently up-to-date
-        self.updateOutModel()
-        selectedRows = self.getSelectedRows(self.outputMap, reverse=True)
-        # Last row cannot be moved down, so it and any rows in sequence before are invalid and skipped
-        invalidRow = len(self.outputTextureMapItems) - 1
-        while selectedRows and selectedRows[0] == invalidRow:
-            selectedRows = selectedRows[1:]
-            invalidRow -= 1
-        # Quick check to see if there is any work to do
-        if not selectedRows: return
-        # Shuffle all selected rows down one position from back to front
-        for row in selectedRows:
-            self.outputTextureMapItems = self.outputTextureMapItems[:row] \
-                                        + [self.outputTextureMapItems[row+1]] \
-                                        + [self.outputTextureMapItems[row]] \
-                                        + self.outputTextureMapItems[row+2:]
-        # Remap the indexes of all items in the list
-        for idx in range(len(self.outputTextureMapItems)):
-            self.outputTextureMapItems[idx].index = idx
-        # Update view for output map
-        self.updateOutView()
+        self.outputModel.moveRowsDown(self.getSelectedRows(self.outputMap, reverse=True))
     
     def addOutRow(self):
         # Add a new row with default values below the current row, or at the bottom if none are selected
-        # Ensure the model is currently up-to-date
-        self.updateOutModel()
         # If multiple rows are selected, place a new entry below the lowest selected row
         selectedRows = self.getSelectedRows(self.outputMap, reverse=True)
         newEntry = TextureMapItem.TextureMapItem("<>",False,True)
-        if selectedRows:
-            self.outputTextureMapItems.insert(selectedRows[0]+1, newEntry)
-        else:
-            self.outputTextureMapItems.append(newEntry)
-        self.updateOutView()
+        self.outputModel.insertItem(selectedRows[0]+1 if selectedRows else len(self.outputModel.items), newEntry)
     
     def removeOutRow(self):
         # Remove the current selected rows from the table
-        # Ensure the model is currently up-to-date
-        self.updateOutModel()
         # Removing is easy working back to front
-        selectedRows = self.getSelectedRows(self.outputMap, reverse=True)
-        for row in selectedRows:
-            del self.outputTextureMapItems[row]
-        self.updateOutView()
+        self.outputModel.removeItems(self.getSelectedRows(self.outputMap, reverse=True))
+
+    def moveVertexRowUp(self):
+        # Move the current selected rows up if able
+        self.vertexModel.moveRowsUp(self.getSelectedRows(self.vertexMap))
+
+    def moveVertexRowDown(self):
+        # Move the current selected rows down if able
+        self.vertexModel.moveRowsDown(self.getSelectedRows(self.vertexMap, reverse=True))
+
+    def addVertexRow(self):
+        # Add a new row with default values below the current row, or at the bottom if none are selected
+        selectedRows = self.getSelectedRows(self.vertexMap, reverse=True)
+        newEntry = VertexBufferItem.VertexBufferItem(layout="2f", attributes="in_position")
+        self.vertexModel.insertItem(selectedRows[0]+1 if selectedRows else len(self.vertexModel.items), newEntry)
+
+    def removeVertexRow(self):
+        # Remove the current selected rows from the table
+        self.vertexModel.removeItems(self.getSelectedRows(self.vertexMap, reverse=True))
 
     def resetMap(self):
-        self.inputTextureMapItems = [TextureMapItem.TextureMapItem("<>")]
-        self.outputTextureMapItems = [TextureMapItem.TextureMapItem("<>",False,True)]
-        self.updateAllViews()
+        self.inputModel.setItems([TextureMapItem.TextureMapItem("<>")])
+        self.outputModel.setItems([TextureMapItem.TextureMapItem("<>",False,True)])
+        self.vertexModel.setItems([])
 
     def applyChanges(self):
         try:
@@ -365,6 +303,10 @@ class RenderBufferMapperDialog(QDialog):
    > The output frame buffer must be mapped in the fragment shader using `layout(location = <index>)`.
    > All inputs and outputs must be set to a valid layer in the document, outputs must be assigned to a paintlayer or mask layer.
    > The Repeat option sets whether the layer used as the texture will repeat when sampling beyond the texture bounds.
+   > Outputs on existing layers keep the pixels the shader does not draw, set Overwrites when the shader draws every pixel to skip uploading the layer. New layers always start transparent.
+   > Vertex and instance buffers feed the vertex shader inputs named in Attribute Names, using a layout such as `2f 4f1`. They can be read from a .csv file with one element per row, a .npy or raw binary file already in the layout, or a layer.
+   > A layer gives one element per pixel of the processed area, in the layer's format and channel order, so gl_InstanceID % width and gl_InstanceID / width give the pixel's position.
+   > Buffers set to Per Instance advance once per instance, draw many copies of a few vertices by setting the number of instances in the render shader window.
    > Press Reset at any time to reset the inputs and outputs to default values.
    > If you like to poke around, the configuration is saved as JSON. If you break something, delete the mgl_map_texture_map entry in krita-scripterrc and restart Krita.""")
         self.helpWindow.open()
@@ -379,14 +321,13 @@ class RenderBufferMapperDialog(QDialog):
         if file[0]:
             with open(file[0], 'r') as f:
                 jsonMap = json.loads(f.read())
-                self.inputTextureMapItems = []
-                self.outputTextureMapItems = []
-                for item in jsonMap:
-                    if item["read"]:
-                        self.inputTextureMapItems.append(TextureMapItem.TextureMapItem(json=item))
-                    if item["write"]:
-                        self.outputTextureMapItems.append(TextureMapItem.TextureMapItem(json=item))
-                self.updateAllViews()
+                # Files with vertex buffers hold two lists, older files only the texture list
+                if jsonMap and isinstance(jsonMap[0], list):
+                    self.setItemsFromJson(jsonMap[0])
+                    self.vertexModel.setItems([VertexBufferItem.VertexBufferItem(json=item) for item in jsonMap[1]])
+                else:
+                    self.setItemsFromJson(jsonMap)
+                    self.vertexModel.setItems([])
 
     def saveFile(self):
         # Open a file save dialog
@@ -397,8 +338,10 @@ class RenderBufferMapperDialog(QDialog):
             "JSON File (*.json)")
         if file[0]:
             with open(file[0], 'w') as f:
-                self.updateAllModels()
-                f.write(str(self.inputTextureMapItems + self.outputTextureMapItems))
+                if self.vertexModel.items:
+                    f.write(str([self.inputModel.items + self.outputModel.items, self.vertexModel.items]))
+                else:
+                    f.write(str(self.inputModel.items + self.outputModel.items))
 
     def saveAndReject(self):
         self.saveSettings(False)
@@ -409,15 +352,14 @@ class RenderBufferMapperDialog(QDialog):
         event.accept()
 
     def saveSettings(self, saveMaps=True):
-        if saveMaps:
-            self.updateAllModels()
         rect = QRect(
             self.geometry().x(),
             self.geometry().y(),
             1, 1) # width and height do not matter
         self.parentWidget().ext.settings.setValue("mgl_map_geometry", rect)
         if saveMaps:
-            self.parentWidget().ext.settings.setValue("mgl_map_texture_map", str(self.inputTextureMapItems + self.outputTextureMapItems))
+            self.parentWidget().ext.settings.setValue("mgl_map_texture_map", str(self.inputModel.items + self.outputModel.items))
+            self.parentWidget().ext.settings.setValue("mgl_map_vertex_map", str(self.vertexModel.items))
         self.parentWidget().ext.settings.sync()
 
     def readSettings(self):
@@ -426,33 +368,29 @@ class RenderBufferMapperDialog(QDialog):
             # TODO: figure out why the box keeps moving around? Does it?
             self.move(readGeometry.x(), readGeometry.y())
         default = '[{"layerId":"<>","read":true,"write":false,"index":0,"repeat":true,"variableName":""},{"layerId":"<>","read":false,"write":true,"index":0,"repeat":true,"variableName":""}]'
-        jsonMap = json.loads(self.parentWidget().ext.settings.value("mgl_map_texture_map", default))
-        self.inputTextureMapItems = []
-        self.outputTextureMapItems = []
+        self.setItemsFromJson(json.loads(self.parentWidget().ext.settings.value("mgl_map_texture_map", default)))
+        jsonMap = json.loads(self.parentWidget().ext.settings.value("mgl_map_vertex_map", "[]"))
+        self.vertexModel.setItems([VertexBufferItem.VertexBufferItem(json=item) for item in jsonMap])
+
+    def setItemsFromJson(self, jsonMap):
+        # Inputs and outputs are saved in one list, split them by their read and write flags
+        inputTextureMapItems = []
+        outputTextureMapItems = []
         for item in jsonMap:
             if item["read"]:
-                self.inputTextureMapItems.append(TextureMapItem.TextureMapItem(json=item))
+                inputTextureMapItems.append(TextureMapItem.TextureMapItem(json=item))
             if item["write"]:
-                self.outputTextureMapItems.append(TextureMapItem.TextureMapItem(json=item))
-        self.updateAllViews()
+                outputTextureMapItems.append(TextureMapItem.TextureMapItem(json=item))
+        self.inputModel.setItems(inputTextureMapItems)
+        self.outputModel.setItems(outputTextureMapItems)
 
     def createLayerLists(self):
         # Assume this will work because you need an active document to open the shader plugin
-        nodes = Krita.instance().activeDocument().topLevelNodes()
-        nameList = []
-        uuidList = []
-        for node in nodes:
-            name, uuid = listNodesRecursive(nameList, uuidList, node)
-            nameList.insert(0, name)
-            uuidList.insert(0, uuid)
-        self.nameList = nameList
-        self.uuidList = ["", "<>"] + uuidList
-
-# Helper function to recursively list all nodes in the document
-def listNodesRecursive(names, uuids, node, prefix="  "):
-    children = node.childNodes()
-    for child in children:
-        name, uuid = listNodesRecursive(names, uuids, child, "  " + prefix)
-        names.insert(0, prefix + name)
-        uuids.insert(0, prefix + uuid)
-    return node.name(), node.uniqueId().toString()
\ No newline at end of file
+        # The layer index is shared with the other dialogs and only rebuilt when the document changed
+        doc = Krita.instance().activeDocument()
+        self.layerIndex = LayerIndex.forDocument(doc)
+        self.layerIndex.refreshIfNeeded(doc)
+        # Refreshing replaces these lists, so the models keep consistent lists if the index is refreshed elsewhere
+        self.inputModel.setLayers(self.layerIndex.names, self.layerIndex.uuids, self.layerIndex.rows)
+        self.outputModel.setLayers(self.layerIndex.names, self.layerIndex.uuids, self.layerIndex.rows)
+        self.vertexModel.setLayers(self.layerIndex.names, self.layerIndex.uuids, self.layerIndex.rows)
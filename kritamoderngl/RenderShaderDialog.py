@@ -1,8 +1,9 @@
 from krita import *
+import time
 from PyQt5.QtCore import Qt, QRect, QSettings, QStandardPaths, QEvent, QUuid
 from PyQt5.QtGui import QIntValidator, QFont, QIcon
-from PyQt5.QtWidgets import QDialog, QFileDialog, QDialogButtonBox, QComboBox, QLabel, QHBoxLayout, QVBoxLayout, QMessageBox, QLineEdit, QTextEdit, QPushButton, QCheckBox
-from . import RenderBufferMapperDialog, RgbaCorrectionHelper
+from PyQt5.QtWidgets import QDialog, QFileDialog, QDialogButtonBox, QComboBox, QLabel, QHBoxLayout, QVBoxLayout, QMessageBox, QLineEdit, QTextEdit, QPushButton, QCheckBox, QWidget
+from . import RenderBufferMapperDialog, RgbaCorrectionHelper, SelectionHelper, FormatConversionHelper, MemoryEstimator, VertexBufferHelper, GeometryComputeHelper, ShaderReflection, ResultCache, TileDiffHelper, ReductionHelper, ProgressiveWriteHelper, BatchHelper, LayerArrayHelper, ShaderCompileHelper
 
 # Dialog box for render shader
 class RenderShaderDialog(QDialog):
@@ -47,20 +48,23 @@ class RenderShaderDialog(QDialog):
             "Triangle Strip",
             "Triangle Fan"])
         self.vertMode.setInsertPolicy(QComboBox.NoInsert)
+        self.instanceLabel = QLabel("Instances:", self)
+        self.instanceNumber = QLineEdit("-1", self)
+        self.instanceNumber.setValidator(QIntValidator(-1, 2147483647, self))
+        self.instanceNumber.setToolTip("""Number of instances to draw, the vertices are drawn once per instance and gl_InstanceID counts the instances.
+-1 uses the number of elements in the per instance buffers, or 1 if there are none.""")
         self.settingSpacer = QLabel("   |   ", self)
         
         self.mapButton = QPushButton("Map Buffers", self)
         self.mapButton.clicked.connect(self.showMap)
-        try:
-            self.mapWindow.validateMapping()
-        except Exception as e:
-            self.mapButton.setIcon(Krita.instance().icon("warning"))
-            self.mapButton.setToolTip(f"Errors in configuration mapping, open to resolve\nMost likely, previous configuration referred to a layer that does not exist now\n\n{e.args[0]}")
+        self.updateMapButton()
         
         self.settingLayout.addWidget(self.settingLabel)
         self.settingLayout.addWidget(self.vertNumber)
         self.settingLayout.addWidget(self.settingLabel2)
         self.settingLayout.addWidget(self.vertMode)
+        self.settingLayout.addWidget(self.instanceLabel)
+        self.settingLayout.addWidget(self.instanceNumber)
         self.settingLayout.addWidget(self.settingSpacer)
         self.settingLayout.addWidget(self.mapButton)
         self.vertBox = QTextEdit()
@@ -69,12 +73,105 @@ class RenderShaderDialog(QDialog):
         self.vertBox.setFont(monoFont)
 
         self.rgbaColorCorrector = RgbaCorrectionHelper.RgbaCorrectionHelper()
+        self.formatConverter = FormatConversionHelper.FormatConversionHelper()
+        self.vertexBufferHelper = VertexBufferHelper.VertexBufferHelper()
         self.rgbaCorrectCheck = QCheckBox("Fix RGBA color channel order", self)
         self.rgbaCorrectCheck.setChecked(True)
         self.rgbaCorrectCheck.setToolTip("""Attempt to ensure the red and blue color channels are in the correct order when using RGBA color mode.
 When this is checked, RGBA channels should be in the correct order. Else, red and blue channels may be swapped.
 If you notice issues with the order of red and blue color channels, try toggling this option.""")
+        self.selectionHelper = SelectionHelper.SelectionHelper()
+        self.halfFloatCheck = QCheckBox("Use F16 intermediates for 32 bit float layers", self)
+        self.halfFloatCheck.setToolTip("""Store the input textures and frame buffer targets of 32 bit float layers as 16 bit floats on the GPU, halving their memory.
+Layers are still uploaded and read back as 32 bit floats, the conversion happens on the GPU.
+Precision is reduced to about 3 decimal digits, and the saved memory and run time are shown after each run.""")
+        self.budgetLabel = QLabel("VRAM budget (MiB):", self)
+        self.budgetEdit = QLineEdit("0", self)
+        self.budgetEdit.setValidator(QIntValidator(0, 1048576, self))
+        self.budgetEdit.setToolTip("""GPU memory a run may use, checked against an estimate before anything is allocated.
+0 uses the free video memory reported by the driver, if the driver reports it.
+Runs that do not fit use F16 intermediates if that is enough, otherwise they are refused.""")
+        self.memoryLayout = QHBoxLayout()
+        self.memoryLayout.addWidget(self.halfFloatCheck)
+        self.memoryLayout.addStretch()
+        self.memoryLayout.addWidget(self.budgetLabel)
+        self.memoryLayout.addWidget(self.budgetEdit)
+        # Duration of the last run with and without F16 intermediates, to show the time saved
+        self.runTimes = {}
+        self.cacheCheck = QCheckBox("Reuse results of identical runs", self)
+        self.cacheCheck.setToolTip("""Keep the results of runs in memory and on disk, and write them straight to the layers when a run with the same shaders, settings, mapping, and layer content is done again.
+Layers are still read to check their content, but nothing is compiled, uploaded, or drawn.""")
+        self.tileDiffHelper = TileDiffHelper.TileDiffHelper()
+        self.reductionHelper = ReductionHelper.ReductionHelper()
+        self.progressiveHelper = ProgressiveWriteHelper.ProgressiveWriteHelper()
+        self.batchLabel = QLabel("Batch over layers:", self)
+        self.batchCombo = QComboBox(self)
+        for key, name in BatchHelper.batchModes:
+            self.batchCombo.addItem(name, key)
+        self.batchCombo.setToolTip("""Run the shader once for each layer of a batch, with the layer in place of the active layer in the mapping.
+The shader is compiled once for the whole batch, and the next layer is fetched while the GPU works on the current one.""")
+        self.batchEdit = QLineEdit("", self)
+        self.batchEdit.setPlaceholderText("Name pattern such as Line*, or a type such as paintlayer")
+        self.batchLayout = QHBoxLayout()
+        self.batchLayout.addWidget(self.batchLabel)
+        self.batchLayout.addWidget(self.batchCombo)
+        self.batchLayout.addWidget(self.batchEdit)
+        self.progressiveCheck = QCheckBox("Write back progressively from the view centre", self)
+        self.progressiveCheck.setToolTip(f"""Write the outputs to the layers in {ProgressiveWriteHelper.tileSize}x{ProgressiveWriteHelper.tileSize} tiles, starting at the centre of the view, and show them on the canvas as they are written.
+The write back can be cancelled from the progress dialog, tiles written until then are kept. Progressive runs are not cached.""")
+        self.cropCheck = QCheckBox("Crop new layers to their content", self)
+        self.cropCheck.setToolTip("""Find the bounding box of the pixels that are not transparent in outputs going to new layers on the GPU, and only read back and write that box.
+The rest of the new layer stays empty, which saves read back time and memory for shaders that only draw in a small area.""")
+        self.tileDiffCheck = QCheckBox("Only write back changed tiles", self)
+        self.tileDiffCheck.setToolTip(f"""Compare each output with the layer's original pixels on the GPU in {TileDiffHelper.tileSize}x{TileDiffHelper.tileSize} tiles, and only write the tiles that changed.
+This keeps undo steps and projection updates small for effects that only change part of a layer, at the cost of reading the layers of overwritten outputs.""")
+        self.selectionCheck = QCheckBox("Limit to selection", self)
+        self.selectionCheck.setToolTip("""Only render the bounding box of the active selection, and blend the result with the original pixels by the selection.
+Layers are only read and written inside that box, so small selections on large documents run much faster.
+Shaders can declare uniform ivec2 region_offset; to get the position of the box in the document.""")
         
+        # Optional compute pass that generates the vertices and the draw command on the GPU
+        self.geometryHelper = GeometryComputeHelper.GeometryComputeHelper()
+        self.geometryCheck = QCheckBox("Generate geometry with a compute shader", self)
+        self.geometryCheck.setToolTip("""Run a compute shader before rendering that writes vertices to storage binding 0 and the draw command to storage binding 1.
+The vertex and fragment shaders then draw exactly the vertices it generated with an indirect draw, without reading anything back.""")
+        self.geometryCheck.toggled.connect(self.updateGeometryVisibility)
+        self.geometryWidget = QWidget(self)
+        self.geometryGroupsLabel = QLabel("Work groups X:", self)
+        self.geometryGroupsX = QLineEdit("(width + 15) // 16", self)
+        self.geometryGroupsLabel2 = QLabel("Y:", self)
+        self.geometryGroupsY = QLineEdit("(height + 15) // 16", self)
+        self.geometrySizeLabel = QLabel("Vertex buffer bytes:", self)
+        self.geometrySize = QLineEdit("width * height * 16", self)
+        self.geometrySize.setToolTip("Size of the generated vertex buffer in bytes, can use width and height of the document (or of the selection when limited to it).")
+        self.geometryLayoutLabel = QLabel("Layout:", self)
+        self.geometryLayout = QLineEdit("4f", self)
+        self.geometryLayout.setToolTip("Layout of each generated vertex, eg. 4f or 2f 2x4 4f1. The buffer follows std430 rules, so a vec3 needs padding.")
+        self.geometryAttributesLabel = QLabel("Attribute Names:", self)
+        self.geometryAttributes = QLineEdit("in_position", self)
+        self.geometryAttributes.setToolTip("Names of the vertex shader inputs for the attributes in the layout, separated by spaces.")
+        self.geometryLayoutBox = QHBoxLayout()
+        self.geometryLayoutBox.addWidget(self.geometryGroupsLabel)
+        self.geometryLayoutBox.addWidget(self.geometryGroupsX)
+        self.geometryLayoutBox.addWidget(self.geometryGroupsLabel2)
+        self.geometryLayoutBox.addWidget(self.geometryGroupsY)
+        self.geometryLayoutBox.addWidget(self.geometrySizeLabel)
+        self.geometryLayoutBox.addWidget(self.geometrySize)
+        self.geometryLayoutBox.addWidget(self.geometryLayoutLabel)
+        self.geometryLayoutBox.addWidget(self.geometryLayout)
+        self.geometryLayoutBox.addWidget(self.geometryAttributesLabel)
+        self.geometryLayoutBox.addWidget(self.geometryAttributes)
+        self.geomLabel = QLabel("Geometry Compute Shader:", self)
+        self.geomBox = QTextEdit()
+        self.geomBox.setAcceptRichText(False)
+        self.geomBox.setTabChangesFocus(False)
+        self.geomBox.setFont(monoFont)
+        geometryBox = QVBoxLayout(self.geometryWidget)
+        geometryBox.setContentsMargins(0, 0, 0, 0)
+        geometryBox.addLayout(self.geometryLayoutBox)
+        geometryBox.addWidget(self.geomLabel)
+        geometryBox.addWidget(self.geomBox)
+
         self.fragLabel = QLabel("Fragment Shader:", self)
         self.fragBox = QTextEdit()
         self.fragBox.setAcceptRichText(False)
@@ -86,10 +183,29 @@ If you notice issues with the order of red and blue color channels, try toggling
         self.errBox.setAcceptRichText(False)
         self.errBox.setReadOnly(True)
         self.errBox.setPlaceholderText("Enter shader code above and click Run, warnings and errors will appear here.")
+        # Compiles the shaders a moment after they are edited and keeps the program for runs
+        self.compileHelper = ShaderCompileHelper.ShaderCompileHelper(
+            self.ext,
+            {"vertex_shader": self.vertBox, "fragment_shader": self.fragBox, "compute_shader": self.geomBox},
+            self.getShaderSources,
+            self.buildPrograms,
+            self.errBox,
+            self)
+        # Turning the geometry pass on or off changes what is compiled
+        self.geometryCheck.toggled.connect(self.compileHelper.schedule)
         
         vbox = QVBoxLayout(self)
         vbox.addLayout(self.settingLayout)
         vbox.addWidget(self.rgbaCorrectCheck)
+        vbox.addWidget(self.selectionCheck)
+        vbox.addWidget(self.cacheCheck)
+        vbox.addWidget(self.tileDiffCheck)
+        vbox.addWidget(self.cropCheck)
+        vbox.addWidget(self.progressiveCheck)
+        vbox.addLayout(self.batchLayout)
+        vbox.addLayout(self.memoryLayout)
+        vbox.addWidget(self.geometryCheck)
+        vbox.addWidget(self.geometryWidget)
         vbox.addWidget(self.vertLabel)
         vbox.addWidget(self.vertBox)
         vbox.addWidget(self.fragLabel)
@@ -99,6 +215,7 @@ If you notice issues with the order of red and blue color channels, try toggling
         vbox.addWidget(self.buttonBox)
         
         self.readSettings()
+        self.updateGeometryVisibility()
         
         self.setWindowTitle("OpenGL Shader Programming")
         self.setSizeGripEnabled(True)
@@ -119,16 +236,40 @@ If you notice issues with the order of red and blue color channels, try toggling
         # this filter is needed to detect when the window (widget) receives focus
         # because the widget does not receive focus events when the window receives focus
         if event.type() == QEvent.WindowActivate:
-            try:
-                self.mapWindow.validateMapping()
-                self.mapButton.setIcon(QIcon())
-                self.mapButton.setToolTip("")
-            except Exception as e:
-                self.mapButton.setIcon(Krita.instance().icon("warning"))
-                self.mapButton.setToolTip(f"Errors in configuration mapping, open to resolve\nMost likely, previous configuration referred to a layer that does not exist now\n\n{e.args[0]}")
+            self.updateMapButton()
             return True
         return super().eventFilter(obj, event)
 
+    def updateMapButton(self):
+        # Show a warning on the map button if the mapping is invalid, the result is cached so this is cheap on focus changes
+        error = self.mapWindow.getValidationError()
+        if error is None:
+            self.mapButton.setIcon(QIcon())
+            self.mapButton.setToolTip("")
+        else:
+            self.mapButton.setIcon(Krita.instance().icon("warning"))
+            self.mapButton.setToolTip(f"Errors in configuration mapping, open to resolve\nMost likely, previous configuration referred to a layer that does not exist now\n\n{error}")
+
+    def updateGeometryVisibility(self):
+        # The geometry settings and shader are only shown while the compute pass is enabled
+        self.geometryWidget.setVisible(self.geometryCheck.isChecked())
+
+    def getShaderSources(self):
+        # The geometry compute shader is only compiled while its pass is enabled
+        geometryShader = self.geomBox.toPlainText() if self.geometryCheck.isChecked() else ""
+        return (self.vertBox.toPlainText(), self.fragBox.toPlainText(), geometryShader)
+
+    def buildPrograms(self, ctx, vertexShader, fragmentShader, geometryShader):
+        # Returns the render program and the geometry compute shader, None without a geometry pass
+        program = ctx.program(vertex_shader=vertexShader, fragment_shader=fragmentShader)
+        if not geometryShader:
+            return program, None
+        try:
+            return program, ctx.compute_shader(geometryShader)
+        except Exception:
+            program.release()
+            raise
+
     def showMap(self):
         # Simple function to show the buffer mapping window
         self.mapWindow.open()
@@ -138,14 +279,100 @@ If you notice issues with the order of red and blue color channels, try toggling
         if not doc:
             self.errBox.setPlainText("You need to have a document open to use this script!")
             return
-        # Check layer map validity before doing anything
+        # Check layer map validity before doing anything, this also resolves every mapped layer once
         try:
-            self.mapWindow.validateMapping()
+            plan = self.mapWindow.getExecutionPlan()
         except Exception as e:
             self.errBox.setPlainText(f"Layer mapping is invalid, click Map Buffers and fix:\n{e.args[0]}")
             return
+        batchMode = self.batchCombo.currentData()
+        if not batchMode:
+            plan.clearPixelData()
+            self.runPlan(doc, plan)
+            return
+        try:
+            nodes = BatchHelper.findNodes(doc, batchMode, self.batchEdit.text())
+            BatchHelper.validate(plan, nodes, plan.outputs)
+        except Exception as e:
+            self.errBox.setPlainText(e.args[0])
+            return
+        plans = [plan.forActiveNode(node) for node in nodes]
+        startTime = time.perf_counter()
+        # The program is compiled once and taken from the program cache for every layer of the batch
+        for index in range(len(plans)):
+            nextPlan = plans[index + 1] if index + 1 < len(plans) else None
+            if not self.runPlan(doc, plans[index], nextPlan.prefetchActive if nextPlan else None):
+                self.errBox.setPlainText(f"Batch stopped at layer {nodes[index].name()} ({index + 1} of {len(nodes)}):\n{self.errBox.toPlainText()}")
+                return
+        self.errBox.setPlainText(f"Batch ran on {len(nodes)} layers in {time.perf_counter() - startTime:.2f} s.\n{self.errBox.toPlainText()}")
+
+    # Run the shaders with a resolved plan, returns False if the run failed and the error is shown
+    # prefetch is called with the region while the GPU works, batch runs use it to fetch the next layer
+    def runPlan(self, doc, plan, prefetch=None):
+        rgbaFix = self.rgbaCorrectCheck.isChecked()
+        # Limit the work to the bounding box of the selection if asked and there is one, else the whole document
+        selectionRegion = SelectionHelper.getSelectionRegion(doc) if self.selectionCheck.isChecked() else None
+        if selectionRegion and (selectionRegion[2] == 0 or selectionRegion[3] == 0):
+            self.errBox.setPlainText("The selection is outside of the document, there is nothing to process.")
+            return False
+        x, y, width, height = selectionRegion if selectionRegion else (0, 0, plan.width, plan.height)
+        halfFloat = self.halfFloatCheck.isChecked()
+        tileDiff = self.tileDiffCheck.isChecked()
+        cropNewLayers = self.cropCheck.isChecked()
+        progressive = self.progressiveCheck.isChecked()
+        # Check the geometry settings before anything is allocated
+        geometry = self.geometryCheck.isChecked()
+        geometryGroups, geometrySize = None, 0
+        if geometry:
+            try:
+                geometryGroups, geometrySize = self.geometryHelper.validate(
+                    self.geometryGroupsX.text(),
+                    self.geometryGroupsY.text(),
+                    self.geometrySize.text(),
+                    self.geometryLayout.text(),
+                    self.geometryAttributes.text(),
+                    width, height)
+            except Exception as e:
+                self.errBox.setPlainText(e.args[0])
+                return False
+        startTime = time.perf_counter()
+        # Check the run fits in GPU memory before allocating anything, the cache key needs the F16 setting it ends up with
+        with self.ext.ctx as ctx:
+            try:
+                halfFloat, fallbackMessage = MemoryEstimator.preflightCheck(
+                    ctx,
+                    int(self.budgetEdit.text() or "0"),
+                    lambda useHalfFloat: MemoryEstimator.estimateRender(plan, width, height, rgbaFix, selectionRegion, useHalfFloat) + geometrySize,
+                    halfFloat)
+            except Exception as e:
+                self.errBox.setPlainText(str(e))
+                return False
+        # Reuse the result of an identical run if there is one
+        cacheKey = None
+        if self.cacheCheck.isChecked():
+            cacheKey = self.getCacheKey(doc, plan, rgbaFix, halfFloat, geometry, selectionRegion, (x, y, width, height))
+            cached = self.ext.getResultCache().get(cacheKey)
+            if cached is not None:
+                newNodes = ResultCache.writeResults(doc, plan.outputs, cached, x, y, width, height)
+                for newNode in newNodes:
+                    plan.getActiveNode(doc).parentNode().addChildNode(newNode, plan.getActiveNode(doc))
+                doc.refreshProjection()
+                plan.clearPixelData()
+                self.errBox.setPlainText(f"Reused the result of an identical run in {(time.perf_counter() - startTime) * 1000:.0f} ms.")
+                self.saveSettings()
+                return True
+        # Progressive runs never read back whole results, so there is nothing to cache
+        if progressive:
+            cacheKey = None
+        cachedResults = []
+        # Set when part of the write back failed after the shader ran, the error is shown and a batch stops
+        failed = False
+        notes = [fallbackMessage] if fallbackMessage else []
         newNodes = []
         inputTextures = []
+        outputData = []
+        outputWorkingTypes = []
+        bufferInstances = None
         program = None
         outFrameBuffer = None
         vao = None
@@ -153,32 +380,48 @@ If you notice issues with the order of red and blue color channels, try toggling
         with self.ext.ctx as ctx:
             # Create a shader program from the text boxes
             try:
-                program = ctx.program(
-                    vertex_shader=self.vertBox.toPlainText(),
-                    fragment_shader=self.fragBox.toPlainText())
+                program, geometryShader = self.compileHelper.getProgram(ctx, self.getShaderSources())
             except Exception as e:
                 # Failure here means likely no OGL objects to clean up
                 self.errBox.setPlainText(str(e))
-                if program:
-                    program.release()
-                return
+                return False
+            # Shaders can optionally read where the processed region is in the document
+            regionOffset = program.get("region_offset", None)
+            if regionOffset is not None:
+                regionOffset.value = (x, y)
+            # Inputs neither shader uses are not fetched, uploaded, or bound
+            # The geometry compute shader is checked against its own compiled program
+            bindings = ShaderReflection.findBindings(program, [self.vertBox.toPlainText(), self.fragBox.toPlainText()])
+            if geometryShader:
+                bindings += ShaderReflection.findBindings(geometryShader, [self.geomBox.toPlainText()])
+            activeInputs = []
+            for planItem in plan.inputs:
+                if ShaderReflection.textureUnitUsed(program, bindings, planItem.item):
+                    activeInputs.append(planItem)
+                else:
+                    notes.append(f"Warning: input texture unit {planItem.index} is not used by the shaders and was skipped.")
+            notes += ShaderReflection.describeUnmapped(bindings, [planItem.item for planItem in plan.inputs], [])
+            if selectionRegion:
+                self.selectionHelper.createMask(ctx, doc, selectionRegion)
             # Map inputs from the input mapper
-            for input in self.mapWindow.inputTextureMapItems:
-                # Get node this item references
-                if input.layerId == "<>":
-                    node = doc.activeNode()
+            for planItem in activeInputs:
+                input = planItem.item
+                # Create input texture from the resolved layer
+                workingType = planItem.getWorkingType(halfFloat)
+                if planItem.arrayNodes:
+                    # Layer arrays pack a slice for each of their layers into one sampler2DArray
+                    inputTexture = LayerArrayHelper.createTextureArray(ctx, plan, planItem, (x, y, width, height), rgbaFix)
+                elif workingType:
+                    # Converted to the working format on the GPU, this also puts the channels in order
+                    inputTexture = self.formatConverter.convertInput(ctx, planItem, (width, height), plan.fetchPixelData(planItem, x, y, width, height), rgbaFix and planItem.needsCorrection, workingType)
                 else:
-                    node = doc.nodeByUniqueID(QUuid(input.layerId))
-                # Get color format data from the node
-                components, colorType = self.getColorComponentsAndType(node)
-                # Create input texture from current layer
-                inputTexture = ctx.texture((doc.width(), doc.height()), components, data=node.projectionPixelData(0, 0, doc.width(), doc.height()), dtype=colorType)
+                    inputTexture = ctx.texture((width, height), planItem.components, data=plan.fetchPixelData(planItem, x, y, width, height), dtype=planItem.colorType)
                 # Set up some attributes for the input texture
                 inputTexture.repeat_x = input.repeat
                 inputTexture.repeat_y = input.repeat
                 # This is to fix RGBA color mode actually being BGRA with integer color depth
-                if self.rgbaCorrectCheck.isChecked():
-                    self.rgbaColorCorrector.swizzleTextureIfNeeded(node, inputTexture)
+                if rgbaFix and planItem.needsCorrection and not planItem.workingType:
+                    self.rgbaColorCorrector.swizzleTexture(inputTexture)
                 inputTextures.append(inputTexture)
                 # Attempt to bind the textures to the program and texture units and assign samplers
                 try:
@@ -190,33 +433,56 @@ If you notice issues with the order of red and blue color channels, try toggling
                     # Cleanup and early exit
                     for i in inputTextures:
                         i.release()
-                    program.release()
-                    return
+                    self.selectionHelper.cleanUp()
+                    self.formatConverter.cleanUp()
+                    return False
             outputTextures = []
             # Create output textures with information from the mapper
-            for output in self.mapWindow.outputTextureMapItems:
-                if output.layerId == "<>":
-                    # Special case for new layer
-                    # TODO: Should there be a way to specify different color formats?
-                    node = doc
-                    components, colorType = self.getColorComponentsAndType(node)
-                    outputTexture = ctx.texture((doc.width(), doc.height()), components, dtype=colorType)
+            for planItem in plan.outputs:
+                output = planItem.item
+                workingType = planItem.getWorkingType(halfFloat)
+                outputWorkingTypes.append(workingType)
+                if planItem.isNewLayer:
+                    # Special case for new layer, which uses the document's format
+                    # The shader can still render in another format by choosing a working format in the mapper
+                    original = None
+                    data = None
                 else:
-                    node = doc.nodeByUniqueID(QUuid(output.layerId))
-                    components, colorType = self.getColorComponentsAndType(node)
                     # Copy the pixel data to the texture, in case it doesn't all get overwritten
-                    outputTexture = ctx.texture((doc.width(), doc.height()), components, data=node.projectionPixelData(0, 0, doc.width(), doc.height()), dtype=colorType)
+                    # Outputs the shader fully overwrites only need the pixels to blend with the selection
+                    original = plan.fetchPixelData(planItem, x, y, width, height) if selectionRegion or not output.overwrite else None
+                    data = None if output.overwrite else original
+                    # The correction pass swaps the whole output after rendering, so kept pixels are swapped ahead of it
+                    if data is not None and rgbaFix and planItem.needsCorrection and not workingType:
+                        data = RgbaCorrectionHelper.swapRedBlue(data, planItem.colorType)
+                if workingType:
+                    outputTexture = self.formatConverter.convertInput(ctx, planItem, (width, height), data, rgbaFix and planItem.needsCorrection, workingType)
+                else:
+                    outputTexture = ctx.texture((width, height), planItem.components, data=data, dtype=planItem.colorType)
+                # Outputs without data start transparent, cleared on the GPU instead of uploading anything
+                if data is None:
+                    self.formatConverter.clearTexture(ctx, outputTexture)
+                # The original pixels are needed again to blend with the selection
+                outputData.append(original if selectionRegion else None)
                 outputTexture.repeat_x = output.repeat
                 outputTexture.repeat_y = output.repeat
-                if self.rgbaCorrectCheck.isChecked():
-                    self.rgbaColorCorrector.fixTextureIfNeeded(node, outputTexture)
+                if rgbaFix and planItem.needsCorrection and not planItem.workingType:
+                    self.rgbaColorCorrector.fixTexture(outputTexture)
                 outputTextures.append(outputTexture)
             # Attempt to create and bind the framebuffer
             try:
                 # Create framebuffer with all output textures
                 outFrameBuffer = ctx.framebuffer(outputTextures)
                 outFrameBuffer.use() # Bind the framebuffer to the program
-                vao = ctx.vertex_array(program, [])
+                # Vertex and instance buffers from the mapper, without any the shader makes its own vertices
+                content, bufferVertices, bufferInstances = self.vertexBufferHelper.createContent(ctx, program, plan, (x, y, width, height))
+                # Generate vertices with the compute shader, they are drawn alongside any mapped vertex buffers
+                if geometry:
+                    self.geometryHelper.generate(ctx, geometryShader, geometryGroups, geometrySize, [(planItem.item, texture) for planItem, texture in zip(activeInputs, inputTextures)], (x, y))
+                    geometryContent = self.geometryHelper.getContent(program, self.geometryLayout.text(), self.geometryAttributes.text())
+                    if geometryContent:
+                        content.append(geometryContent)
+                vao = ctx.vertex_array(program, content)
             except Exception as e:
                 self.errBox.setPlainText(str(e))
                 # Cleanup and early exit
@@ -228,12 +494,18 @@ If you notice issues with the order of red and blue color channels, try toggling
                     outFrameBuffer.release()
                 if vao:
                     vao.release()
-                program.release()
-                return
+                self.vertexBufferHelper.cleanUp()
+                self.geometryHelper.cleanUp()
+                self.selectionHelper.cleanUp()
+                self.formatConverter.cleanUp()
+                return False
             try:
                 vertices = int(self.vertNumber.text())
                 if vertices != -1:
                     vao.vertices = vertices
+                elif bufferVertices is not None:
+                    # Per vertex buffers only, per instance buffers do not limit the vertex count
+                    vao.vertices = bufferVertices
                 # Set the primitive drawing mode
                 match self.vertMode.currentIndex():
                     case 0:
@@ -255,31 +527,89 @@ If you notice issues with the order of red and blue color channels, try toggling
             except ValueError as e:
                 # Could not parse number of vertices, good luck
                 pass
+            try:
+                instances = int(self.instanceNumber.text())
+            except ValueError:
+                instances = -1
+            if instances == -1:
+                instances = bufferInstances if bufferInstances is not None else 1
+            notes += self.vertexBufferHelper.notes + self.geometryHelper.notes
             
-            ctx.clear()
             # Display any errors in warningWidget
             try:
-                vao.render()
+                if geometry:
+                    # The number of vertices and instances come from the command the compute shader wrote
+                    self.geometryHelper.render(vao)
+                else:
+                    vao.render(instances=instances)
+                # Fetch the next layer of a batch while the GPU works on this one
+                if prefetch:
+                    prefetch(x, y, width, height)
                 ctx.finish()
                 # Run the RGBA channel correction pass if needed
-                if self.rgbaCorrectCheck.isChecked():
+                if rgbaFix:
                     self.rgbaColorCorrector.renderCorrectionIfNeeded(ctx, doc)
+                # Convert outputs with a working format back to the layer's format
+                # If this output needed color channel correction, use the corrected texture
+                results = []
+                for index in range(len(plan.outputs)):
+                    planItem = plan.outputs[index]
+                    if outputWorkingTypes[index]:
+                        results.append(self.formatConverter.convertOutput(ctx, planItem, outputTextures[index], rgbaFix and planItem.needsCorrection))
+                    elif rgbaFix and planItem.needsCorrection:
+                        results.append(self.rgbaColorCorrector.getNextCorrectedTexture())
+                    else:
+                        results.append(outputTextures[index])
+                # Blend the results with the original pixels by the selection mask
+                if selectionRegion and results:
+                    for index in range(len(results)):
+                        self.selectionHelper.blendTexture(ctx, results[index], outputData[index])
+                    self.selectionHelper.renderBlendIfNeeded(ctx)
+                    results = [self.selectionHelper.getNextBlendedTexture() for texture in results]
                 # Copy data from output buffers to nodes
-                for index in range(len(self.mapWindow.outputTextureMapItems)):
-                    output = self.mapWindow.outputTextureMapItems[index]
-                    if output.layerId == "<>":
-                        # Put the result into a new node
-                        # TODO: If output color format differs from document, this new node's color format needs to be changed to match
+                for index in range(len(plan.outputs)):
+                    planItem = plan.outputs[index]
+                    if planItem.isNewLayer:
+                        # Put the result into a new node, the result is always in the document's format
                         node = doc.createNode(f"Render Result {index}", "paintlayer")
                         newNodes.append(node)
                     else:
-                        node = doc.nodeByUniqueID(QUuid(output.layerId))
-                    # If this output needed color channel correction, use the corrected texture
-                    textureToUse = outputTextures[index] if not (self.rgbaCorrectCheck.isChecked() and self.rgbaColorCorrector.nodeNeedsCorrection(node)) else self.rgbaColorCorrector.getNextCorrectedTexture()
-                    node.setPixelData(textureToUse.read(), 0, 0, doc.width(), doc.height())
+                        node = planItem.node
+                    cropped = cropNewLayers and planItem.isNewLayer
+                    # The whole result is only read back when all of it is written or it has to be cached
+                    # Cropped layers are cached as the part that was written, so a reused result is cropped the same way
+                    data = results[index].read() if not cropped and (cacheKey or not (tileDiff or progressive)) else None
+                    if cropped:
+                        bounds = self.reductionHelper.findBounds(ctx, results[index])
+                        spans = [bounds] if bounds else []
+                        if bounds:
+                            notes.append(f"Result {index}: new layer cropped to x {bounds[0] + x}, y {bounds[1] + y}, width {bounds[2]}, height {bounds[3]}")
+                        else:
+                            notes.append(f"Result {index}: fully transparent, the new layer was left empty")
+                    elif tileDiff:
+                        original = None if planItem.isNewLayer else plan.fetchPixelData(planItem, x, y, width, height)
+                        spans = self.tileDiffHelper.findChangedSpans(ctx, results[index], original)
+                    else:
+                        spans = [(0, 0, width, height)]
+                    if progressive:
+                        # Written tile by tile after the run is cleaned up
+                        self.progressiveHelper.add(ctx, node, results[index], spans)
+                    else:
+                        for spanX, spanY, spanWidth, spanHeight, spanData in self.tileDiffHelper.readSpans(ctx, results[index], spans, data):
+                            node.setPixelData(spanData, x + spanX, y + spanY, spanWidth, spanHeight)
+                            if cropped and cacheKey:
+                                cachedResults.append((index, planItem.isNewLayer, spanData, (spanX, spanY, spanWidth, spanHeight)))
+                    if cropped and cacheKey and not spans:
+                        cachedResults.append((index, planItem.isNewLayer, b"", (0, 0, 0, 0)))
+                    if data is not None:
+                        cachedResults.append((index, planItem.isNewLayer, data, (0, 0, width, height)))
+                if self.tileDiffHelper.totalTiles:
+                    notes.append(self.tileDiffHelper.describe())
                 self.errBox.setPlainText("")
             except Exception as e:
                 self.errBox.setPlainText(str(e))
+                cacheKey = None
+                failed = True
             # Cleanup
             for i in inputTextures:
                 i.release()
@@ -287,39 +617,88 @@ If you notice issues with the order of red and blue color channels, try toggling
                 o.release()
             outFrameBuffer.release()
             vao.release()
-            program.release()
             self.rgbaColorCorrector.cleanUp()
+            self.vertexBufferHelper.cleanUp()
+            self.geometryHelper.cleanUp()
+            self.selectionHelper.cleanUp()
+            self.formatConverter.cleanUp()
+            self.tileDiffHelper.cleanUp()
+            self.reductionHelper.cleanUp()
         # Exit the context scope before adding new nodes
         for newNode in newNodes:
-            doc.activeNode().parentNode().addChildNode(newNode, doc.activeNode())
+            plan.getActiveNode(doc).parentNode().addChildNode(newNode, plan.getActiveNode(doc))
         doc.refreshProjection()
+        if self.progressiveHelper.jobs:
+            notes.append(self.progressiveHelper.write(self.ext.ctx, doc, (x, y, width, height), self))
+        plan.clearPixelData()
+        if cacheKey and cachedResults:
+            self.ext.getResultCache().put(cacheKey, cachedResults)
+        self.runTimes[halfFloat] = time.perf_counter() - startTime
+        if halfFloat:
+            notes.append(MemoryEstimator.describeHalfFloatSavings(
+                MemoryEstimator.estimateRender(plan, width, height, rgbaFix, selectionRegion, True),
+                MemoryEstimator.estimateRender(plan, width, height, rgbaFix, selectionRegion, False),
+                self.runTimes[True],
+                self.runTimes.get(False)))
+        # Only show notes about the run if it did not fail
+        if notes and not self.errBox.toPlainText():
+            self.errBox.setPlainText("\n".join(notes))
         self.saveSettings()
+        return not failed
 
-    def getColorComponentsAndType(self, node):
-        # Helper function to get the number of components and data type from a node
-        colorModel = node.colorModel()
-        # Number of components is the number of capitals in the color model, unless GRAYA
-        if colorModel == "GRAYA":
-            components = 2
-        else:
-            components = sum(1 for c in colorModel if c.isupper())
-        colorDepth = node.colorDepth()
-        colorDepth = colorDepth[0].lower() + str(int(colorDepth[1:]) // 8)
-        return components, colorDepth
+    def getCacheKey(self, doc, plan, rgbaFix, halfFloat, geometry, selectionRegion, region):
+        # Everything that decides the result of a run, with the content of the layers and files it reads
+        x, y, width, height = region
+        readOutputs = [planItem for planItem in plan.outputs if not planItem.isNewLayer and (not planItem.item.overwrite or selectionRegion)]
+        return ResultCache.makeKey([
+            "render",
+            self.vertBox.toPlainText(),
+            self.fragBox.toPlainText(),
+            [self.vertNumber.text(), self.vertMode.currentIndex(), self.instanceNumber.text()],
+            [self.geomBox.toPlainText(), self.geometryGroupsX.text(), self.geometryGroupsY.text(), self.geometrySize.text(), self.geometryLayout.text(), self.geometryAttributes.text()] if geometry else None,
+            rgbaFix,
+            halfFloat,
+            self.cropCheck.isChecked(),
+            [doc.colorModel(), doc.colorDepth()],
+            region,
+            ResultCache.fingerprint(doc.selection().pixelData(x, y, width, height)) if selectionRegion else None,
+            str([planItem.item for planItem in plan.inputs]),
+            str([planItem.item for planItem in plan.outputs]),
+            str(plan.vertexBuffers),
+            [ResultCache.fingerprintFile(item.sourceFile) for item in plan.vertexBuffers if not item.layerId],
+            ResultCache.fingerprintLayers(plan, plan.inputs, x, y, width, height),
+            ResultCache.fingerprintLayers(plan, readOutputs, x, y, width, height),
+            ResultCache.fingerprintLayers(plan, list(plan.vertexLayers.values()), x, y, width, height)])
 
     def showHelp(self):
         self.helpWindow.setText("Krita ModernGL Render Shader Programming")
         self.helpWindow.setInformativeText("""This tool is designed for running GLSL vertex and fragment shaders inside of Krita and rendering their output to a new layer in the current document. If you would like to learn more, https://learnopengl.com has good tutorials. Here are some more useful bits of info:
 
-   > No vertices are fed into the vertex shader from the program, you will need to define your own vertices inside the shader to render.
-   > Use the text box above the vertex shader to specify how many vertices are to be processed.
+   > Without vertex buffers, no vertices are fed into the vertex shader from the program, you will need to define your own vertices inside the shader to render.
+   > Vertex and instance buffers can be added in Map Buffers, from .csv, .npy or raw files or from a layer, and are fed to the vertex shader inputs named there.
+   > Use the text box above the vertex shader to specify how many vertices are to be processed, -1 uses the number in the vertex buffers.
+   > Instances draws the vertices that many times in one draw call, gl_InstanceID tells them apart. -1 uses the number of elements in the per instance buffers, or 1.
    > Change the primitive draw mode using the selection box next to the box to specify the number of vertices.
    > Input and output textures can be configured using the Map Buffers button.
    > By default, the active layer is the input, and the output will be added to a new layer above the active layer.
+   > A Layer Array pattern on an input packs every layer whose name matches it into one read only sampler2DArray, a slice per layer from the top of the Layers docker.
+   > Each input and output can use a F16 or F32 working format, integer layers are then normalized to 0.0-1.0 floats and converted back on the GPU, with optional dithering.
+   > F16 intermediates stores input textures and frame buffer targets of 32 bit float layers as 16 bit floats on the GPU, and shows the memory and time saved.
+   > Before a run, the GPU memory needed is estimated and checked against the VRAM budget, or the free video memory if the driver reports it and the budget is 0.
+   > Limit to selection only renders the bounding box of the active selection, textures and the frame buffer are the size of that box and the result is blended by the selection. Declare uniform ivec2 region_offset; to get the position of the box.
+   > Generate geometry with a compute shader runs a compute shader first that writes vertices to `layout(std430, binding = 0) buffer` and the draw command { uint count; uint instanceCount; uint first; uint baseInstance; } to binding 1. The command starts at 0 vertices and 1 instance, add to count with atomicAdd as vertices are written.
+   > The generated vertices are drawn with an indirect draw using the Layout and Attribute Names set for them, nothing is read back except the frame buffer. Mapped input textures can be sampled in the compute shader too.
+   > Mapped inputs the shaders do not use are skipped with a warning, so their layers are not fetched or uploaded. Samplers the shaders use without a mapping are flagged too.
+   > Reuse results of identical runs keeps results in memory and on disk (256 MiB and 1 GiB by default, set mgl_cache_memory and mgl_cache_disk in MiB in krita-scripterrc), and writes them straight to the layers when the shaders, settings, mapping, layer content, and vertex buffer files match an earlier run.
+   > The shaders, and the geometry compute shader while it is enabled, are compiled a moment after you stop typing. Errors appear below with their lines marked in red, and the compiled program is kept, so Run only has the layers left to upload, process, and write back.
+   > Batch over layers runs the shader once for each selected layer, each layer whose name matches a pattern with * and ? wildcards, or each layer of a type such as paintlayer, with that layer in place of the active layer in the mapping. The shader is compiled once for the batch.
+   > Write back progressively writes the outputs in tiles from the centre of the view outward and refreshes the canvas as it goes, the write back can be cancelled and keeps the tiles already written.
+   > Crop new layers to their content only reads back and writes the bounding box of the pixels that are not transparent in outputs going to new layers.
+   > Only write back changed tiles compares the outputs with the layers on the GPU and only writes the 64x64 tiles that changed, keeping undo steps small for local effects.
    > Varyings output from the vertex shader can be used as inputs to the fragment shader.
    > Fix RGBA color channel order option will try to ensure colors are in the correct channels, else red and blue could be swapped.
    > There is no syntax highlighting, it is advisable you use some other editor to make the shaders.
-   > Shader files can be saved and loaded using Save and Open, selecting a vertex shader first then a fragment shader.""")
+   > Shader files can be saved and loaded using Save and Open, selecting a vertex shader first then a fragment shader, then a compute shader if geometry is generated.""")
         self.helpWindow.open()
 
     def openFile(self):
@@ -343,6 +722,17 @@ If you notice issues with the order of red and blue color channels, try toggling
         if file[0]:
             with open(file[0], 'r') as ff:
                 self.fragBox.setPlainText(ff.read())
+        if not self.geometryCheck.isChecked():
+            return
+        # Open a file selection dialog for the geometry compute shader
+        file = QFileDialog.getOpenFileName(
+            self,
+            "Select a file to open",
+            Krita.getAppDataLocation() + "/pykrita/kritamoderngl",
+            "Compute Shaders (*.comp)")
+        if file[0]:
+            with open(file[0], 'r') as cf:
+                self.geomBox.setPlainText(cf.read())
 
     def saveFile(self):
         # This will also open two dialogs to save the two different shaders
@@ -365,13 +755,32 @@ If you notice issues with the order of red and blue color channels, try toggling
         if file[0]:
             with open(file[0], 'w') as ff:
                 ff.write(self.fragBox.toPlainText())
+        if not self.geometryCheck.isChecked():
+            return
+        # Open a file save dialog for the geometry compute shader
+        file = QFileDialog.getSaveFileName(
+            self,
+            "Save File",
+            Krita.getAppDataLocation() + "/pykrita/kritamoderngl",
+            "Compute Shaders (*.comp)")
+        if file[0]:
+            with open(file[0], 'w') as cf:
+                cf.write(self.geomBox.toPlainText())
+
+    def releasePrograms(self):
+        # Programs kept by the compile helper belong to this dialog, a new one is made each time the tool is opened
+        if self.ext.ctx:
+            with self.ext.ctx:
+                self.compileHelper.cleanUp()
 
     def saveAndReject(self):
         self.saveSettings()
+        self.releasePrograms()
         self.reject()
 
     def closeEvent(self, event):
         self.saveSettings()
+        self.releasePrograms()
         event.accept()
 
     def saveSettings(self):
@@ -383,7 +792,25 @@ If you notice issues with the order of red and blue color channels, try toggling
         self.ext.settings.setValue("mgl_geometry", rect)
         self.ext.settings.setValue("mgl_vert_number", self.vertNumber.text())
         self.ext.settings.setValue("mgl_vert_mode", self.vertMode.currentIndex())
+        self.ext.settings.setValue("mgl_vert_instances", self.instanceNumber.text())
         self.ext.settings.setValue("mgl_frag_rgba_fix", self.rgbaCorrectCheck.isChecked())
+        self.ext.settings.setValue("mgl_frag_selection", self.selectionCheck.isChecked())
+        self.ext.settings.setValue("mgl_frag_cache", self.cacheCheck.isChecked())
+        self.ext.settings.setValue("mgl_frag_tile_diff", self.tileDiffCheck.isChecked())
+        self.ext.settings.setValue("mgl_frag_crop_new", self.cropCheck.isChecked())
+        self.ext.settings.setValue("mgl_frag_progressive", self.progressiveCheck.isChecked())
+        self.ext.settings.setValue("mgl_frag_batch_mode", self.batchCombo.currentData())
+        self.ext.settings.setValue("mgl_frag_batch_pattern", self.batchEdit.text())
+        self.ext.settings.setValue("mgl_frag_half_float", self.halfFloatCheck.isChecked())
+        self.ext.settings.setValue("mgl_vram_budget", self.budgetEdit.text())
+        self.ext.settings.setValue("mgl_geom_enabled", self.geometryCheck.isChecked())
+        self.ext.settings.setValue("mgl_geom_groups_x", self.geometryGroupsX.text())
+        self.ext.settings.setValue("mgl_geom_groups_y", self.geometryGroupsY.text())
+        self.ext.settings.setValue("mgl_geom_vertex_size", self.geometrySize.text())
+        self.ext.settings.setValue("mgl_geom_layout", self.geometryLayout.text())
+        self.ext.settings.setValue("mgl_geom_attributes", self.geometryAttributes.text())
+        if self.geomBox.toPlainText() != "":
+            self.ext.settings.setValue("mgl_geom_shader", self.geomBox.toPlainText())
         if self.vertBox.toPlainText() != "":
             self.ext.settings.setValue("mgl_vert_shader", self.vertBox.toPlainText())
         if self.fragBox.toPlainText() != "":
@@ -395,6 +822,23 @@ If you notice issues with the order of red and blue color channels, try toggling
         self.setGeometry(self.readGeometry)
         self.vertNumber.setText(self.ext.settings.value("mgl_vert_number", "-1"))
         self.vertMode.setCurrentIndex(int(self.ext.settings.value("mgl_vert_mode", "4")))
+        self.instanceNumber.setText(self.ext.settings.value("mgl_vert_instances", "-1"))
         self.rgbaCorrectCheck.setChecked(self.ext.settings.value("mgl_frag_rgba_fix", "true") == "true")
+        self.selectionCheck.setChecked(self.ext.settings.value("mgl_frag_selection", "false") == "true")
+        self.cacheCheck.setChecked(self.ext.settings.value("mgl_frag_cache", "false") == "true")
+        self.tileDiffCheck.setChecked(self.ext.settings.value("mgl_frag_tile_diff", "false") == "true")
+        self.cropCheck.setChecked(self.ext.settings.value("mgl_frag_crop_new", "false") == "true")
+        self.progressiveCheck.setChecked(self.ext.settings.value("mgl_frag_progressive", "false") == "true")
+        self.batchCombo.setCurrentIndex(max(0, self.batchCombo.findData(self.ext.settings.value("mgl_frag_batch_mode", ""))))
+        self.batchEdit.setText(self.ext.settings.value("mgl_frag_batch_pattern", ""))
+        self.halfFloatCheck.setChecked(self.ext.settings.value("mgl_frag_half_float", "false") == "true")
+        self.budgetEdit.setText(self.ext.settings.value("mgl_vram_budget", "0"))
+        self.geometryCheck.setChecked(self.ext.settings.value("mgl_geom_enabled", "false") == "true")
+        self.geometryGroupsX.setText(self.ext.settings.value("mgl_geom_groups_x", "(width + 15) // 16"))
+        self.geometryGroupsY.setText(self.ext.settings.value("mgl_geom_groups_y", "(height + 15) // 16"))
+        self.geometrySize.setText(self.ext.settings.value("mgl_geom_vertex_size", "width * height * 16"))
+        self.geometryLayout.setText(self.ext.settings.value("mgl_geom_layout", "4f"))
+        self.geometryAttributes.setText(self.ext.settings.value("mgl_geom_attributes", "in_position"))
+        self.geomBox.setPlainText(self.ext.settings.value("mgl_geom_shader", ""))
         self.vertBox.setPlainText(self.ext.settings.value("mgl_vert_shader", ""))
         self.fragBox.setPlainText(self.ext.settings.value("mgl_frag_shader", ""))
\ No newline at end of file
@@ -0,0 +1,169 @@
+"""
+Class to help reusing the results of identical runs instead of computing them again
+
+A run is identified by a key hashed from everything that decides its output: the shader sources, the dialog's
+settings, the mapping, the processed region and selection, and a fingerprint of the content of every layer the run
+reads. When a run with the same key was done before, its outputs are written straight to the target layers and the
+shaders are not compiled, no textures are uploaded, and nothing is dispatched.
+
+Results are kept in memory and on disk, each bounded by a number of bytes. When a limit is reached the least recently
+used results are evicted first, so toggling between a few shader variants keeps all of them cached. On disk the
+modification time of each file records when it was last used.
+
+Layers still have to be fetched to fingerprint them, so a hit saves the GPU work and the upload but not the fetch. The
+fetched data is kept in the execution plan for the run, so a miss does not fetch the layers a second time.
+"""
+import hashlib
+import json
+import os
+import struct
+from collections import OrderedDict
+
+# Default limits in MiB, these can be changed with mgl_cache_memory and mgl_cache_disk in krita-scripterrc
+defaultMemoryLimit = 256
+defaultDiskLimit = 1024
+
+# Hash some data to a short hex string
+def fingerprint(data):
+    return hashlib.blake2b(bytes(data), digest_size=16).hexdigest()
+
+# Fingerprint a file by its path, size, and modification time, so large files are not read to build the key
+def fingerprintFile(path):
+    if not path or not os.path.isfile(path):
+        return [path, None]
+    return [path, os.path.getsize(path), os.path.getmtime(path)]
+
+# Fingerprint the content and format of the layers a run reads, fetching them through the plan so a miss can reuse them
+def fingerprintLayers(plan, planItems, x, y, width, height):
+    return [[planItem.index, planItem.components, planItem.colorType, fingerprint(plan.fetchPixelData(planItem, x, y, width, height))] for planItem in planItems]
+
+# Build a cache key from a list of JSON serializable parts
+def makeKey(parts):
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True, default=str).encode("utf-8"), digest_size=20).hexdigest()
+
+# Pack a list of (index, isNewLayer, data, bounds) outputs into bytes for the disk cache
+# bounds is the (x, y, width, height) of the data in the processed region, new layers cropped to nothing have no data
+def packResults(results):
+    packed = [struct.pack("<I", len(results))]
+    for index, isNewLayer, data, bounds in results:
+        packed.append(struct.pack("<I?Q4I", index, isNewLayer, len(data), *bounds))
+        packed.append(bytes(data))
+    return b"".join(packed)
+
+# Unpack bytes written by packResults
+def unpackResults(packed):
+    count = struct.unpack_from("<I", packed, 0)[0]
+    offset = 4
+    headerSize = struct.calcsize("<I?Q4I")
+    results = []
+    for i in range(count):
+        index, isNewLayer, length, *bounds = struct.unpack_from("<I?Q4I", packed, offset)
+        offset += headerSize
+        results.append((index, isNewLayer, packed[offset:offset + length], tuple(bounds)))
+        offset += length
+    return results
+
+# Write cached results to the layers of the plan items they were made for, returns the new layers to add to the document
+def writeResults(doc, planItems, results, x, y, width, height):
+    newNodes = []
+    for index, isNewLayer, data, (dataX, dataY, dataWidth, dataHeight) in results:
+        planItem = planItems[index]
+        if planItem.isNewLayer:
+            node = doc.createNode(f"Render Result {index}", "paintlayer")
+            newNodes.append(node)
+        else:
+            node = planItem.node
+        if dataWidth and dataHeight:
+            node.setPixelData(data, x + dataX, y + dataY, dataWidth, dataHeight)
+    return newNodes
+
+class ResultCache:
+    directory = ""
+    memoryLimit = 0
+    diskLimit = 0
+    entries = OrderedDict()
+    memoryBytes = 0
+
+    def __init__(self, directory, memoryLimit=defaultMemoryLimit, diskLimit=defaultDiskLimit):
+        self.directory = directory
+        self.memoryLimit = memoryLimit * 1024 * 1024
+        self.diskLimit = diskLimit * 1024 * 1024
+        # Results by key, ordered from least to most recently used
+        self.entries = OrderedDict()
+        self.memoryBytes = 0
+
+    def entryBytes(self, results):
+        return sum(len(data) for index, isNewLayer, data, bounds in results)
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    # Get the results stored for a key as a list of (index, isNewLayer, data, bounds), or None if there are none
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        path = self.getPath(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                results = unpackResults(f.read())
+            # Mark the file as recently used
+            os.utime(path)
+        except (OSError, struct.error):
+            return None
+        self.putMemory(key, results)
+        return results
+
+    # Store the results of a run, results larger than a limit are not kept at that level
+    def put(self, key, results):
+        self.putMemory(key, results)
+        self.putDisk(key, results)
+
+    def putMemory(self, key, results):
+        size = self.entryBytes(results)
+        if size > self.memoryLimit:
+            return
+        if key in self.entries:
+            self.memoryBytes -= self.entryBytes(self.entries.pop(key))
+        self.entries[key] = results
+        self.memoryBytes += size
+        while self.memoryBytes > self.memoryLimit:
+            oldKey, oldResults = self.entries.popitem(last=False)
+            self.memoryBytes -= self.entryBytes(oldResults)
+
+    def putDisk(self, key, results):
+        if self.entryBytes(results) > self.diskLimit:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.getPath(key), "wb") as f:
+                f.write(packResults(results))
+            self.evictDisk()
+        except OSError:
+            # The disk cache is optional, the memory cache still works without it
+            pass
+
+    def evictDisk(self):
+        # Remove the least recently used files until the directory fits in the limit
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".bin"):
+                path = os.path.join(self.directory, name)
+                files.append((os.path.getmtime(path), os.path.getsize(path), path))
+        total = sum(size for time, size, path in files)
+        for time, size, path in sorted(files):
+            if total <= self.diskLimit:
+                break
+            os.remove(path)
+            total -= size
+
+    # Forget all results in memory and on disk
+    def clear(self):
+        self.entries = OrderedDict()
+        self.memoryBytes = 0
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(".bin"):
+                    os.remove(os.path.join(self.directory, name))
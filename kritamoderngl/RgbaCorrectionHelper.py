@@ -29,6 +29,22 @@ void main() {
     gl_Position = vec4(vertices[gl_VertexID], 1.0);
 }"""
 
+# Check if this Krita node (or document) needs blue and red channels swapped
+def nodeNeedsCorrection(node):
+    return (node and node.colorDepth()[0] == "U" and node.colorModel() == "RGBA")
+
+# Swap the red and blue channels of 8 or 16 bit pixel data on the CPU
+# Used for pixels uploaded into an output that the correction pass will swap back after rendering
+def swapRedBlue(data, colorType):
+    data = bytes(data)
+    size = 1 if colorType == "u1" else 2
+    stride = 4 * size
+    swapped = bytearray(data)
+    for offset in range(size):
+        swapped[offset::stride] = data[2 * size + offset::stride]
+        swapped[2 * size + offset::stride] = data[offset::stride]
+    return bytes(swapped)
+
 class RgbaCorrectionHelper:
     texturesToReplace = []
     correctedTextures = []
@@ -45,18 +61,26 @@ class RgbaCorrectionHelper:
 
     # Check if this Krita node needs blue and red channels swapped
     def nodeNeedsCorrection(self, node):
-        return (node and node.colorDepth()[0] == "U" and node.colorModel() == "RGBA")
+        return nodeNeedsCorrection(node)
 
     # If node needs correction, apply swizzle to texture, only works on inputs
     def swizzleTextureIfNeeded(self, node, texture):
         if self.nodeNeedsCorrection(node):
-            texture.swizzle = "BGRA"
+            self.swizzleTexture(texture)
+
+    # Apply swizzle to a texture already known to need correction
+    def swizzleTexture(self, texture):
+        texture.swizzle = "BGRA"
 
     # If node needs correction, save a reference to the texture to use later
     def fixTextureIfNeeded(self, node, texture):
-        # This will simply track the texture until it is time to build the correction shader
         if self.nodeNeedsCorrection(node):
-            self.texturesToReplace.append(texture)
+            self.fixTexture(texture)
+
+    # Save a reference to a texture already known to need correction
+    def fixTexture(self, texture):
+        # This will simply track the texture until it is time to build the correction shader
+        self.texturesToReplace.append(texture)
 
     # If any textures are saved, then the correction pass needs to happen
     def correctionPassNeeded(self):
@@ -92,9 +116,9 @@ class RgbaCorrectionHelper:
                 t.release()
             self.frameBuffer.release()
             self.correctedTextures = []
-        colorDepth = doc.colorDepth()[0].lower() + str(int(doc.colorDepth()[1:]) // 8)
-        for i in range(len(self.texturesToReplace)):
-            self.correctedTextures.append(ctx.texture((doc.width(), doc.height()), 4, dtype=colorDepth))
+        # Match each texture being corrected, which may be a region of the document or a layer in another color depth
+        for texture in self.texturesToReplace:
+            self.correctedTextures.append(ctx.texture(texture.size, 4, dtype=texture.dtype))
         return ctx.framebuffer(self.correctedTextures)
 
     # Create the vertex array to use for rendering... the actual vertices are in the vertex shader
@@ -0,0 +1,131 @@
+"""
+Class to help limiting shaders to the active selection of a document
+
+Only the bounding box of the selection is uploaded and processed, so the cost follows the size of the selection
+instead of the size of the canvas. The selection mask for that box is uploaded as an extra texture, and after the
+user's shader (and RGBA correction) each output is blended with the original pixels by the mask in one more render
+pass, so partially selected pixels are mixed the same way Krita's own filters do. The blended result is then written
+back with a single setPixelData call limited to the box.
+
+Blending is done on the data in the order it is stored, so it works the same with or without RGBA correction.
+"""
+from . import RgbaCorrectionHelper
+
+# Get the bounding box of the document's selection clipped to the document, as (x, y, width, height)
+# Returns None when there is no selection, and an empty box when the selection is outside the document
+def getSelectionRegion(doc):
+    selection = doc.selection()
+    if not selection or selection.width() <= 0 or selection.height() <= 0:
+        return None
+    left = max(0, selection.x())
+    top = max(0, selection.y())
+    right = min(doc.width(), selection.x() + selection.width())
+    bottom = min(doc.height(), selection.y() + selection.height())
+    return (left, top, max(0, right - left), max(0, bottom - top))
+
+class SelectionHelper:
+    maskTexture = None
+    texturesToBlend = []
+    originalTextures = []
+    blendedTextures = []
+    frameBuffer = None
+    program = None
+    vao = None
+
+    def __init__(self):
+        self.maskTexture = None
+        self.texturesToBlend = []
+        self.originalTextures = []
+        self.blendedTextures = []
+        self.frameBuffer = None
+        self.program = None
+        self.vao = None
+
+    # Upload the selection mask of the region, one normalized byte per pixel
+    def createMask(self, ctx, doc, region):
+        x, y, width, height = region
+        self.maskTexture = ctx.texture((width, height), 1, data=doc.selection().pixelData(x, y, width, height), dtype="f1")
+
+    # Save a result texture to blend with the original pixel data, None means the original is transparent
+    def blendTexture(self, ctx, texture, originalData):
+        self.texturesToBlend.append(texture)
+        if originalData is None:
+            self.originalTextures.append(None)
+        else:
+            self.originalTextures.append(ctx.texture(texture.size, texture.components, data=originalData, dtype=texture.dtype))
+
+    # Create a shader using the saved textures, integer formats are mixed as floats and rounded back
+    def generateFragmentShader(self):
+        fragShader = "#version 330 core\n\nuniform sampler2D mask;\n"
+        for i in range(len(self.texturesToBlend)):
+            prefix = "" if self.texturesToBlend[i].dtype[0] == "f" else "u"
+            fragShader += f"uniform {prefix}sampler2D result{i};\n"
+            if self.originalTextures[i]:
+                fragShader += f"uniform {prefix}sampler2D original{i};\n"
+            fragShader += f"layout(location = {i}) out {prefix}vec4 out_color{i};\n"
+        fragShader += "void main() {\n    ivec2 pos = ivec2(gl_FragCoord.xy);\n    float amount = texelFetch(mask, pos, 0).r;\n"
+        for i in range(len(self.texturesToBlend)):
+            original = f"vec4(texelFetch(original{i}, pos, 0))" if self.originalTextures[i] else "vec4(0.0)"
+            blended = f"mix({original}, vec4(texelFetch(result{i}, pos, 0)), amount)"
+            if self.texturesToBlend[i].dtype[0] == "f":
+                fragShader += f"\n    out_color{i} = {blended};"
+            else:
+                fragShader += f"\n    out_color{i} = uvec4(round({blended}));"
+        fragShader += "\n}"
+        return fragShader
+
+    # Binds the mask and saved textures to be used as input for the blend shader
+    def bindTextures(self, program):
+        location = 0
+        self.maskTexture.use(location=location)
+        program["mask"] = location
+        for i in range(len(self.texturesToBlend)):
+            location += 1
+            self.texturesToBlend[i].use(location=location)
+            program[f"result{i}"] = location
+            if self.originalTextures[i]:
+                location += 1
+                self.originalTextures[i].use(location=location)
+                program[f"original{i}"] = location
+
+    # Perform the rendering operation to blend the results with the originals
+    def renderBlendIfNeeded(self, ctx):
+        if not self.texturesToBlend:
+            return
+        self.program = ctx.program(vertex_shader=RgbaCorrectionHelper.vertexShader, fragment_shader=self.generateFragmentShader())
+        self.bindTextures(self.program)
+        for texture in self.texturesToBlend:
+            self.blendedTextures.append(ctx.texture(texture.size, texture.components, dtype=texture.dtype))
+        self.frameBuffer = ctx.framebuffer(self.blendedTextures)
+        self.frameBuffer.use()
+        self.vao = ctx.vertex_array(self.program, [])
+        self.vao.vertices = 6
+        self.vao.mode = ctx.TRIANGLES
+        ctx.clear()
+        self.vao.render()
+        ctx.finish()
+        self.texturesToBlend = []
+
+    # This will iterate over the blended textures to return them in the order they were saved
+    def getNextBlendedTexture(self):
+        self.blendedTextures = self.blendedTextures[1:] + self.blendedTextures[:1]
+        return self.blendedTextures[-1]
+
+    # Clean up all OGL objects created, the textures to blend belong to the parent
+    def cleanUp(self):
+        for tex in self.originalTextures + self.blendedTextures + [self.maskTexture]:
+            if tex:
+                tex.release()
+        self.originalTextures = []
+        self.blendedTextures = []
+        self.texturesToBlend = []
+        self.maskTexture = None
+        if self.frameBuffer:
+            self.frameBuffer.release()
+        if self.program:
+            self.program.release()
+        if self.vao:
+            self.vao.release()
+        self.frameBuffer = None
+        self.program = None
+        self.vao = None
@@ -0,0 +1,147 @@
+"""
+Class to help compiling the shaders of a dialog while they are edited, and keeping the compiled programs for runs
+
+A short time after the last edit, the shaders are compiled on the plugin's own context from Qt's event loop, so
+errors show up while typing instead of after pressing Run. Errors are shown in the dialog's error box, and the lines
+they point to are marked in the text boxes. Compiled programs are kept by their sources, so a run with unchanged
+shaders takes the program from the cache and only does the data work. Sources that failed keep their error, so
+pressing Run on them shows it again without compiling.
+
+Drivers word their logs differently, lines are found from the common forms:
+    0:12(5): error: ...    Mesa
+    0(12) : error C0000    NVIDIA
+    ERROR: 0:12: ...       AMD and Intel
+"""
+import re
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QColor, QTextCursor, QTextFormat
+from PyQt5.QtWidgets import QTextEdit
+
+# Milliseconds after the last edit before the shaders are compiled
+idleDelay = 750
+
+# Programs and errors kept by their sources, the oldest are dropped first
+maxEntries = 8
+
+# ModernGL puts the name of the stage above each compiler log
+stageNames = ["vertex_shader", "fragment_shader", "geometry_shader", "compute_shader"]
+errorLinePattern = re.compile(r"^\s*(?:ERROR:\s*|WARNING:\s*)?\d+[:(](\d+)[):(]", re.I)
+
+# Find the lines errors point to for each stage, as a dict of stage name to line numbers starting at 1
+# Logs without a stage name belong to defaultStage
+def findErrorLines(error, defaultStage=None):
+    lines = {}
+    stage = defaultStage
+    for line in error.splitlines():
+        if line.strip() in stageNames:
+            stage = line.strip()
+            continue
+        match = errorLinePattern.match(line)
+        if match and stage:
+            lines.setdefault(stage, set()).add(int(match.group(1)))
+    return lines
+
+# Release what a build returned, a program or a tuple of programs where unused ones are None
+def releaseCompiled(compiled):
+    for program in compiled if isinstance(compiled, tuple) else (compiled,):
+        if program:
+            program.release()
+
+class ShaderCompileHelper:
+    boxes = {}
+    entries = {}
+    ctx = None
+    showingError = False
+
+    # boxes is a dict of stage name to text box, getSources returns the sources to build from the boxes as a tuple
+    # build is called with the context and the sources and returns the compiled program, or a tuple of them
+    def __init__(self, extension, boxes, getSources, build, errBox, parent):
+        self.ext = extension
+        self.boxes = boxes
+        self.getSources = getSources
+        self.build = build
+        self.errBox = errBox
+        self.entries = {}
+        self.ctx = None
+        self.showingError = False
+        self.timer = QTimer(parent)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.compileNow)
+        for box in boxes.values():
+            box.textChanged.connect(self.schedule)
+
+    # Compile once the shaders have not been edited for a moment
+    def schedule(self):
+        self.timer.start(idleDelay)
+
+    # Compile the shaders as they are in the boxes, the program is kept for the next run
+    def compileNow(self):
+        if not self.ext.ctx:
+            return
+        try:
+            sources = self.getSources()
+        except Exception as e:
+            self.showResult(str(e))
+            return
+        with self.ext.ctx as ctx:
+            try:
+                self.getProgram(ctx, sources)
+            except Exception:
+                # Already shown in the error box
+                pass
+
+    # Get the program for the sources from the cache or compile it, raises the compile error if there is one
+    # Programs belong to the cache, must be called in the context's scope
+    def getProgram(self, ctx, sources):
+        # A new context from the backend settings released every program of the old one
+        if ctx is not self.ctx:
+            self.entries = {}
+            self.ctx = ctx
+        if sources not in self.entries:
+            try:
+                self.entries[sources] = (self.build(ctx, *sources), None)
+            except Exception as e:
+                self.entries[sources] = (None, str(e))
+            self.dropOldest()
+        program, error = self.entries[sources]
+        self.showResult(error)
+        if error:
+            raise Exception(error)
+        return program
+
+    # Release the oldest programs when there are more than maxEntries
+    def dropOldest(self):
+        while len(self.entries) > maxEntries:
+            program, error = self.entries.pop(next(iter(self.entries)))
+            releaseCompiled(program)
+
+    # Show a compile error in the error box and mark its lines, None clears the marks
+    def showResult(self, error):
+        defaultStage = next(iter(self.boxes)) if len(self.boxes) == 1 else None
+        errorLines = findErrorLines(error, defaultStage) if error else {}
+        for stage, box in self.boxes.items():
+            selections = []
+            for line in sorted(errorLines.get(stage, [])):
+                block = box.document().findBlockByNumber(line - 1)
+                if not block.isValid():
+                    continue
+                selection = QTextEdit.ExtraSelection()
+                selection.format.setBackground(QColor(255, 0, 0, 64))
+                selection.format.setProperty(QTextFormat.FullWidthSelection, True)
+                selection.cursor = QTextCursor(block)
+                selections.append(selection)
+            box.setExtraSelections(selections)
+        if error:
+            self.errBox.setPlainText(error)
+        elif self.showingError:
+            self.errBox.setPlainText("Shaders compiled without errors.")
+        self.showingError = bool(error)
+
+    # Release all kept programs, must be called in the context's scope
+    def cleanUp(self):
+        self.timer.stop()
+        if self.ctx is self.ext.ctx:
+            for program, error in self.entries.values():
+                releaseCompiled(program)
+        self.entries = {}
+        self.ctx = None
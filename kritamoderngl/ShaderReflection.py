@@ -0,0 +1,73 @@
+"""
+Functions to find which texture and image units a compiled shader actually uses
+
+The mappings often keep rows for samplers and images that an edited shader no longer uses, and every row costs a
+layer fetch and an upload. The compiled program only reports the uniforms that are still active after the compiler
+removed unused code, but ModernGL does not say which of them are samplers or images or what unit they are bound to.
+So the declarations are read from the shader source for their kind and binding, and the program is asked which of
+them are active.
+
+Anything that cannot be decided is treated as used: named samplers are checked directly in the program, and units
+are only dropped by binding when the source declares samplers (or images) that could be found.
+"""
+import re
+
+commentPattern = re.compile(r"//[^\n]*|/\*.*?\*/", re.S)
+qualifiers = r"(?:(?:readonly|writeonly|coherent|volatile|restrict|highp|mediump|lowp)\s+)*"
+declarationPattern = re.compile(r"(?:layout\s*\(([^)]*)\)\s*)?" + qualifiers + r"uniform\s+" + qualifiers + r"([iu]?(sampler|image)\w*)\s+(\w+)")
+bindingPattern = re.compile(r"\bbinding\s*=\s*(\d+)")
+
+# A sampler or image declared in a shader, samplers and images without a binding use unit 0
+class ShaderBinding():
+    def __init__(self, name, kind, unit, active):
+        self.name = name
+        self.kind = kind
+        self.unit = unit
+        self.active = active
+
+# Check whether a uniform is active in a compiled program, arrays may be reported by their first element
+def isActive(program, name):
+    return program.get(name, None) is not None or program.get(name + "[0]", None) is not None
+
+# Find the samplers and images declared in the sources, program is the compiled program they are checked against
+# A program of None marks every declaration as active, for sources that are not compiled yet
+def findBindings(program, sources):
+    bindings = []
+    for source in sources:
+        for match in declarationPattern.finditer(commentPattern.sub("", source)):
+            layout, typeName, kind, name = match.groups()
+            binding = bindingPattern.search(layout) if layout else None
+            active = program is None or isActive(program, name)
+            bindings.append(ShaderBinding(name, kind, int(binding.group(1)) if binding else 0, active))
+    return bindings
+
+# Check whether a texture unit mapping is used, by its sampler name if it has one, else by the units the samplers use
+def textureUnitUsed(program, bindings, item):
+    if item.variableName:
+        return isActive(program, item.variableName) or any(binding.active and binding.name == item.variableName for binding in bindings)
+    samplers = [binding for binding in bindings if binding.kind == "sampler"]
+    if not samplers:
+        return True
+    return any(binding.active and binding.unit == item.index for binding in samplers)
+
+# Check whether an image unit mapping is used by the units the images are bound to
+def imageUnitUsed(bindings, item):
+    images = [binding for binding in bindings if binding.kind == "image"]
+    if not images:
+        return True
+    return any(binding.active and binding.unit == item.index for binding in images)
+
+# Describe the active samplers and images that have no mapping, returns a line for each
+def describeUnmapped(bindings, textureItems, imageItems):
+    messages = []
+    samplerNames = [item.variableName for item in textureItems if item.variableName]
+    samplerUnits = [item.index for item in textureItems if not item.variableName]
+    imageUnits = [item.index for item in imageItems]
+    for binding in bindings:
+        if not binding.active:
+            continue
+        if binding.kind == "sampler" and binding.name not in samplerNames and binding.unit not in samplerUnits:
+            messages.append(f"Warning: sampler {binding.name} (unit {binding.unit}) is used by the shader but has no texture unit mapped.")
+        elif binding.kind == "image" and binding.unit not in imageUnits:
+            messages.append(f"Warning: image {binding.name} (binding {binding.unit}) is used by the shader but has no image unit mapped.")
+    return messages
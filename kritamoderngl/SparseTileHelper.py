@@ -0,0 +1,213 @@
+"""
+Class to help running compute shaders only on the tiles of the region where the inputs have content
+
+Mostly transparent layers still cost an invocation per pixel when the shader is dispatched over the whole region. In
+sparse mode the region is split into tiles, a small compute pass marks every tile where an input has a pixel that is
+not transparent within the tile or a halo around it, and appends the tile to a list on the GPU. The same pass counts
+the workgroups to run in an indirect dispatch command, so the shader runs on the occupied tiles without reading
+anything back in between.
+
+The tile list is bound to storage binding 7 and these are added to the shader after its #version line:
+    ivec2 tile_origin()  the first pixel of the tile this workgroup works on, in the processed region
+    ivec2 tile_pixel()   the pixel of this invocation, to use instead of gl_GlobalInvocationID.xy
+    TILE_SIZE            the size of the tiles, a multiple of the local size close to 64 pixels
+Workgroups of a tile follow each other along x, and the tile is covered exactly, so each pixel is run once. Shaders
+without inputs to read, such as generators that only write, run on every tile.
+"""
+import re
+import struct
+from . import ShaderReflection
+
+# Storage binding of the tile list in the shader
+sparseBinding = 7
+
+# Tiles are the multiple of the local size that is closest to this size, in pixels
+targetTileSize = 64
+
+localSizePattern = re.compile(r"\blocal_size_([xy])\s*=\s*(\d+)")
+versionPattern = re.compile(r"^[ \t]*#version[^\n]*\n?", re.M)
+
+# Added to the shader after its #version line, #line keeps the line numbers of errors the same
+shaderHeader = """
+layout(std430, binding = {binding}) readonly buffer SparseTiles {{
+    uint sparse_command[3];
+    uint sparse_tile_count;
+    uint sparse_tiles[];
+}};
+const ivec2 TILE_SIZE = ivec2({tileX}, {tileY});
+ivec2 tile_origin() {{
+    uint tile = sparse_tiles[gl_WorkGroupID.x / {groupsX}u];
+    return ivec2(tile & 0xFFFFu, tile >> 16u) * TILE_SIZE;
+}}
+ivec2 tile_pixel() {{
+    return tile_origin() + ivec2(gl_WorkGroupID.x % {groupsX}u, gl_WorkGroupID.y) * ivec2({localX}, {localY}) + ivec2(gl_LocalInvocationID.xy);
+}}
+#line {line}
+"""
+
+# Marks each tile where the input has a pixel that is not transparent, one workgroup per tile
+occupancyShader = """#version 430
+
+layout(local_size_x = 16, local_size_y = 16) in;
+uniform {sampler} in_texture;
+uniform ivec2 tile_size;
+uniform int halo;
+uniform uint groups_x;
+layout(std430, binding = 0) buffer Tiles {{
+    uint command[3];
+    uint tile_count;
+    uint tiles[];
+}};
+layout(std430, binding = 1) buffer Flags {{
+    uint flags[];
+}};
+shared uint occupied;
+
+bool hasContent(int x, int y) {{
+{contentCheck}
+}}
+
+void main() {{
+    if (gl_LocalInvocationIndex == 0u) {{
+        occupied = 0u;
+    }}
+    barrier();
+    ivec2 size = textureSize(in_texture, 0).xy;
+    ivec2 tile = ivec2(gl_WorkGroupID.xy);
+    ivec2 start = max(tile * tile_size - halo, ivec2(0));
+    ivec2 end = min((tile + 1) * tile_size + halo, size);
+    for (int y = start.y + int(gl_LocalInvocationID.y); y < end.y && occupied == 0u; y += 16) {{
+        for (int x = start.x + int(gl_LocalInvocationID.x); x < end.x; x += 16) {{
+            if (hasContent(x, y)) {{
+                occupied = 1u;
+                break;
+            }}
+        }}
+    }}
+    barrier();
+    if (gl_LocalInvocationIndex == 0u && occupied != 0u) {{
+        // A tile can be occupied in several inputs, it is only added to the list once
+        uint index = gl_WorkGroupID.y * gl_NumWorkGroups.x + gl_WorkGroupID.x;
+        if (atomicExchange(flags[index], 1u) == 0u) {{
+            tiles[atomicAdd(tile_count, 1u)] = uint(tile.x) | (uint(tile.y) << 16);
+            atomicAdd(command[0], groups_x);
+        }}
+    }}
+}}"""
+
+# Content checks of single textures and of texture arrays, where any slice with content counts
+textureCheck = "    return texelFetch(in_texture, ivec2(x, y), 0)[{alpha}] {notEmpty};"
+arrayCheck = """    for (int layer = 0; layer < textureSize(in_texture, 0).z; layer++) {{
+        if (texelFetch(in_texture, ivec3(x, y, layer), 0)[{alpha}] {notEmpty}) {{
+            return true;
+        }}
+    }}
+    return false;"""
+
+# Find the local size a compute shader declares, sizes that are not literal numbers count as 1
+def getLocalSize(source):
+    size = {"x": 1, "y": 1}
+    for axis, value in localSizePattern.findall(ShaderReflection.commentPattern.sub("", source)):
+        size[axis] = int(value)
+    return size["x"], size["y"]
+
+class SparseTileHelper:
+    localSize = (1, 1)
+    tileSize = (targetTileSize, targetTileSize)
+    tiles = (0, 0)
+    programs = []
+    tileBuffer = None
+    flagBuffer = None
+
+    def __init__(self):
+        self.localSize = (1, 1)
+        self.tileSize = (targetTileSize, targetTileSize)
+        self.tiles = (0, 0)
+        self.programs = []
+        self.tileBuffer = None
+        self.flagBuffer = None
+
+    # Check the storage buffers leave the tile list's binding free, raises an exception with description if not
+    def validate(self, storageBuffers):
+        for item in storageBuffers:
+            if item.index == sparseBinding:
+                raise Exception(f"Invalid Configuration\nStorage buffer at index {item.index}\nBinding {sparseBinding} is used by the tile list in sparse tile mode.")
+
+    # Add the tile functions to a compute shader's source and choose the tile size from its local size
+    def prepareSource(self, source):
+        self.localSize = getLocalSize(source)
+        self.tileSize = tuple(size * max(1, round(targetTileSize / size)) for size in self.localSize)
+        match = versionPattern.search(source)
+        if not match:
+            raise Exception("Sparse tile mode needs the shader to start with a #version line.")
+        line = source.count("\n", 0, match.end()) + 1
+        header = shaderHeader.format(
+            binding=sparseBinding,
+            tileX=self.tileSize[0],
+            tileY=self.tileSize[1],
+            groupsX=self.tileSize[0] // self.localSize[0],
+            localX=self.localSize[0],
+            localY=self.localSize[1],
+            line=line)
+        prefix = source[:match.end()]
+        if not prefix.endswith("\n"):
+            prefix += "\n"
+        return prefix + header + source[match.end():]
+
+    # Build the tile list from the textures of the inputs, size is the processed region and halo is in pixels
+    # Texture arrays of layer arrays count a tile as occupied when any of their slices has content there
+    # Without any inputs every tile is listed
+    def findTiles(self, ctx, inputs, size, halo):
+        self.tiles = ((size[0] + self.tileSize[0] - 1) // self.tileSize[0], (size[1] + self.tileSize[1] - 1) // self.tileSize[1])
+        groupsX = self.tileSize[0] // self.localSize[0]
+        groupsY = self.tileSize[1] // self.localSize[1]
+        count = self.tiles[0] * self.tiles[1]
+        if not inputs:
+            # Shaders that only write have nothing to find content in, every tile is run
+            tiles = [tileX | (tileY << 16) for tileY in range(self.tiles[1]) for tileX in range(self.tiles[0])]
+            self.tileBuffer = ctx.buffer(struct.pack(f"<4I{count}I", count * groupsX, groupsY, 1, count, *tiles))
+            return
+        self.tileBuffer = ctx.buffer(struct.pack("<4I", 0, groupsY, 1, 0) + bytes(count * 4))
+        self.flagBuffer = ctx.buffer(reserve=count * 4)
+        self.flagBuffer.clear()
+        self.tileBuffer.bind_to_storage_buffer(binding=0)
+        self.flagBuffer.bind_to_storage_buffer(binding=1)
+        for texture in inputs:
+            isFloat = texture.dtype[0] == "f"
+            # Layer arrays are TextureArrays, which have a number of layers
+            isArray = hasattr(texture, "layers")
+            contentCheck = (arrayCheck if isArray else textureCheck).format(alpha=texture.components - 1, notEmpty="> 0.0" if isFloat else "!= 0u")
+            program = ctx.compute_shader(occupancyShader.format(
+                sampler=("" if isFloat else "u") + ("sampler2DArray" if isArray else "sampler2D"),
+                contentCheck=contentCheck))
+            self.programs.append(program)
+            texture.use(location=0)
+            program["in_texture"] = 0
+            program["tile_size"] = self.tileSize
+            program["halo"] = halo
+            program["groups_x"] = groupsX
+            program.run(self.tiles[0], self.tiles[1], 1)
+        # The list and command must be visible to the indirect dispatch
+        ctx.memory_barrier()
+
+    # Run the shader on the occupied tiles, groupsZ is the number of workgroups to run along z for each tile
+    def run(self, shader, groupsZ):
+        self.tileBuffer.write(struct.pack("<I", groupsZ), offset=8)
+        self.tileBuffer.bind_to_storage_buffer(binding=sparseBinding)
+        shader.run_indirect(self.tileBuffer)
+
+    # Describe how many tiles were run
+    def describe(self):
+        occupied = struct.unpack("<I", self.tileBuffer.read(4, offset=12))[0]
+        return f"Sparse tiles: ran {occupied} of {self.tiles[0] * self.tiles[1]} {self.tileSize[0]}x{self.tileSize[1]} tiles"
+
+    # Clean up all OGL objects created
+    def cleanUp(self):
+        for program in self.programs:
+            program.release()
+        for buffer in [self.tileBuffer, self.flagBuffer]:
+            if buffer:
+                buffer.release()
+        self.programs = []
+        self.tileBuffer = None
+        self.flagBuffer = None
@@ -0,0 +1,185 @@
+"""
+Class to help creating, binding, and reading back shader storage buffers (SSBOs) for compute shaders
+
+Buffers can be filled from a .npy file or a raw binary file, and/or sized with a simple expression using the
+document's width and height, eg. "width * height * 4". After the dispatch, buffers marked for read back are read
+into a Python array and optionally written to a .npy or raw binary file.
+
+Krita does not ship numpy, so .npy files are read and written here directly. Only little-endian, C ordered
+arrays of the types in dataTypes are supported, which covers what GLSL can read from a buffer.
+"""
+import array
+import ast
+import math
+import operator
+import struct
+
+# Data types that can be used for storage buffers, as numpy type strings with their array module type codes
+dataTypes = {"i1": "b", "u1": "B", "i2": "h", "u2": "H", "i4": "i", "u4": "I", "f4": "f", "f8": "d"}
+
+# Results with at most this many values are listed in the read back messages, eg. counters written with atomics
+maxListedValues = 16
+
+# Largest result of ** in size expressions is 2 to this power, so a typo such as width**height**2 cannot hang Krita
+maxPowerBits = 64
+
+def limitedPower(base, exponent):
+    if abs(exponent) > maxPowerBits or (abs(base) > 1 and exponent > 0 and math.log2(abs(base)) * exponent > maxPowerBits):
+        raise OverflowError(f"** results are limited to 2**{maxPowerBits}")
+    return operator.pow(base, exponent)
+
+# Operators allowed in size expressions
+binaryOperators = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: limitedPower
+}
+
+# Evaluate a simple arithmetic size expression such as "width * height * 4" without using eval
+def evaluateSize(expression, names):
+    def evaluate(node):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node.value
+        if isinstance(node, ast.Name) and node.id in names:
+            return names[node.id]
+        if isinstance(node, ast.BinOp) and type(node.op) in binaryOperators:
+            return binaryOperators[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return -evaluate(node.operand)
+        raise Exception(f"Unsupported size expression: {expression}\nUse numbers, width, height and + - * / // % **")
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError:
+        raise Exception(f"Unsupported size expression: {expression}\nUse numbers, width, height and + - * / // % **")
+    try:
+        return int(evaluate(tree))
+    except (ZeroDivisionError, OverflowError, ValueError, TypeError) as e:
+        raise Exception(f"Unsupported size expression: {expression}\n{e}")
+
+# Read the contents of a .npy file, returns the raw data and its type string
+def readNpy(data):
+    if data[:6] != b"\x93NUMPY":
+        raise Exception("File is not a valid .npy file.")
+    if data[6] == 1:
+        headerLength = struct.unpack("<H", data[8:10])[0]
+        start = 10
+    else:
+        headerLength = struct.unpack("<I", data[8:12])[0]
+        start = 12
+    header = ast.literal_eval(data[start:start+headerLength].decode("latin1"))
+    if header["fortran_order"]:
+        raise Exception(".npy file must be C ordered.")
+    if header["descr"][0] == ">":
+        raise Exception(".npy file must be little-endian.")
+    dataType = header["descr"][1:]
+    if dataType not in dataTypes:
+        raise Exception(f".npy data type {header['descr']} is not supported, use one of: {', '.join(dataTypes)}")
+    return data[start+headerLength:], dataType
+
+# Write raw data as a one dimensional .npy file
+def writeNpy(path, data, dataType):
+    count = len(data) // struct.calcsize(dataTypes[dataType])
+    header = "{'descr': '<%s', 'fortran_order': False, 'shape': (%d,), }" % (dataType, count)
+    # The header is padded with spaces and a newline so the data starts on a 64 byte boundary
+    header += " " * (63 - (10 + len(header)) % 64) + "\n"
+    with open(path, "wb") as f:
+        f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+        f.write(data[:count * struct.calcsize(dataTypes[dataType])])
+
+# Load a file for a storage buffer, .npy files are parsed and anything else is used as raw bytes
+def loadBufferData(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.lower().endswith(".npy"):
+        return readNpy(data)
+    return data, None
+
+# Save read back data to a .npy or raw binary file depending on the extension
+def saveBufferData(path, data, dataType):
+    if path.lower().endswith(".npy"):
+        writeNpy(path, data, dataType)
+    else:
+        with open(path, "wb") as f:
+            f.write(data)
+
+# Convert read back data to a Python array of the buffer's data type
+def toPythonObject(data, dataType):
+    result = array.array(dataTypes[dataType])
+    result.frombytes(data[:len(data) - len(data) % result.itemsize])
+    return result
+
+class StorageBufferHelper:
+    buffers = []
+    results = {}
+
+    def __init__(self):
+        self.buffers = []
+        self.results = {}
+
+    # Check a storage buffer item can be used without touching any files, raises an exception with description if not
+    def validateItem(self, item, width, height):
+        if item.dataType not in dataTypes:
+            raise Exception(f"Invalid Configuration\nStorage buffer at index {item.index}\nData Type must be one of: {', '.join(dataTypes)}")
+        if not item.sourceFile and not item.size:
+            raise Exception(f"Invalid Configuration\nStorage buffer at index {item.index}\nA source file or a size is needed.")
+        if item.size:
+            try:
+                size = evaluateSize(item.size, {"width": width, "height": height})
+            except Exception as e:
+                raise Exception(f"Invalid Configuration\nStorage buffer at index {item.index}\n{e.args[0]}")
+            if size <= 0:
+                raise Exception(f"Invalid Configuration\nStorage buffer at index {item.index}\nThe size must be larger than 0.")
+
+    # Create a buffer for each item, fill it from its source file if it has one, and bind it to its index
+    def createBuffers(self, ctx, items, width, height):
+        self.results = {}
+        for item in items:
+            data = None
+            if item.sourceFile:
+                try:
+                    data = loadBufferData(item.sourceFile)[0]
+                except Exception as e:
+                    raise Exception(f"Storage buffer at index {item.index}\nCould not load {item.sourceFile}:\n{e}")
+            size = evaluateSize(item.size, {"width": width, "height": height}) if item.size else 0
+            # A source file larger than the size expression decides the size
+            size = max(size, len(data) if data else 0)
+            if size <= 0:
+                raise Exception(f"Storage buffer at index {item.index}\nBuffer size must be larger than 0.")
+            buffer = ctx.buffer(reserve=size)
+            self.buffers.append((item, buffer))
+            buffer.clear()
+            if data:
+                buffer.write(data)
+            buffer.bind_to_storage_buffer(binding=item.index)
+
+    # Read back the buffers marked for it, returns a line describing each one
+    def readBack(self):
+        messages = []
+        for item, buffer in self.buffers:
+            if not item.readBack:
+                continue
+            data = buffer.read()
+            result = toPythonObject(data, item.dataType)
+            self.results[item.index] = result
+            if item.outputFile:
+                saveBufferData(item.outputFile, data, item.dataType)
+                message = f"Storage buffer {item.index}: read back {len(data)} bytes to {item.outputFile}"
+            else:
+                message = f"Storage buffer {item.index}: read back {len(data)} bytes"
+            # Small results such as counters or reductions are shown directly
+            if len(result) <= maxListedValues:
+                message += ": " + ", ".join(str(value) for value in result)
+            messages.append(message)
+        return messages
+
+    # Clean up all OGL objects created, the read back results are kept
+    def cleanUp(self):
+        for item, buffer in self.buffers:
+            buffer.release()
+        self.buffers = []
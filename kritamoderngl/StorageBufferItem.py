@@ -0,0 +1,39 @@
+import json as jsonlib
+
+# Utility/data class for handling shader storage buffers for compute shaders
+class StorageBufferItem():
+    index: int
+    sourceFile: str
+    size: str
+    dataType: str
+    readBack: bool
+    outputFile: str
+
+    # Initialize from individual components or a dict from a JSON string
+    def __init__(self, index:int=0, sourceFile:str="", size:str="", dataType:str="f4", readBack:bool=False, outputFile:str="", json:dict=None):
+        if json:
+            self.index = json['index']
+            self.sourceFile = json['sourceFile']
+            self.size = json['size']
+            self.dataType = json['dataType']
+            self.readBack = json['readBack']
+            self.outputFile = json['outputFile']
+        else:
+            self.index = index
+            self.sourceFile = sourceFile
+            self.size = size
+            self.dataType = dataType
+            self.readBack = readBack
+            self.outputFile = outputFile
+
+    # Print as a JSON object, file paths may need escaping so this goes through the json module
+    def __str__(self):
+        return jsonlib.dumps({"index": self.index, "sourceFile": self.sourceFile, "size": self.size, "dataType": self.dataType, "readBack": self.readBack, "outputFile": self.outputFile}, separators=(",", ":"))
+
+    # Other string method should also print as a JSON object
+    def __repr__(self):
+        return self.__str__()
+
+    # define < method for sorting by index
+    def __lt__(self, other):
+        return self.index < other.index
@@ -1,3 +1,5 @@
+import json as jsonlib
+
 # Utility/data class for handling mapping layers to textures for input and output
 class TextureMapItem():
     layerId: str
@@ -6,9 +8,13 @@ class TextureMapItem():
     index: int
     repeat: bool
     variableName: str
+    workingFormat: str
+    dither: bool
+    overwrite: bool
+    arrayLayers: str
 
     # Initialize from individual components or a dict from a JSON string
-    def __init__(self, layerId:str="", read:bool=True, write:bool=False, index:int=0, repeat:bool=True, variableName:str="", json:dict=None):
+    def __init__(self, layerId:str="", read:bool=True, write:bool=False, index:int=0, repeat:bool=True, variableName:str="", workingFormat:str="", dither:bool=False, overwrite:bool=False, arrayLayers:str="", json:dict=None):
         if json:
             self.layerId = json['layerId']
             self.read = json['read']
@@ -16,6 +22,11 @@ class TextureMapItem():
             self.index = json['index']
             self.repeat = json['repeat']
             self.variableName = json['variableName']
+            # Mappings saved by older versions do not have a working format
+            self.workingFormat = json.get('workingFormat', "")
+            self.dither = json.get('dither', False)
+            self.overwrite = json.get('overwrite', False)
+            self.arrayLayers = json.get('arrayLayers', "")
         else:
             self.layerId = layerId
             self.read = read
@@ -23,15 +34,19 @@ class TextureMapItem():
             self.index = index
             self.repeat = repeat
             self.variableName = variableName
+            self.workingFormat = workingFormat
+            self.dither = dither
+            self.overwrite = overwrite
+            self.arrayLayers = arrayLayers
     
     # Print as a JSON object
     def __str__(self):
-        return f'{{"layerId":"{self.layerId}","read":{str(self.read).lower()},"write":{str(self.write).lower()},"index":{self.index},"repeat":{str(self.repeat).lower()},"variableName":"{self.variableName}"}}'
+        return f'{{"layerId":"{self.layerId}","read":{str(self.read).lower()},"write":{str(self.write).lower()},"index":{self.index},"repeat":{str(self.repeat).lower()},"variableName":"{self.variableName}","workingFormat":"{self.workingFormat}","dither":{str(self.dither).lower()},"overwrite":{str(self.overwrite).lower()},"arrayLayers":{jsonlib.dumps(self.arrayLayers)}}}'
 
     # Other string method should also print as a JSON object
     def __repr__(self):
-        return f'{{"layerId":"{self.layerId}","read":{str(self.read).lower()},"write":{str(self.write).lower()},"index":{self.index},"repeat":{str(self.repeat).lower()},"variableName":"{self.variableName}"}}'
+        return self.__str__()
 
     # define < method for sorting by index
     def __lt__(self, other):
-        return self.index < other.index
\ No newline at end of file
+        return self.index < other.index
@@ -0,0 +1,224 @@
+from krita import *
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QStringListModel, pyqtSignal
+from PyQt5.QtGui import QFont
+from PyQt5.QtWidgets import QStyledItemDelegate, QComboBox
+
+# Table model for a list of TextureMapItems (or other mapping items with an index), the list is the data and the views only display it
+# Columns are given as (attribute name, header) pairs, the "index" column shows the row
+# Text columns limited to a few values can be given choices as {attribute name: [(value, name)]}
+class TextureMapModel(QAbstractTableModel):
+    # Emitted for every change to the mapping, including reordering and replacing the list
+    mappingEdited = pyqtSignal()
+
+    def __init__(self, columns, specialIds, specialNames, toolTips, parent=None, choices=None):
+        super(TextureMapModel, self).__init__(parent)
+        self.items = []
+        self.columns = columns
+        self.choices = choices if choices else {}
+        self.specialIds = specialIds
+        self.specialNames = specialNames
+        self.toolTips = toolTips
+        self.layerNames = []
+        self.layerUuids = []
+        self.layerRows = {}
+        # Entries for the layer drop down, shared by every editor instead of copied into each
+        self.layerList = QStringListModel(specialNames, self)
+        self.monoFont = QFont("Monospace")
+        self.monoFont.setStyleHint(QFont.TypeWriter)
+
+    def setLayers(self, names, uuids, rows):
+        # Set the layers that can be chosen, these come from the shared LayerIndex
+        self.layerNames = names
+        self.layerUuids = uuids
+        self.layerRows = rows
+        self.layerList.setStringList(self.specialNames + names)
+        column = self.getColumn("layerId")
+        if self.items and column is not None:
+            self.dataChanged.emit(self.index(0, column), self.index(len(self.items) - 1, column))
+
+    def setItems(self, items):
+        # Replace the whole list, renumbering the indexes to match the rows
+        self.beginResetModel()
+        self.items = items
+        for idx in range(len(self.items)):
+            self.items[idx].index = idx
+        self.endResetModel()
+        self.mappingEdited.emit()
+
+    def getColumn(self, key):
+        for column in range(len(self.columns)):
+            if self.columns[column][0] == key:
+                return column
+        return None
+
+    def getLayerRow(self, layerId):
+        # Find the drop down row for a layer id, the special entries are listed before the layers
+        if layerId in self.specialIds:
+            return self.specialIds.index(layerId)
+        # Mappings saved by older versions may have the indentation in front of the uuid
+        row = self.layerRows.get(layerId.strip())
+        return 0 if row is None else row + len(self.specialIds)
+
+    def getLayerId(self, row):
+        # Get the layer id for a drop down row
+        if row < len(self.specialIds):
+            return self.specialIds[row]
+        return self.layerUuids[row - len(self.specialIds)]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.columns[section][1]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        key = self.columns[index.column()][0]
+        if key == "index":
+            return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if isinstance(getattr(self.items[index.row()], key), bool):
+            return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsUserCheckable
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        item = self.items[index.row()]
+        key = self.columns[index.column()][0]
+        if role == Qt.ToolTipRole:
+            return self.toolTips.get(key)
+        if key == "index":
+            return str(index.row()) if role == Qt.DisplayRole else None
+        value = getattr(item, key)
+        if isinstance(value, bool):
+            if role == Qt.CheckStateRole:
+                return Qt.Checked if value else Qt.Unchecked
+            return None
+        if key == "layerId":
+            row = self.getLayerRow(value)
+            if role == Qt.EditRole:
+                return row
+            if role == Qt.DisplayRole:
+                return self.specialNames[row] if row < len(self.specialIds) else self.layerNames[row - len(self.specialIds)]
+            return None
+        if role == Qt.FontRole and key == "variableName":
+            return self.monoFont
+        if role == Qt.DisplayRole and key in self.choices:
+            return dict(self.choices[key]).get(value, value)
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return value
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid():
+            return False
+        item = self.items[index.row()]
+        key = self.columns[index.column()][0]
+        if role == Qt.CheckStateRole:
+            setattr(item, key, value == Qt.Checked)
+        elif role == Qt.EditRole and key == "layerId":
+            item.layerId = self.getLayerId(value)
+        elif role == Qt.EditRole and key != "index":
+            setattr(item, key, value)
+        else:
+            return False
+        self.dataChanged.emit(index, index)
+        self.mappingEdited.emit()
+        return True
+
+    def renumber(self, first, last):
+        # Keep the unit indexes equal to the rows after a structural change
+        for idx in range(first, last + 1):
+            self.items[idx].index = idx
+        self.dataChanged.emit(self.index(first, 0), self.index(last, 0))
+
+    def moveRowsUp(self, rows):
+        # Move the given rows up if able, rows must be sorted ascending
+        # Row 0 cannot be moved up, so it and any rows in sequence after are invalid and skipped
+        invalidRow = 0
+        while rows and rows[0] == invalidRow:
+            rows = rows[1:]
+            invalidRow += 1
+        # Shuffle all selected rows up one position from front to back
+        for row in rows:
+            self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), row - 1)
+            self.items[row - 1], self.items[row] = self.items[row], self.items[row - 1]
+            self.endMoveRows()
+            self.renumber(row - 1, row)
+        if rows:
+            self.mappingEdited.emit()
+
+    def moveRowsDown(self, rows):
+        # Move the given rows down if able, rows must be sorted descending
+        # Last row cannot be moved down, so it and any rows in sequence before are invalid and skipped
+        invalidRow = len(self.items) - 1
+        while rows and rows[0] == invalidRow:
+            rows = rows[1:]
+            invalidRow -= 1
+        # Shuffle all selected rows down one position from back to front
+        for row in rows:
+            self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), row + 2)
+            self.items[row], self.items[row + 1] = self.items[row + 1], self.items[row]
+            self.endMoveRows()
+            self.renumber(row, row + 1)
+        if rows:
+            self.mappingEdited.emit()
+
+    def insertItem(self, row, item):
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.items.insert(row, item)
+        self.endInsertRows()
+        self.renumber(row, len(self.items) - 1)
+        self.mappingEdited.emit()
+
+    def removeItems(self, rows):
+        # Remove the given rows, rows must be sorted descending
+        for row in rows:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.items[row]
+            self.endRemoveRows()
+        if rows and rows[-1] < len(self.items):
+            self.renumber(rows[-1], len(self.items) - 1)
+        if rows:
+            self.mappingEdited.emit()
+
+# Delegate that only creates a layer drop down while a layer cell is being edited
+class LayerDelegate(QStyledItemDelegate):
+    def createEditor(self, parent, option, index):
+        editor = QComboBox(parent)
+        editor.setModel(index.model().layerList)
+        editor.setInsertPolicy(QComboBox.NoInsert)
+        # Commit as soon as a layer is picked rather than when focus leaves
+        editor.activated.connect(lambda row: self.commitData.emit(editor))
+        return editor
+
+    def setEditorData(self, editor, index):
+        editor.setCurrentIndex(index.data(Qt.EditRole))
+
+    def setModelData(self, editor, model, index):
+        model.setData(index, editor.currentIndex(), Qt.EditRole)
+
+# Delegate that edits a column with a fixed list of choices, given as [(value, name)]
+class ChoiceDelegate(QStyledItemDelegate):
+    def __init__(self, choices, parent=None):
+        super(ChoiceDelegate, self).__init__(parent)
+        self.choices = choices
+
+    def createEditor(self, parent, option, index):
+        editor = QComboBox(parent)
+        for value, name in self.choices:
+            editor.addItem(name, value)
+        editor.activated.connect(lambda row: self.commitData.emit(editor))
+        return editor
+
+    def setEditorData(self, editor, index):
+        editor.setCurrentIndex(max(0, editor.findData(index.data(Qt.EditRole))))
+
+    def setModelData(self, editor, model, index):
+        model.setData(index, editor.currentData(), Qt.EditRole)
@@ -0,0 +1,156 @@
+"""
+Class to help writing back only the parts of an output that the shader changed
+
+Writing a whole layer with setPixelData makes Krita record an undo step for every pixel and update the projection
+everywhere, even when the shader only changed a small area. Instead, each result is compared with the layer's
+original pixels on the GPU in one small render pass that writes a byte per tile, set when any pixel in the tile
+differs. Only that mask is read back to find the changed tiles, then changed tiles next to each other in a row are
+read from the GPU and written to the layer together.
+
+New layers are compared with transparent pixels, so tiles the shader left empty are not written at all. The result
+and the original are compared in the order they are stored in, so this works the same with or without RGBA correction.
+"""
+from . import RgbaCorrectionHelper, MemoryEstimator
+
+# Width and height of the tiles compared and written back, in pixels
+tileSize = 64
+
+# Shader to mark the tiles where the result differs from the original, one fragment per tile
+compareShader = """#version 330 core
+
+uniform {prefix}sampler2D result;
+{originalUniform}
+uniform int tileSize;
+out float changed;
+
+void main() {{
+    ivec2 size = textureSize(result, 0);
+    ivec2 start = ivec2(gl_FragCoord.xy) * tileSize;
+    ivec2 end = min(start + tileSize, size);
+    changed = 0.0;
+    for (int y = start.y; y < end.y; y++) {{
+        for (int x = start.x; x < end.x; x++) {{
+            ivec2 pos = ivec2(x, y);
+            if (any(notEqual(texelFetch(result, pos, 0){swizzle}, {original}))) {{
+                changed = 1.0;
+                return;
+            }}
+        }}
+    }}
+}}"""
+
+swizzles = {1: ".r", 2: ".rg", 3: ".rgb", 4: ".rgba"}
+
+class TileDiffHelper:
+    programs = {}
+    vaos = {}
+    textures = []
+    frameBuffers = []
+    changedTiles = 0
+    totalTiles = 0
+
+    def __init__(self):
+        self.programs = {}
+        self.vaos = {}
+        self.textures = []
+        self.frameBuffers = []
+        self.changedTiles = 0
+        self.totalTiles = 0
+
+    # Get a program for the shader source, each distinct comparison is only compiled once per run
+    def getProgram(self, ctx, source):
+        if source not in self.programs:
+            self.programs[source] = ctx.program(vertex_shader=RgbaCorrectionHelper.vertexShader, fragment_shader=source)
+            vao = ctx.vertex_array(self.programs[source], [])
+            vao.vertices = 6
+            vao.mode = ctx.TRIANGLES
+            self.vaos[source] = vao
+        return self.programs[source]
+
+    # Compare a result with the original pixel data, None for new layers, and find the changed tiles
+    # Returns spans of changed tiles next to each other in a row, as (x, y, width, height) in the result
+    def findChangedSpans(self, ctx, result, originalData):
+        width, height = result.size
+        tilesX = (width + tileSize - 1) // tileSize
+        tilesY = (height + tileSize - 1) // tileSize
+        prefix = "" if result.dtype[0] == "f" else "u"
+        # notEqual needs vectors, single channels are compared together with the second channel, which reads as 0
+        components = max(result.components, 2)
+        swizzle = swizzles[components]
+        if originalData is None:
+            originalUniform = ""
+            original = f"{prefix}vec{components}(0)"
+        else:
+            originalUniform = f"uniform {prefix}sampler2D original;"
+            original = f"texelFetch(original, pos, 0){swizzle}"
+        source = compareShader.format(prefix=prefix, originalUniform=originalUniform, swizzle=swizzle, original=original)
+        program = self.getProgram(ctx, source)
+        result.use(location=0)
+        program["result"] = 0
+        program["tileSize"] = tileSize
+        if originalData is not None:
+            originalTexture = ctx.texture(result.size, result.components, data=originalData, dtype=result.dtype)
+            self.textures.append(originalTexture)
+            originalTexture.use(location=1)
+            program["original"] = 1
+        mask = ctx.texture((tilesX, tilesY), 1, dtype="f1")
+        self.textures.append(mask)
+        frameBuffer = ctx.framebuffer([mask])
+        self.frameBuffers.append(frameBuffer)
+        frameBuffer.use()
+        self.vaos[source].render()
+        changed = mask.read()
+        spans = []
+        for tileY in range(tilesY):
+            tileX = 0
+            while tileX < tilesX:
+                if not changed[tileY * tilesX + tileX]:
+                    tileX += 1
+                    continue
+                first = tileX
+                while tileX < tilesX and changed[tileY * tilesX + tileX]:
+                    tileX += 1
+                spanX = first * tileSize
+                spanY = tileY * tileSize
+                spans.append((spanX, spanY, min(tileX * tileSize, width) - spanX, min(tileSize, height - spanY)))
+                self.changedTiles += tileX - first
+        self.totalTiles += tilesX * tilesY
+        return spans
+
+    # Get the pixel data of each span as (x, y, width, height, data)
+    # Spans are read from the GPU, unless the whole result was already read back and is given as data
+    def readSpans(self, ctx, result, spans, data=None):
+        if data is not None and spans == [(0, 0, *result.size)]:
+            yield 0, 0, *result.size, data
+            return
+        if data is not None:
+            pixelBytes = result.components * MemoryEstimator.bytesPerComponent[result.dtype]
+            rowBytes = result.size[0] * pixelBytes
+            for x, y, width, height in spans:
+                yield x, y, width, height, b"".join(data[row * rowBytes + x * pixelBytes:row * rowBytes + (x + width) * pixelBytes] for row in range(y, y + height))
+            return
+        frameBuffer = ctx.framebuffer([result])
+        self.frameBuffers.append(frameBuffer)
+        for x, y, width, height in spans:
+            yield x, y, width, height, frameBuffer.read(viewport=(x, y, width, height), components=result.components, dtype=result.dtype)
+
+    # Describe how much of the outputs was written back
+    def describe(self):
+        return f"Changed tiles: wrote {self.changedTiles} of {self.totalTiles} {tileSize}x{tileSize} tiles"
+
+    # Clean up all OGL objects created, the results belong to the parent
+    def cleanUp(self):
+        for texture in self.textures:
+            texture.release()
+        for frameBuffer in self.frameBuffers:
+            frameBuffer.release()
+        for vao in self.vaos.values():
+            vao.release()
+        for program in self.programs.values():
+            program.release()
+        self.textures = []
+        self.frameBuffers = []
+        self.programs = {}
+        self.vaos = {}
+        self.changedTiles = 0
+        self.totalTiles = 0
@@ -0,0 +1,176 @@
+"""
+Class to help creating vertex and instance buffers for render shaders and building the vertex array from them
+
+Each buffer has a layout in ModernGL's format, eg. "2f 4f1" for a vec2 and a normalized RGBA byte color, and a name
+for each attribute in the vertex shader. Buffers marked per instance advance once per instance instead of once per
+vertex, so a few vertices describing one shape can be drawn at every position of an instance buffer in a single
+instanced draw call.
+
+Buffers can be filled from a .npy or raw binary file holding the data already in the layout, from a CSV file with one
+vertex (or instance) per row and one column per component, or from a layer. A layer gives one element per pixel of the
+processed region in the layer's own format and channel order, so gl_InstanceID % width and gl_InstanceID / width are
+the pixel's position in the region. Without a layout, layers use one normalized vector of the layer's components.
+"""
+import csv
+import re
+import struct
+from . import StorageBufferHelper
+
+# Attribute types that can be used in layouts, as (struct code, value normalized values are scaled by or None)
+layoutTypes = {
+    "f": ("f", None), "f1": ("B", 255), "f2": ("e", None), "f4": ("f", None), "f8": ("d", None),
+    "i": ("i", None), "i1": ("b", None), "i2": ("h", None), "i4": ("i", None),
+    "u": ("I", None), "u1": ("B", None), "u2": ("H", None), "u4": ("I", None),
+    "nu1": ("B", 255), "nu2": ("H", 65535), "ni1": ("b", 127), "ni2": ("h", 32767)
+}
+
+# Layout type for a layer's data type when the item does not have a layout
+layerLayoutTypes = {"u1": "f1", "u2": "nu2", "f2": "f2", "f4": "f4"}
+
+layoutPattern = re.compile(r"^(\d*)(nu|ni|f|i|u|x)(\d*)$")
+
+# Parse a layout into a list of (components, type, bytes), padding has a type of None
+def parseLayout(layout):
+    parsed = []
+    for token in layout.split():
+        match = layoutPattern.match(token)
+        if not match:
+            raise Exception(f"Unsupported layout entry: {token}\nUse entries such as 2f, 4f1, 3i, 1u2, nu2 or 4x for padding.")
+        count = int(match.group(1)) if match.group(1) else 1
+        if match.group(2) == "x":
+            parsed.append((count, None, count * (int(match.group(3)) if match.group(3) else 1)))
+            continue
+        typeName = match.group(2) + match.group(3)
+        if typeName not in layoutTypes:
+            raise Exception(f"Unsupported layout entry: {token}\nSupported types are: {', '.join(layoutTypes)}")
+        parsed.append((count, typeName, count * struct.calcsize(layoutTypes[typeName][0])))
+    if not parsed:
+        raise Exception("Layout cannot be empty.")
+    return parsed
+
+# Get the layout of a layer's data for items without their own
+def getLayerLayout(planItem):
+    return f"{planItem.components}{layerLayoutTypes[planItem.colorType]}"
+
+# Match the attributes of a layout with the vertex shader's inputs, returns the layout and names to bind and the skipped names
+# Attributes the compiler removed or the shader does not declare are bound as padding, which ModernGL would otherwise refuse
+def matchAttributes(program, layout, attributes):
+    usedTokens = []
+    usedNames = []
+    skippedNames = []
+    names = iter(attributes.split())
+    for token, (count, typeName, size) in zip(layout.split(), parseLayout(layout)):
+        if typeName is None:
+            usedTokens.append(token)
+            continue
+        name = next(names)
+        if program.get(name, None) is None:
+            skippedNames.append(name)
+            usedTokens.append(f"{size}x")
+        else:
+            usedTokens.append(token)
+            usedNames.append(name)
+    return " ".join(usedTokens), usedNames, skippedNames
+
+# Pack the rows of a CSV file into the layout, each row is one element and padding is filled with zeros
+def packCsv(path, parsed):
+    rowFormat = "<" + "".join(f"{size}x" if typeName is None else layoutTypes[typeName][0] * count for count, typeName, size in parsed)
+    components = sum(count for count, typeName, size in parsed if typeName)
+    packed = bytearray()
+    with open(path, "r", newline="") as f:
+        for line, row in enumerate(csv.reader(f), 1):
+            # Skip empty lines and a header row
+            if not row or not row[0].strip() or row[0].strip()[0].isalpha():
+                continue
+            if len(row) < components:
+                raise Exception(f"Row {line} has {len(row)} columns, the layout needs {components}.")
+            values = []
+            column = 0
+            for count, typeName, size in parsed:
+                if typeName is None:
+                    continue
+                code, scale = layoutTypes[typeName]
+                for value in row[column:column + count]:
+                    if scale:
+                        values.append(round(float(value) * scale))
+                    elif code in "efd":
+                        values.append(float(value))
+                    else:
+                        values.append(int(float(value)))
+                column += count
+            packed += struct.pack(rowFormat, *values)
+    return bytes(packed)
+
+class VertexBufferHelper:
+    buffers = []
+    notes = []
+
+    def __init__(self):
+        self.buffers = []
+        self.notes = []
+
+    # Check a vertex buffer item can be used without touching any files, raises an exception with description if not
+    def validateItem(self, item):
+        if not item.layerId and not item.sourceFile:
+            raise Exception(f"Invalid Configuration\nVertex buffer at index {item.index}\nA source file or a layer is needed.")
+        if not item.layout:
+            if not item.layerId:
+                raise Exception(f"Invalid Configuration\nVertex buffer at index {item.index}\nA layout is needed for source files.")
+            parsed = [(1, "f", 4)]
+        else:
+            try:
+                parsed = parseLayout(item.layout)
+            except Exception as e:
+                raise Exception(f"Invalid Configuration\nVertex buffer at index {item.index}\n{e.args[0]}")
+        attributeCount = sum(1 for count, typeName, size in parsed if typeName)
+        if len(item.attributes.split()) != attributeCount:
+            raise Exception(f"Invalid Configuration\nVertex buffer at index {item.index}\nAttribute Names needs one name for each of the {attributeCount} attributes in the layout.")
+
+    # Load the data of an item from its file or layer, in the item's layout
+    def loadData(self, item, planItem, plan, region):
+        if planItem:
+            x, y, width, height = region
+            return plan.fetchPixelData(planItem, x, y, width, height)
+        try:
+            if item.sourceFile.lower().endswith(".csv"):
+                return packCsv(item.sourceFile, parseLayout(item.layout))
+            return StorageBufferHelper.loadBufferData(item.sourceFile)[0]
+        except Exception as e:
+            raise Exception(f"Vertex buffer at index {item.index}\nCould not load {item.sourceFile}:\n{e}")
+
+    # Create a buffer for each item and get the content for ctx.vertex_array
+    # Layers are fetched through the plan, region is the processed part of the document
+    # Returns the content with the number of vertices and instances the buffers hold, None if there are no buffers of that kind
+    def createContent(self, ctx, program, plan, region):
+        content = []
+        vertices = None
+        instances = None
+        for item in plan.vertexBuffers:
+            planItem = plan.vertexLayers.get(item.index)
+            layout = item.layout if item.layout else getLayerLayout(planItem)
+            parsed = parseLayout(layout)
+            stride = sum(size for count, typeName, size in parsed)
+            data = self.loadData(item, planItem, plan, region)
+            if len(data) < stride or len(data) % stride:
+                raise Exception(f"Vertex buffer at index {item.index}\nHolds {len(data)} bytes, which is not a whole number of {stride} byte elements for the layout {layout}.")
+            usedLayout, usedNames, skippedNames = matchAttributes(program, layout, item.attributes)
+            for name in skippedNames:
+                self.notes.append(f"Vertex buffer {item.index}: attribute {name} is not used by the vertex shader and was skipped.")
+            if not usedNames:
+                continue
+            buffer = ctx.buffer(data)
+            self.buffers.append(buffer)
+            content.append((buffer, usedLayout + ("/i" if item.perInstance else ""), *usedNames))
+            count = len(data) // stride
+            if item.perInstance:
+                instances = count if instances is None else min(instances, count)
+            else:
+                vertices = count if vertices is None else min(vertices, count)
+        return content, vertices, instances
+
+    # Clean up all OGL objects created
+    def cleanUp(self):
+        for buffer in self.buffers:
+            buffer.release()
+        self.buffers = []
+        self.notes = []
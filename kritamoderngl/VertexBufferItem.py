@@ -0,0 +1,39 @@
+import json as jsonlib
+
+# Utility/data class for handling vertex and instance buffers for render shaders
+class VertexBufferItem():
+    index: int
+    layerId: str
+    sourceFile: str
+    layout: str
+    attributes: str
+    perInstance: bool
+
+    # Initialize from individual components or a dict from a JSON string
+    def __init__(self, index:int=0, layerId:str="", sourceFile:str="", layout:str="", attributes:str="", perInstance:bool=False, json:dict=None):
+        if json:
+            self.index = json['index']
+            self.layerId = json['layerId']
+            self.sourceFile = json['sourceFile']
+            self.layout = json['layout']
+            self.attributes = json['attributes']
+            self.perInstance = json['perInstance']
+        else:
+            self.index = index
+            self.layerId = layerId
+            self.sourceFile = sourceFile
+            self.layout = layout
+            self.attributes = attributes
+            self.perInstance = perInstance
+
+    # Print as a JSON object, file paths may need escaping so this goes through the json module
+    def __str__(self):
+        return jsonlib.dumps({"index": self.index, "layerId": self.layerId, "sourceFile": self.sourceFile, "layout": self.layout, "attributes": self.attributes, "perInstance": self.perInstance}, separators=(",", ":"))
+
+    # Other string method should also print as a JSON object
+    def __repr__(self):
+        return self.__str__()
+
+    # define < method for sorting by index
+    def __lt__(self, other):
+        return self.index < other.index
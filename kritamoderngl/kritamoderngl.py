@@ -1,17 +1,30 @@
 from krita import *
 from zipfile import ZipFile
-from . import RenderShaderDialog, ComputeShaderDialog
+from . import RenderShaderDialog, ComputeShaderDialog, BackendSettingsDialog, ReductionHelper, BackendHelper, ResultCache
 import logging
 import platform
+import shutil
+import time
 import sys
 import os
 
+# Name of the file written into each extracted wheel directory once extraction has completed
+versionMarkerName = ".kritamoderngl_version"
+
 class KritaModernGL(Extension):
     def __init__(self, parent):
         super().__init__(parent)
         # Set up logger
         logging.basicConfig(filename = Krita.getAppDataLocation() + "/pykrita/kritamoderngl/log.log", level = logging.INFO)
         self.log = logging.getLogger(__name__)
+        # ModernGL is only unpacked, imported, and given a context the first time one of the tools is used
+        # This keeps Krita start-up from paying for it when the plugin is not used
+        self.ctx = None
+        self.settings = None
+        # Results of earlier runs, shared by both dialogs and created the first time it is used
+        self.resultCache = None
+
+    def getWheelNames(self):
         # ModernGL is compiled per platform per architecture per python version
         # Distribute with all packages, then only unpack the relevant ones
         # Determine the python version
@@ -44,54 +57,136 @@ class KritaModernGL(Extension):
             glc_name = "glcontext-3.0.0-cp" + vers + "-cp" + vers + "-" + glc_plat
         else:
             glc_name = "glcontext-3.0.0-cp" + vers + "-cp" + vers + "-" + plat
-        # If it is not a directory, extract the zip to a directory
+        return mgl_name, glc_name
+
+    def extractWheel(self, path, name):
+        # Extract the wheel to a directory of the same name unless a previous extraction completed
+        # The marker file holds the wheel name, so a partial extraction or an older version is redone
+        target = os.path.join(path, name)
+        marker = os.path.join(target, versionMarkerName)
+        try:
+            with open(marker, "r") as f:
+                if f.read() == name:
+                    return True
+        except OSError:
+            pass
+        if os.path.exists(target):
+            shutil.rmtree(target, ignore_errors=True)
+        os.makedirs(target, exist_ok=True)
+        try:
+            with ZipFile(target + ".whl", "r") as whl:
+                whl.extractall(target)
+            with open(marker, "w") as f:
+                f.write(name)
+        except Exception:
+            return False
+        return True
+
+    def loadSettings(self):
+        configPath = QStandardPaths.writableLocation(QStandardPaths.GenericConfigLocation)
+        self.settings = QSettings(configPath + '/krita-scripterrc', QSettings.IniFormat)
+
+    def initModernGL(self):
+        # Unpack and import ModernGL and create the persistent context, returns whether the context is usable
+        if self.ctx:
+            return True
+        if not self.settings:
+            self.loadSettings()
+        startTime = time.perf_counter()
+        mgl_name, glc_name = self.getWheelNames()
         mgl_path = Krita.getAppDataLocation() + "/pykrita/kritamoderngl/bin/"
-        if not os.path.exists(os.path.join(mgl_path, mgl_name)):
-            os.makedirs(os.path.join(mgl_path, mgl_name))
-            try:
-                with ZipFile(os.path.join(mgl_path, mgl_name) + ".whl", "r") as mgl_zip:
-                    mgl_zip.extractall(os.path.join(mgl_path, mgl_name))
-            except:
-                # This platform has no valid ModernGL build
-                self.log.warning("No valid ModernGL build found, attempted: %s", mgl_name)
+        if not self.extractWheel(mgl_path, mgl_name):
+            # This platform has no valid ModernGL build
+            self.log.warning("No valid ModernGL build found, attempted: %s", mgl_name)
         # Repeat for glcontext
-        if not os.path.exists(os.path.join(mgl_path, glc_name)):
-            os.makedirs(os.path.join(mgl_path, glc_name))
-            try:
-                with ZipFile(os.path.join(mgl_path, glc_name) + ".whl", "r") as glc_zip:
-                    glc_zip.extractall(os.path.join(mgl_path, glc_name))
-            except:
-                # This platform has no valid GLContext build
-                self.log.warning("No valid GLContext build found, attempted: %s", glc_name)
+        if not self.extractWheel(mgl_path, glc_name):
+            # This platform has no valid GLContext build
+            self.log.warning("No valid GLContext build found, attempted: %s", glc_name)
+        extractTime = time.perf_counter()
         # Add the directory to the path
-        sys.path.append(os.path.join(mgl_path, mgl_name))
-        sys.path.append(os.path.join(mgl_path, glc_name))
+        for name in (mgl_name, glc_name):
+            if os.path.join(mgl_path, name) not in sys.path:
+                sys.path.append(os.path.join(mgl_path, name))
         # Import the correct version of ModernGL
         try:
             import moderngl
-            # Initialize ModernGL here to have a persistant context
-            self.ctx = moderngl.create_context(standalone=True)
-            self.log.info("ModernGL initialized, GL_VENDOR: %s, GL_RENDERER: %s, GL_VERSION: %s", self.ctx.info["GL_VENDOR"], self.ctx.info["GL_RENDERER"], self.ctx.info["GL_VERSION"])
+            # Initialize ModernGL here to have a persistant context, on the backend and device from the settings
+            backend = self.settings.value("mgl_backend", "")
+            deviceIndex = int(self.settings.value("mgl_egl_device", "-1") or "-1")
+            software = self.settings.value("mgl_software", "false") == "true"
+            threads = int(self.settings.value("mgl_software_threads", "0") or "0")
+            self.ctx = BackendHelper.createContext(moderngl, backend, deviceIndex, software, threads)
+            self.log.info("ModernGL initialized with %s, GL_VENDOR: %s, GL_RENDERER: %s, GL_VERSION: %s", BackendHelper.describeSettings(backend, deviceIndex, software, threads), self.ctx.info["GL_VENDOR"], self.ctx.info["GL_RENDERER"], self.ctx.info["GL_VERSION"])
         except ImportError as e:
             self.log.warning("Failed to import ModernGL: %s", str(e))
+            return False
+        except Exception as e:
+            self.log.warning("Failed to create ModernGL context: %s", str(e))
+            return False
+        self.log.info("ModernGL start-up took %.1f ms (%.1f ms unpacking wheels)", (time.perf_counter() - startTime) * 1000, (extractTime - startTime) * 1000)
+        return True
+
+    def resetContext(self):
+        # Release the context so it is created again with the current settings on next use
+        if self.ctx:
+            self.ctx.release()
+            self.ctx = None
+            self.initModernGL()
+
+    def getResultCache(self):
+        # The cache is kept in the plugin folder, its limits in MiB can be changed in krita-scripterrc
+        if not self.resultCache:
+            self.resultCache = ResultCache.ResultCache(
+                Krita.getAppDataLocation() + "/pykrita/kritamoderngl/cache",
+                int(self.settings.value("mgl_cache_memory", str(ResultCache.defaultMemoryLimit))),
+                int(self.settings.value("mgl_cache_disk", str(ResultCache.defaultDiskLimit))))
+        return self.resultCache
+
+    def layerStatistics(self, node, kind, doc=None):
+        # Reduce a layer over the document area on the GPU, for the dialogs and for scripts
+        # kind is a key from ReductionHelper.reductionTypes, returns a dict of small results
+        if not self.initModernGL():
+            raise Exception("ModernGL could not be loaded on this system.")
+        if not doc:
+            doc = Krita.instance().activeDocument()
+        reducer = ReductionHelper.ReductionHelper()
+        with self.ctx as ctx:
+            try:
+                return reducer.reduce(ctx, node, doc.width(), doc.height(), kind)
+            finally:
+                reducer.cleanUp()
 
     def setup(self):
         pass
 
+    def showInitError(self):
+        QMessageBox.warning(None, "Krita ModernGL", "ModernGL could not be loaded on this system.\nCheck log.log in the kritamoderngl plugin folder for details.")
+
     def RenderShaderAction(self):
-        configPath = QStandardPaths.writableLocation(QStandardPaths.GenericConfigLocation)
-        self.settings = QSettings(configPath + '/krita-scripterrc', QSettings.IniFormat)
+        self.loadSettings()
+        if not self.initModernGL():
+            self.showInitError()
+            return
         self.mainDialog = RenderShaderDialog.RenderShaderDialog(self)
 
     def ComputeShaderAction(self):
-        configPath = QStandardPaths.writableLocation(QStandardPaths.GenericConfigLocation)
-        self.settings = QSettings(configPath + '/krita-scripterrc', QSettings.IniFormat)
+        self.loadSettings()
+        if not self.initModernGL():
+            self.showInitError()
+            return
         self.mainDialog = ComputeShaderDialog.ComputeShaderDialog(self)
 
+    def BackendSettingsAction(self):
+        # Does not need ModernGL until the benchmark is run or the settings are applied
+        self.loadSettings()
+        self.settingsDialog = BackendSettingsDialog.BackendSettingsDialog(self)
+
     def createActions(self, window):
         mainAction = window.createAction("KritaModernGL_Render", "OpenGL Render Shader Programming")
         mainAction.triggered.connect(self.RenderShaderAction)
         mainAction = window.createAction("KritaModernGL_Compute", "OpenGL Compute Shader Programming")
         mainAction.triggered.connect(self.ComputeShaderAction)
+        mainAction = window.createAction("KritaModernGL_Backend", "OpenGL Backend Settings")
+        mainAction.triggered.connect(self.BackendSettingsAction)
 
 Krita.instance().addExtension(KritaModernGL(Krita.instance()))